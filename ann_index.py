@@ -0,0 +1,259 @@
+# ann_index.py
+
+'''
+An approximate nearest-neighbour index over the word embedding for decoding predicted vectors into words, NumPy only.
+The normalized embedding rows are clustered by k-means into num_lists inverted lists (IVF). A query is only scored
+against the words of the nprobe lists whose centroids are closest to it, so the cost is about nprobe / num_lists of an
+exact scan. With num_subspaces > 0 the residuals of the words to their centroids are product quantized (PQ): every
+subspace of a residual is stored as the id of its nearest of 256 codes, and a query scores the codes through one small
+lookup table per subspace instead of the vectors. The rerank best of those scores can then be rescored exactly.
+IVFIndex has the topk and words of WordDecoder, so set_decoder(model, index) makes get_esaved, pred_dict_filter and
+get_accuracy decode through it.
+Usage:
+    python ann_index.py
+builds the index of the GloVe embedding, saves it to system_params.ann_index_path and prints recall@k against latency
+for several nprobe, next to the exact search of WordDecoder.
+'''
+
+import time
+import numpy as np
+from word_decoder import WordDecoder, normalize_rows, set_decoder
+from system_config import system_params
+
+
+def kmeans(vectors, num_clusters, num_iter=20, seed=0, batch_size=4096):
+    '''
+    Lloyd's k-means from num_clusters random rows, empty clusters are restarted at random rows.
+    Output:
+        centroids: shape (num_clusters, vector size)
+        assignment: the cluster of every row
+    '''
+    rng = np.random.RandomState(seed)
+    vectors = np.asarray(vectors, dtype=np.float32)
+    num_clusters = min(num_clusters, len(vectors))
+    centroids = vectors[rng.choice(len(vectors), num_clusters, replace=False)].copy()
+    for _ in range(num_iter):
+        assignment = assign(vectors, centroids, batch_size)
+        counts = np.bincount(assignment, minlength=num_clusters)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignment, vectors)
+        empty = counts == 0
+        centroids[~empty] = sums[~empty] / counts[~empty, None]
+        centroids[empty] = vectors[rng.choice(len(vectors), int(empty.sum()))]
+    return centroids, assign(vectors, centroids, batch_size)
+
+
+def assign(vectors, centroids, batch_size=4096):
+    '''
+    The closest centroid of every row by squared euclidean distance, computed batch_size rows at a time.
+    '''
+    centroid_norms = np.sum(centroids ** 2, axis=1)
+    assignment = np.empty(len(vectors), dtype=np.int64)
+    for start in range(0, len(vectors), batch_size):
+        distances = centroid_norms - 2 * np.dot(vectors[start:start + batch_size], centroids.T)
+        assignment[start:start + batch_size] = np.argmin(distances, axis=1)
+    return assignment
+
+
+class IVFIndex(object):
+    '''
+    Inverted lists over k-means centroids, with exact or product-quantized scoring of the probed lists.
+    The scores are inner products of normalized vectors, the cosine similarity that most_similar ranks by.
+    '''
+    def __init__(self, words, centroids, order, offsets, vectors=None, codes=None, codebooks=None, nprobe=16, rerank=0):
+        '''
+        Input:
+            words: the word of every row of the embedding
+            centroids: the list centroids, shape (num_lists, vector size)
+            order: the embedding rows sorted by list, the rows of list i are order[offsets[i]:offsets[i + 1]]
+            vectors: the normalized embedding rows in that order, needed without PQ and for reranking
+            codes, codebooks: the PQ codes of the residuals in that order, shape (num words, num_subspaces),
+                and the codes of every subspace, shape (num_subspaces, num_codes, subspace size)
+            nprobe: the number of lists scored per query
+            rerank: with PQ, the number of best candidates rescored exactly, 0 to rank by the PQ scores
+        '''
+        self.words = list(words)
+        self.centroids = centroids
+        self.order = order
+        self.offsets = offsets
+        self.vectors = vectors
+        self.codes = codes
+        self.codebooks = codebooks
+        self.nprobe = nprobe
+        self.rerank = rerank
+
+    @classmethod
+    def build(cls, vectors, words, num_lists=1024, num_subspaces=0, num_codes=256, keep_vectors=True, num_iter=20, seed=0,
+              max_train=262144, nprobe=16, rerank=0):
+        '''
+        Cluster the embedding and fill the lists.
+        Input:
+            vectors: the embedding matrix, one row per word
+            num_subspaces: the number of PQ subspaces, which must divide the vector size, 0 to store the vectors instead
+            num_codes: the codes per subspace, at most 256 so a code fits in a byte
+            keep_vectors: with PQ, also keep the vectors to rerank with
+            max_train: k-means runs on a random sample of at most this many rows, then every row is assigned
+        '''
+        vectors = normalize_rows(vectors)
+        rng = np.random.RandomState(seed)
+        sample = vectors
+        if len(vectors) > max_train:
+            sample = vectors[rng.choice(len(vectors), max_train, replace=False)]
+        print('clustering {} of {} words into {} lists'.format(len(sample), len(vectors), num_lists))
+        centroids, _ = kmeans(sample, num_lists, num_iter, seed)
+        assignment = assign(vectors, centroids)
+        order = np.argsort(assignment, kind='stable')
+        offsets = np.concatenate([[0], np.cumsum(np.bincount(assignment, minlength=len(centroids)))])
+        vectors = vectors[order]
+        codes, codebooks = None, None
+        if num_subspaces > 0:
+            if vectors.shape[1] % num_subspaces != 0:
+                raise ValueError('{} subspaces do not divide the vector size {}'.format(num_subspaces, vectors.shape[1]))
+            if num_codes > 256:
+                raise ValueError('at most 256 codes per subspace, got {}'.format(num_codes))
+            residuals = vectors - centroids[assignment[order]]
+            sub_size = vectors.shape[1] // num_subspaces
+            codes = np.empty((len(vectors), num_subspaces), dtype=np.uint8)
+            codebooks = np.empty((num_subspaces, num_codes, sub_size), dtype=np.float32)
+            for s in range(num_subspaces):
+                print('quantizing subspace {} of {}'.format(s + 1, num_subspaces))
+                sub = residuals[:, s * sub_size:(s + 1) * sub_size]
+                sub_sample = sub if len(sub) <= max_train else sub[rng.choice(len(sub), max_train, replace=False)]
+                codebook, _ = kmeans(sub_sample, num_codes, num_iter, seed + s + 1)
+                codebooks[s, :len(codebook)] = codebook
+                codebooks[s, len(codebook):] = 0
+                codes[:, s] = assign(sub, codebook)
+            if not keep_vectors:
+                vectors = None
+        return cls(words, centroids, order, offsets, vectors, codes, codebooks, nprobe, rerank)
+
+    @classmethod
+    def from_model(cls, model, **kwargs):
+        return cls.build(model.wv.vectors, model.wv.index2word, **kwargs)
+
+    def save(self, npz_path):
+        arrays = {'words': np.array(self.words), 'centroids': self.centroids, 'order': self.order, 'offsets': self.offsets}
+        for name in ['vectors', 'codes', 'codebooks']:
+            if getattr(self, name) is not None:
+                arrays[name] = getattr(self, name)
+        np.savez(npz_path, **arrays)
+
+    @classmethod
+    def load(cls, npz_path, nprobe=16, rerank=0):
+        with np.load(npz_path) as f:
+            optional = {name: f[name] if name in f.files else None for name in ['vectors', 'codes', 'codebooks']}
+            return cls([str(word) for word in f['words']], f['centroids'], f['order'], f['offsets'], nprobe=nprobe, rerank=rerank, **optional)
+
+    def _candidates(self, probe):
+        # the positions, in list order, of the words of the probed lists
+        return np.concatenate([np.arange(self.offsets[i], self.offsets[i + 1]) for i in probe])
+
+    def _score(self, query, candidates, centroid_scores, probe, k):
+        if self.codes is None:
+            return np.dot(self.vectors[candidates], query)
+        # q . x = q . centroid + q . residual, the residual scored through the lookup table of every subspace
+        num_subspaces, _, sub_size = self.codebooks.shape
+        table = np.einsum('scd,sd->sc', self.codebooks, query.reshape(num_subspaces, sub_size))
+        list_sizes = self.offsets[probe + 1] - self.offsets[probe]
+        scores = np.repeat(centroid_scores[probe], list_sizes)
+        codes = self.codes[candidates]
+        for s in range(num_subspaces):
+            scores += table[s, codes[:, s]]
+        # never rescore fewer than the k returned
+        rerank = max(self.rerank, k) if self.rerank > 0 else 0
+        if rerank > 0 and self.vectors is not None and len(candidates) > rerank:
+            best = np.argpartition(-scores, rerank - 1)[:rerank]
+            scores = np.full(len(candidates), -np.inf, dtype=np.float32)
+            scores[best] = np.dot(self.vectors[candidates[best]], query)
+        return scores
+
+    def topk(self, pred_words, k=10, batch_size=256):
+        '''
+        Input:
+            pred_words: the predicted vectors, shape (num vectors, vector size)
+            k: the number of neighbours of every vector
+        Output:
+            the embedding ids of the approximately k most similar words of every vector, most similar first,
+            shape (num vectors, k), padded with -1 if the probed lists hold fewer than k words
+        '''
+        pred_words = normalize_rows(pred_words)
+        nprobe = min(self.nprobe, len(self.centroids))
+        top = np.full((len(pred_words), k), -1, dtype=np.int64)
+        for start in range(0, len(pred_words), batch_size):
+            queries = pred_words[start:start + batch_size]
+            centroid_scores = np.dot(queries, self.centroids.T)
+            probes = np.argpartition(-centroid_scores, nprobe - 1, axis=1)[:, :nprobe]
+            for i in range(len(queries)):
+                probe = np.sort(probes[i])
+                candidates = self._candidates(probe)
+                scores = self._score(queries[i], candidates, centroid_scores[i], probe, k)
+                num = min(k, len(candidates))
+                best = np.argpartition(-scores, num - 1)[:num] if num < len(candidates) else np.arange(len(candidates))
+                best = best[np.argsort(-scores[best], kind='stable')]
+                top[start + i, :num] = self.order[candidates[best]]
+        return top
+
+    def nearest(self, vectors, batch_size=256):
+        return self.topk(vectors, 1, batch_size)[:, 0]
+
+
+def use_ann_index(model, npz_path, nprobe=16, rerank=0):
+    '''
+    Load a saved index and decode the predictions of model through it from now on.
+    '''
+    index = IVFIndex.load(npz_path, nprobe, rerank)
+    set_decoder(model, index)
+    print('decoding through the index {} with nprobe {}'.format(npz_path, nprobe))
+    return index
+
+
+def get_recall(exact_top, approx_top):
+    '''
+    The mean fraction of the exact top-k found by the approximate top-k.
+    '''
+    k = exact_top.shape[1]
+    return float(np.mean([len(np.intersect1d(exact_top[i], approx_top[i])) / k for i in range(len(exact_top))]))
+
+
+def recall_report(index, exact, queries, k=10, nprobes=(1, 2, 4, 8, 16, 32, 64)):
+    '''
+    Print recall@k and the latency per query of index for every nprobe, against the exact search.
+    Output:
+        a list of (nprobe, recall, milliseconds per query), the exact search first with nprobe None
+    '''
+    start = time.time()
+    exact_top = exact.topk(queries, k)
+    rows = [(None, 1.0, (time.time() - start) / len(queries) * 1000)]
+    saved_nprobe = index.nprobe
+    for nprobe in nprobes:
+        if nprobe > len(index.centroids):
+            break
+        index.nprobe = nprobe
+        start = time.time()
+        approx_top = index.topk(queries, k)
+        rows.append((nprobe, get_recall(exact_top, approx_top), (time.time() - start) / len(queries) * 1000))
+    index.nprobe = saved_nprobe
+    print('{:>8} {:>10} {:>14}'.format('nprobe', 'recall@{}'.format(k), 'ms per query'))
+    for nprobe, recall, latency in rows:
+        print('{:>8} {:>10.4f} {:>14.4f}'.format('exact' if nprobe is None else nprobe, recall, latency))
+    return rows
+
+
+def main():
+    import gensim.models.keyedvectors as word2vec
+    sys_params = system_params()
+    wv_model = word2vec.KeyedVectors.load_word2vec_format('glove.6B.100d.txt', binary=False)
+    index = IVFIndex.from_model(wv_model, num_lists=sys_params.ann_num_lists, num_subspaces=sys_params.ann_num_subspaces,
+                                nprobe=sys_params.ann_nprobe, rerank=sys_params.ann_rerank)
+    index.save(sys_params.ann_index_path)
+    print('saved the index to {}'.format(sys_params.ann_index_path))
+
+    # predicted vectors are near, not on, the words: random words with noise of the scale of the vectors
+    rng = np.random.RandomState(0)
+    vectors = wv_model.wv.vectors
+    queries = vectors[rng.choice(len(vectors), 2000, replace=False)]
+    queries = queries + 0.5 * vectors.std(axis=0) * rng.randn(*queries.shape)
+    recall_report(index, WordDecoder.from_model(wv_model), queries.astype(np.float32))
+
+if __name__ == '__main__':
+    main()
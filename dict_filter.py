@@ -4,10 +4,12 @@ import json, sys
 import shutil, os
 import numpy as np
 import nltk
-import tensorflow as tf
-import pygtrie as trie
 from gensim.models import Word2Vec
 import gensim.models.keyedvectors as word2vec
+from bisect import bisect_left
+from word_decoder import get_decoder, normalize_rows
+
+_prefix_indexes = {}
 
 
 '''
@@ -16,7 +18,7 @@ get_esaved function will return average esaved for the model.
 dict_filter will return a word which is the closest prediction given the inputs.
 '''
 
-def get_esaved(model, true_words, pred_words, topn=1, cons=20):
+def get_esaved(model, true_words, pred_words, topn=1, cons=20, true_ids=None):
     '''
     This function evaluates the model by calculating the eSaved as defined in checkpoint2.
     Inputs:
@@ -25,47 +27,96 @@ def get_esaved(model, true_words, pred_words, topn=1, cons=20):
         pred_words: the word vecs produced by the model
         topn: the number of nearest neighbours to be evaluated as correct, default to 1
         cons: the number of nearest neighbours to be considered, default to 20
+        true_ids: the ids of the true words in the model, recovered from true_words if not given
     Output:
     The average eSaved.
     '''
     print('begin getting eSaved')
-    
+    decoder = get_decoder(model)
+    if true_ids is None:
+        true_ids = decoder.nearest(true_words)
+    # the cons nearest words of every prediction, nearest first, from batched matmuls
+    candidates = decoder.topk(pred_words, cons)
+
     # calculate the esaved
     eSaved = 0
-    for i in range(len(true_words)):
-
-        true_word_vec = true_words[i]
-        pred_word_vec = pred_words[i]
-
-        temp1 = model.most_similar([true_word_vec], [], 1)
-        true_word = temp1[0][0]
-        similar_list = model.most_similar([pred_word_vec], [], cons)
-        pred_words_list = [pair[0] for pair in similar_list]
-        # build a trie tree to speed up the finding process
-        t = trie.CharTrie()
-        rt = {}
-        for i in range(len(pred_words_list)):
-            word = pred_words_list[i]
-            t[word] = i
-            rt[i] = word
-        inputs = ''
-        flag = False
-        for i in range(len(true_word)):
-            inputs += true_word[i]
-            es = 1 - (i + 1) / (len(true_word) + 1)
-            try:
-                m = list(t[inputs:])
-                m.sort()
-                for j in range(min(topn, len(m))):
-                    if rt[m[j]] == true_word:
-                        eSaved += es
-                        flag = True
-                        break
-            except KeyError:
+    for i in range(len(true_ids)):
+        true_word = decoder.words[true_ids[i]]
+        # an approximate decoder pads with -1 when it finds fewer than cons words
+        pred_words_list = [decoder.words[j] for j in candidates[i] if j >= 0]
+        for j in range(len(true_word)):
+            inputs = true_word[:j + 1]
+            # the candidates starting with what is typed so far, in order
+            m = [word for word in pred_words_list if word.startswith(inputs)]
+            if not m:
                 break
-            if flag:
+            if true_word in m[:topn]:
+                eSaved += 1 - (j + 1) / (len(true_word) + 1)
                 break
-    return eSaved / len(true_words)
+    return eSaved / len(true_ids)
+
+
+def get_prefix_range(words, prefix):
+    '''
+    The range [start, end) of the sorted words that start with prefix.
+    '''
+    start = bisect_left(words, prefix)
+    if prefix == '':
+        return start, len(words)
+    end = bisect_left(words, prefix[:-1] + chr(ord(prefix[-1]) + 1), start)
+    return start, end
+
+
+class PrefixIndex(object):
+    '''
+    The vocabulary sorted lexicographically, with the normalized embedding rows in the same order,
+    so the words starting with any prefix are one contiguous slice of the rows, found by bisection.
+    The exact nearest words among them are then one dot product over that slice, which shrinks with every typed character.
+    '''
+    def __init__(self, vectors, words):
+        '''
+        Input:
+            vectors: the embedding matrix, one row per word
+            words: the word of every row
+        '''
+        order = sorted(range(len(words)), key=lambda i: words[i])
+        self.words = [words[i] for i in order]
+        self.ids = np.array(order, dtype=np.int64)
+        self.vectors = normalize_rows(vectors)[self.ids]
+
+    @classmethod
+    def from_model(cls, model):
+        return cls(model.wv.vectors, model.wv.index2word)
+
+    def topk(self, pred_word_vec, k=1, prefix=''):
+        '''
+        Input:
+            pred_word_vec: the predicted vector
+            k: the number of words to return
+            prefix: only return words starting with it
+        Output:
+            The k words starting with prefix that are most similar to pred_word_vec, most similar first.
+        '''
+        start, end = get_prefix_range(self.words, prefix)
+        if start == end:
+            return []
+        scores = np.dot(self.vectors[start:end], normalize_rows(pred_word_vec))
+        if k < len(scores):
+            top = np.argpartition(-scores, k - 1)[:k]
+        else:
+            top = np.arange(len(scores))
+        top = top[np.argsort(-scores[top], kind='stable')]
+        return [self.words[start + i] for i in top]
+
+
+def get_prefix_index(model):
+    '''
+    The PrefixIndex of a word embedding, built once and reused by every later call with the same model.
+    '''
+    key = id(model)
+    if key not in _prefix_indexes or _prefix_indexes[key][0] is not model:
+        _prefix_indexes[key] = (model, PrefixIndex.from_model(model))
+    return _prefix_indexes[key][1]
 
 
 def pred_dict_filter(model, inputs, pred_word_vec, topn=1, cons=20):
@@ -76,39 +127,13 @@ def pred_dict_filter(model, inputs, pred_word_vec, topn=1, cons=20):
         inputs: the input word
         pred_word_vec: the word vec produced by the model
         topn: the number of nearest neighbours to be evaluated as correct, default to 1
-        cons: the number of nearest neighbours to be considered, default to 20
+        cons: the number of nearest neighbours to be considered when nothing is typed yet, default to 20
     Output:
         The predicted words as a list.
     '''
-    similar_list = model.most_similar([pred_word_vec], [], cons)
-    pred_words_list = [pair[0] for pair in similar_list]
-    '''
-    # This is a deprecated version that use trie tree to do the whole process
-    # build a trie tree to speed up the finding process
-    t = trie.CharTrie()
-    rt = {}
-    for i in range(len(pred_words_list)):
-        word = pred_words_list[i]
-        t[word] = i
-        rt[i] = word
-    try:
-        m = list(t[inputs:])
-        m.sort()
-        pred_word = rt[m[0]]
-    except KeyError:
-        return ''
-    return pred_word
-    '''
-    # This is a better version that uses Python's substring method
-    count = 0
-    word_list = []
-    for i in range(len(pred_words_list)):
-        word = pred_words_list[i]
-        if len(inputs) > len(word):
-            continue
-        if inputs == word[0:len(inputs)]:
-            word_list.append(word)
-            count += 1
-            if count == topn:
-                break
-    return word_list
+    if inputs == '':
+        # every word matches, search the whole vocabulary with the decoder of the model, which may be approximate
+        decoder = get_decoder(model)
+        return [decoder.words[i] for i in decoder.topk(np.asarray(pred_word_vec)[None], min(topn, cons))[0] if i >= 0]
+    # the exact nearest words among all words starting with inputs, not only among the cons nearest overall
+    return get_prefix_index(model).topk(pred_word_vec, topn, inputs)
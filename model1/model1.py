@@ -18,7 +18,8 @@ from model1_config import model1_params
 from nltk.util import ngrams
 from collections import Counter
 import pygtrie as trie
-import heapq, copy
+import heapq, copy, math
+from suffix_array import SuffixArrayIndex
 
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 from system_config import system_params
@@ -76,6 +77,11 @@ class Language_Model(object):
         self.num_voc = len(voc_set)
         self.voc_list = list(voc_set)
         self.pred_dict = {}
+        # counts of the next word indexed by the previous n-1 words, for phrase completion
+        self.context_index = {}
+        for ngram, count in self.ngrams.items():
+            self.context_index.setdefault(ngram[:-1], Counter())[ngram[-1]] = count
+        self.expansion_dict = {}
     
     def predict(self, prev_words, topn=10):
         '''
@@ -109,6 +115,65 @@ class Language_Model(object):
         self.pred_dict[tuple(prev_words[0:-1])]=prediction
         return prediction
 
+    def expand(self, context, beam_width):
+        '''
+        Return the beam_width most likely next words after context, with their log probability.
+        Only words seen after the context are candidates, so the probability is count / context count;
+        add-one smoothing only spreads mass over unseen words, which a beam never keeps.
+        Results are memoized, since different beams and requests keep reaching the same contexts.
+        '''
+        key = (context, beam_width)
+        if key in self.expansion_dict:
+            return self.expansion_dict[key]
+        counts = self.context_index.get(context)
+        if not counts:
+            expansions = []
+        else:
+            total = sum(counts.values())
+            expansions = [(math.log(count / total), word) for word, count in counts.most_common(beam_width)]
+        self.expansion_dict[key] = expansions
+        return expansions
+
+    def complete_phrase(self, prev_words, max_len=5, beam_width=3, min_prob=0.05):
+        '''
+        Generate multi-word completions given the prev_words by beam search.
+        Input:
+            prev_words: a list of strings, each of string is a word
+            max_len: the maximum number of words in a completion
+            beam_width: number of partial phrases kept after each step
+            min_prob: a phrase is not extended once its probability falls below this threshold
+        Output:
+            a list of phrases (each a list of words), best first, ranked by average log probability per word
+        '''
+        if max_len <= 0:
+            return []
+        context_len = self.n - 1
+        min_log_prob = math.log(min_prob)
+        beams = [(0.0, ())]
+        finished = []
+        for step in range(max_len):
+            candidates = []
+            for log_prob, phrase in beams:
+                history = tuple(prev_words) + phrase
+                context = history[len(history) - context_len:] if context_len > 0 else ()
+                extended = False
+                for word_log_prob, word in self.expand(context, beam_width):
+                    score = log_prob + word_log_prob
+                    # expansions are sorted, so the rest are below the threshold too
+                    if score < min_log_prob:
+                        break
+                    candidates.append((score, phrase + (word,)))
+                    extended = True
+                if not extended and phrase:
+                    finished.append((log_prob, phrase))
+            if not candidates:
+                break
+            beams = heapq.nlargest(beam_width, candidates)
+        else:
+            finished += beams
+        finished.sort(key=lambda pair: pair[0] / len(pair[1]), reverse=True)
+        return [list(phrase) for log_prob, phrase in finished]
+
 def sentence_concat(sentences):
     '''
     This is a helper function that concat a list of sentences into one sentence.
@@ -142,6 +207,27 @@ def ngram_train(filename, start_train, end_train, n):
     print('done')
     return lm
 
+def suffix_array_train(filename, start_train, end_train, index_dir):
+    '''
+    Generates the suffix array index over the training corpus, or loads it if it was built before.
+    Input:
+        filename: a string of location of corpus
+        start_train, end_train: start and end index
+        index_dir: the folder the index is saved to and memory-mapped from
+    Output:
+        a SuffixArrayIndex instance
+    '''
+    if os.path.isdir(index_dir):
+        print('loading the suffix array index')
+        return SuffixArrayIndex.load(index_dir)
+    print('building the suffix array index')
+    train_sentences, stars = get_review_data(filename, start_train, end_train)
+    train_sentences = [sentence[5:] for sentence in train_sentences]
+    train_sentences = sentence_concat(train_sentences)
+    SuffixArrayIndex.build(train_sentences).save(index_dir)
+    print('done')
+    return SuffixArrayIndex.load(index_dir)
+
 def ngram_test(filename, start_test, end_test, n):
     """
     Generates the test inputs.
@@ -251,8 +337,13 @@ def main():
     start_test, end_test = model_params.test_start, model_params.test_end
     
     print('---------------- Getting Data and Training----------------')
-    lm = ngram_train(sys_params.all_reviews_jsonfn, start_train, end_train, model_params.n)
-    test_ngrams = ngram_test(sys_params.all_reviews_jsonfn, start_test, end_test, model_params.n)
+    if model_params.use_suffix_array:
+        # the suffix array sees up to max_context previous words instead of n-1
+        lm = suffix_array_train(sys_params.all_reviews_jsonfn, start_train, end_train, model_params.suffix_array_dir)
+        test_ngrams = ngram_test(sys_params.all_reviews_jsonfn, start_test, end_test, model_params.max_context + 1)
+    else:
+        lm = ngram_train(sys_params.all_reviews_jsonfn, start_train, end_train, model_params.n)
+        test_ngrams = ngram_test(sys_params.all_reviews_jsonfn, start_test, end_test, model_params.n)
     print('---------------- Done Getting Data and Training----------------')
 
     # begin predicting
@@ -21,3 +21,8 @@ class model1_params:
         self.test_end = self.test_start + self.test_size
         
         self.save_path = './model1_train_{}_test_{}_n_{}/save.p'.format(self.train_size, self.test_size, self.n)
+
+        # longest-match prediction with a suffix array instead of fixed n
+        self.use_suffix_array = False
+        self.max_context = 10
+        self.suffix_array_dir = './model1_train_{}_suffix_array'.format(self.train_size)
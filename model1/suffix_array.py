@@ -0,0 +1,197 @@
+# suffix_array.py
+
+'''
+A suffix array index over the id-encoded training corpus.
+Unlike the n-gram model, the context length is not fixed at training time:
+given whatever the user has typed, we look up the longest suffix of it that
+occurs in the corpus and count the words that follow it.
+Memory is linear in the corpus size (one id array and one suffix array),
+and both arrays are memory-mapped from disk when the index is loaded.
+'''
+
+import json, os
+import numpy as np
+
+CORPUS_FN = 'corpus.npy'
+SA_FN = 'suffix_array.npy'
+VOCAB_FN = 'vocab.json'
+
+
+def build_suffix_array(corpus):
+    '''
+    Build the suffix array of an integer array by prefix doubling.
+    Every round sorts all suffixes at once by (rank of first k tokens, rank of next k tokens)
+    with np.lexsort, so the whole construction runs in O(log n) vectorized passes.
+    Input:
+        corpus: 1-d array of non-negative token ids
+    Output:
+        an int64 array sa such that corpus[sa[i]:] are in increasing lexicographic order
+    '''
+    n = len(corpus)
+    if n == 0:
+        return np.zeros(0, dtype=np.int64)
+    rank = np.asarray(corpus, dtype=np.int64)
+    sa = np.argsort(rank, kind='stable')
+    k = 1
+    while True:
+        # -1 sorts before every token, i.e. a suffix that ends is smaller
+        second = np.full(n, -1, dtype=np.int64)
+        second[:n - k] = rank[k:]
+        sa = np.lexsort((second, rank))
+        first_sorted, second_sorted = rank[sa], second[sa]
+        new_group = np.empty(n, dtype=bool)
+        new_group[0] = True
+        new_group[1:] = (first_sorted[1:] != first_sorted[:-1]) | (second_sorted[1:] != second_sorted[:-1])
+        rank = np.empty(n, dtype=np.int64)
+        rank[sa] = np.cumsum(new_group) - 1
+        if rank[sa[-1]] == n - 1 or k >= n:
+            break
+        k *= 2
+    return sa
+
+
+class SuffixArrayIndex(object):
+    '''
+    Holds the id-encoded corpus, its suffix array and the vocabulary,
+    and answers longest-match continuation queries by binary search.
+    '''
+    def __init__(self, corpus, sa, voc_list):
+        self.corpus = corpus
+        self.sa = sa
+        self.voc_list = voc_list
+        self.word2id = {word: i for i, word in enumerate(voc_list)}
+        self.num_tokens = len(corpus)
+
+    @classmethod
+    def build(cls, sentences):
+        '''
+        Build the index from a list of words (the concatenated training reviews).
+        '''
+        voc_list = sorted(set(sentences))
+        word2id = {word: i for i, word in enumerate(voc_list)}
+        corpus = np.array([word2id[word] for word in sentences], dtype=np.int32)
+        sa = build_suffix_array(corpus).astype(np.int32 if len(corpus) < 2**31 else np.int64)
+        return cls(corpus, sa, voc_list)
+
+    def save(self, folder):
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        np.save(os.path.join(folder, CORPUS_FN), self.corpus)
+        np.save(os.path.join(folder, SA_FN), self.sa)
+        with open(os.path.join(folder, VOCAB_FN), 'w') as f:
+            json.dump(self.voc_list, f)
+
+    @classmethod
+    def load(cls, folder, mmap=True):
+        '''
+        Load a saved index. With mmap=True the corpus and suffix array stay on disk
+        and only the pages touched by the binary searches are read.
+        '''
+        mmap_mode = 'r' if mmap else None
+        corpus = np.load(os.path.join(folder, CORPUS_FN), mmap_mode=mmap_mode)
+        sa = np.load(os.path.join(folder, SA_FN), mmap_mode=mmap_mode)
+        with open(os.path.join(folder, VOCAB_FN)) as f:
+            voc_list = json.load(f)
+        return cls(corpus, sa, voc_list)
+
+    def _compare(self, pos, pattern):
+        '''
+        Compare the suffix starting at pos with pattern, looking at len(pattern) tokens only.
+        Returns -1, 0 or 1 as the suffix is smaller than, starts with, or is larger than pattern.
+        '''
+        m = len(pattern)
+        seg = np.asarray(self.corpus[pos:pos + m])
+        diff = np.nonzero(seg != pattern[:len(seg)])[0]
+        if len(diff) > 0:
+            j = diff[0]
+            return -1 if seg[j] < pattern[j] else 1
+        if len(seg) < m:
+            # the suffix ran out of tokens while matching
+            return -1
+        return 0
+
+    def find(self, pattern):
+        '''
+        Find the range [lo, hi) of suffix array entries whose suffix starts with pattern.
+        Input:
+            pattern: 1-d array of token ids
+        Output:
+            lo, hi, with lo == hi if the pattern does not occur
+        '''
+        lo, hi = 0, self.num_tokens
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._compare(self.sa[mid], pattern) < 0:
+                lo = mid + 1
+            else:
+                hi = mid
+        start = lo
+        hi = self.num_tokens
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._compare(self.sa[mid], pattern) <= 0:
+                lo = mid + 1
+            else:
+                hi = mid
+        return start, lo
+
+    def encode(self, prev_words):
+        '''
+        Map words to ids, keeping only the part of the context after the last unknown word,
+        since no suffix containing an unknown word can match.
+        '''
+        ids = []
+        for word in prev_words:
+            if word in self.word2id:
+                ids.append(self.word2id[word])
+            else:
+                ids = []
+        return np.array(ids, dtype=self.corpus.dtype)
+
+    def longest_match(self, prev_words, max_len=None):
+        '''
+        Find the longest suffix of prev_words that occurs in the corpus with a continuation.
+        If a suffix of length m does not occur, no longer suffix can, so we stop there.
+        Input:
+            prev_words: a list of strings, everything the user has typed so far
+            max_len: optional cap on the match length
+        Output:
+            (match length, lo, hi) where sa[lo:hi] are the occurrences of the match
+        '''
+        context = self.encode(prev_words)
+        if max_len is not None:
+            context = context[max(0, len(context) - max_len):]
+        best = (0, 0, self.num_tokens)
+        for m in range(1, len(context) + 1):
+            lo, hi = self.find(context[len(context) - m:])
+            # an occurrence at the very end of the corpus has nothing after it
+            if lo == hi or (hi - lo == 1 and self.sa[lo] + m >= self.num_tokens):
+                break
+            best = (m, lo, hi)
+        return best
+
+    def continuation_counts(self, prev_words, max_len=None):
+        '''
+        Count the words following the longest matching suffix of prev_words.
+        Output:
+            match length, array of continuation ids, array of their counts
+        '''
+        m, lo, hi = self.longest_match(prev_words, max_len)
+        positions = np.asarray(self.sa[lo:hi], dtype=np.int64) + m
+        positions = positions[positions < self.num_tokens]
+        next_ids = np.asarray(self.corpus[positions])
+        ids, counts = np.unique(next_ids, return_counts=True)
+        return m, ids, counts
+
+    def predict(self, prev_words, topn=10, max_len=None):
+        '''
+        Generate topn predictions given the prev_words, backing off to the longest match.
+        Output:
+            a list of words, in decending order of their count after the matched context
+        '''
+        m, ids, counts = self.continuation_counts(prev_words, max_len)
+        if len(ids) > topn:
+            top = np.argpartition(-counts, topn - 1)[:topn]
+            ids, counts = ids[top], counts[top]
+        order = np.argsort(-counts, kind='stable')
+        return [self.voc_list[i] for i in ids[order]]
@@ -1,6 +1,5 @@
 from pathlib import Path
-from operator import itemgetter
-import json, sys, shutil, os
+import json, sys, os
 import numpy as np
 import nltk
 import tensorflow as tf
@@ -9,78 +8,65 @@ import gensim.models.keyedvectors as word2vec
 from model2_config import model2_params
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 from system_config import system_params
-from prep_data import get_review_data, get_word_embedding
+from prep_data import get_review_data, get_word_embedding, get_word_ids
 from dict_filter import get_esaved
+from word_decoder import get_decoder, get_topk_accuracy
+from train_utils import prepare_save_path, split_validation, CheckpointManager, get_validation_loss, train_epochs, skip_batches
 
 os.environ["TF_CPP_MIN_LOG_LEVEL"]="3"
 
 # start predicting from the 6th word
-def prepare_input_for_nn(model, sentences, stars, reverse=False):
-    # list of numpy array (each is a embedding representing the previous sequence)
-    inputs = []
-    # list of vector (true word representing by vector)
-    true_words = []
-    if not reverse:
-        for i in range(len(sentences)):
-            sentence = sentences[i]
-            star = np.array([stars[i]])
-            if len(sentence) < 5:
-                continue
-
-            # unnormalized one doesn't divide by the total weight
-            weighted_sum = np.zeros(model.vector_size)
-            total_weight = 0
-            for i in range(5):
-                total_weight += i+1
-                if sentence[i] in model.wv.vocab:
-                    weighted_sum += model[sentence[i]] * (i+1)
-
-            # begin prepare input and label
-            for i in range(5, len(sentence)):
-                cur_input = weighted_sum / total_weight
-                cur_label = sentence[i]
-
-                if cur_label in model.wv.vocab:
-                    inputs.append(np.concatenate((cur_input, star), axis=0))
-                    true_words.append(model[cur_label])
-
-                    weighted_sum += model[cur_label] * (i+1)
-
-                total_weight += i+1
-
-    else:
-        max_weight = len(sentences)
-        for i in range(len(sentences)):
-            sentence = sentences[i]
-            star = np.array([stars[i]])
-            if len(sentence) < 5:
-                continue
-
-            # unnormalized one doesn't divide by the total weight
-            weighted_sum = np.zeros(model.vector_size)
-            total_weight = 0
-            for i in range(5):
-                cur_weight = max_weight-i-1
-                total_weight += cur_weight
-                if sentence[i] in model.wv.vocab:
-                    weighted_sum += model[sentence[i]] * (cur_weight)
-
-            # begin prepare input and label
-            for i in range(5, len(sentence)):
-                cur_weight = max_weight-i-1
-                cur_input = weighted_sum / total_weight
-                cur_label = sentence[i]
-
-                if cur_label in model.wv.vocab:
-                    inputs.append(np.concatenate((cur_input, star), axis=0))
-                    true_words.append(model[cur_label])
-
-                    weighted_sum += model[cur_label] * cur_weight
-
-                total_weight += cur_weight
-
-            
-
+def prepare_input_for_nn(model, sentences, stars, reverse=False, return_ids=False):
+    '''
+    The input for the word at position i is the weighted average of the embeddings of all previous words
+    (words out of the vocabulary count as zero vectors), concatenated with the star of the review.
+    The weight of position j is j+1, or len(sentences)-j-1 if reverse.
+    All prefix averages of a review come from one cumulative sum over its embedding matrix.
+    Output:
+        inputs: float32 array of shape (num examples, vector_size+1)
+        true_words: float32 array of shape (num examples, vector_size), the vector of the true word
+        true_ids: the id of the true word in the model, if return_ids
+    '''
+    dim = model.vector_size
+    vectors = model.wv.vectors
+    sentence_ids = [get_word_ids(model, sentence) for sentence in sentences]
+    # one example per word in the vocabulary from the 6th word on
+    num_examples = sum(int(np.count_nonzero(ids[5:] >= 0)) for ids in sentence_ids if len(ids) >= 5)
+    inputs = np.empty((num_examples, dim + 1), dtype=np.float32)
+    true_words = np.empty((num_examples, dim), dtype=np.float32)
+    true_ids = np.empty(num_examples, dtype=np.int64)
+
+    max_weight = len(sentences)
+    k = 0
+    for i in range(len(sentences)):
+        ids = sentence_ids[i]
+        if len(ids) < 5:
+            continue
+        known = ids >= 0
+        targets = np.nonzero(known[5:])[0] + 5
+        if len(targets) == 0:
+            continue
+        positions = np.arange(len(ids))
+        if not reverse:
+            weights = positions + 1
+        else:
+            weights = max_weight - positions - 1
+
+        embedding = vectors[np.where(known, ids, 0)].astype(np.float64)
+        embedding[~known] = 0
+        # unnormalized sums of words up to and including each position
+        weighted_sums = np.cumsum(embedding * weights[:, None], axis=0)
+        total_weights = np.cumsum(weights)
+
+        end = k + len(targets)
+        inputs[k:end, :dim] = weighted_sums[targets - 1] / total_weights[targets - 1, None]
+        inputs[k:end, dim] = stars[i]
+        true_words[k:end] = vectors[ids[targets]]
+        true_ids[k:end] = ids[targets]
+        k = end
+
+    if return_ids:
+        return inputs, true_words, true_ids
     return inputs, true_words
 
 def build_nn(input_ph, out_size=100):
@@ -90,6 +76,8 @@ def build_nn(input_ph, out_size=100):
     hidden4 = tf.layers.dense(inputs=hidden3, units=256, activation=tf.nn.relu)
     hidden5 = tf.layers.dense(inputs=hidden4, units=128, activation=tf.nn.relu)
     output = tf.layers.dense(inputs=hidden5, units=out_size)
+    # a stable name for serving to look the output up by
+    output = tf.identity(output, name='prediction')
     return output
 
 def get_loss(pred_word, true_word):
@@ -102,82 +90,87 @@ def get_optimizer(loss, lr=0.005):
     # return a tf operation
     return tf.train.AdamOptimizer(learning_rate=lr).minimize(loss)
 
-def train_nn(model, sess, saver, input_ph, word_ph, loss, train_op, inputs, true_words, batch_size, training, num_epoch, save_path):
-    print("begin training")
+def get_input_pipeline(num_features, num_labels, batch_size, num_epoch, shuffle_buffer=100000, prefetch=2):
+    '''
+    Build a tf.data pipeline that shuffles, batches and prefetches the training arrays for num_epoch epochs,
+    train_nn runs it one epoch at a time.
+    The arrays are fed through placeholders when the iterator is initialized, so they are not stored in the graph.
+    Output:
+        features_ph, labels_ph: the placeholders to feed the arrays with when initializing
+        iterator: an initializable iterator over (features, labels) batches
+    '''
+    features_ph = tf.placeholder(tf.float32, [None, num_features])
+    labels_ph = tf.placeholder(tf.float32, [None, num_labels])
+    dataset = tf.data.Dataset.from_tensor_slices((features_ph, labels_ph))
+    dataset = dataset.shuffle(shuffle_buffer).repeat(num_epoch).batch(batch_size).prefetch(prefetch)
+    iterator = dataset.make_initializable_iterator()
+    return features_ph, labels_ph, iterator
+
+def train_nn(sess, manager, loss, train_op, iterator, features_ph, labels_ph, inputs, true_words, num_epoch, log_every=1000, checkpoint_every=0, validation_loss=None):
+    '''
+    Train for the epochs manager has not finished yet, with an iterator over one epoch of the pipeline.
+    manager: the CheckpointManager of the run, it saves the checkpoints and decides when to stop early
+    validation_loss: a function of the session returning the held-out loss
+    '''
     writer = tf.summary.FileWriter('./graphs', sess.graph)
     loss_summary = tf.summary.scalar('loss', loss)
-    # merged = tf.summary.merge_all()
-    index = np.arange(len(inputs))
-    # change inputs and true_words vectors to np array
-    ### inputs = np.reshape(np.array(inputs), (len(inputs), model.vector_size))
-    ### true_words = np.reshape(np.array(true_words), (len(inputs), model.vector_size))
-
-    iterations = int(len(inputs)/batch_size)
-
-    for i in range(iterations):
-        batch_index = np.random.choice(index, size=batch_size, replace=True)
-        batch_inputs = itemgetter(*batch_index)(inputs)
-        batch_words = itemgetter(*batch_index)(true_words)
-        batch_inputs_np = np.reshape(np.array(batch_inputs), (batch_size, model.vector_size+1))
-        batch_words_np = np.reshape(np.array(batch_words), (batch_size, model.vector_size))
-        sess.run(train_op, feed_dict={input_ph: batch_inputs_np, word_ph: batch_words_np, training:False})
-        cur_loss = sess.run(loss, feed_dict={input_ph: batch_inputs_np, word_ph: batch_words_np, training:False})
-        if i % 1000 == 0:
-            print("loss for batch {} is {}".format(i, cur_loss))
-        summary = sess.run(loss_summary, feed_dict={input_ph: batch_inputs_np, word_ph: batch_words_np, training:False})
-        writer.add_summary(summary, i)
-
-
-    for r in range(num_epoch-1):
-        for i in range(iterations):
-            batch_index = np.random.choice(index, size=batch_size, replace=True)
-            batch_inputs = itemgetter(*batch_index)(inputs)
-            batch_words = itemgetter(*batch_index)(true_words)
-            batch_inputs_np = np.reshape(np.array(batch_inputs), (batch_size, model.vector_size+1))
-            batch_words_np = np.reshape(np.array(batch_words), (batch_size, model.vector_size))
-            sess.run(train_op, feed_dict={input_ph: batch_inputs_np, word_ph: batch_words_np, training:False})
-            cur_loss = sess.run(loss, feed_dict={input_ph: batch_inputs_np, word_ph: batch_words_np, training:False})
-            if i % 1000 == 0:
-                print("loss for batch {} is {}".format(i, cur_loss))
 
-    
-    saver.save(sess, save_path)
+    # the graph reads its batches from the iterator, so there is nothing to feed
+    next_labels = iterator.get_next()[1]
+    def init_epoch(sess, skip):
+        sess.run(iterator.initializer, feed_dict={features_ph: inputs, labels_ph: true_words})
+        skip_batches(sess, next_labels, skip)
+    train_epochs(sess, manager, loss, train_op, num_epoch, init_epoch, log_every=log_every, checkpoint_every=checkpoint_every,
+                 validation_loss=validation_loss, summary=loss_summary, writer=writer)
+
+
+def get_validation_batches(input_ph, word_ph, inputs, true_words, batch_size=1024):
+    '''
+    The (feed_dict, batch size) pairs of get_validation_loss over the validation arrays.
+    '''
+    for start in range(0, len(inputs), batch_size):
+        yield {input_ph: inputs[start:start + batch_size], word_ph: true_words[start:start + batch_size]}, len(inputs[start:start + batch_size])
+
+
+def predict_in_batches(sess, nn_model, input_ph, inputs, batch_size=1024):
+    '''
+    Run the network over inputs in fixed-size batches, yielding the predictions of each batch.
+    '''
+    for start in range(0, len(inputs), batch_size):
+        yield sess.run(nn_model, feed_dict={input_ph: inputs[start:start + batch_size]})
 
 
-def get_prediction(model, nn_model, test_sentences, test_stars, input_ph, word_ph, training_ph, save_path):
+def get_prediction(model, nn_model, test_sentences, test_stars, input_ph, save_path, batch_size=1024, return_ids=False):
+    '''
+    return_ids: also return the ids of the true words in the model
+    '''
     print('begin predicting')
-    test_inputs, test_true_words = prepare_input_for_nn(model, test_sentences, test_stars, reverse=False)
+    test_inputs, test_true_words, test_true_ids = prepare_input_for_nn(model, test_sentences, test_stars, reverse=False, return_ids=True)
     print('test true word len = {}'.format(len(test_true_words)))
-    test_inputs = np.reshape(np.array(test_inputs), (len(test_inputs), model.vector_size+1))
-    test_true_words = np.reshape(np.array(test_true_words), (len(test_true_words), model.vector_size))
+    test_pred_words = np.empty((len(test_inputs), model.vector_size), dtype=np.float32)
     with tf.Session() as sess:
         saver = tf.train.Saver()
         saver.restore(sess, save_path)
-        test_pred_words = sess.run(nn_model, feed_dict={input_ph: test_inputs, word_ph: test_true_words, training_ph:False})
+        start = 0
+        for batch_pred in predict_in_batches(sess, nn_model, input_ph, test_inputs, batch_size):
+            test_pred_words[start:start + len(batch_pred)] = batch_pred
+            start += len(batch_pred)
     print('test pred word len = {}'.format(len(test_pred_words)))
+    if return_ids:
+        return test_true_words, test_pred_words, test_true_ids
     return test_true_words, test_pred_words
 
 
-def get_accuracy(model, true_words, pred_words, topn=10):
+def get_accuracy(model, true_words, pred_words, topn=10, true_ids=None):
+    '''
+    The fraction of predictions whose true word is among their topn nearest words, decoded in batches.
+    true_ids: the ids of the true words in the model, recovered from true_words if not given
+    '''
     print('begin getting accuracy')
-    correct = 0
-    for i in range(len(true_words)):
-
-        true_word_vec = true_words[i]
-        pred_word_vec = pred_words[i]
-
-        temp1 = model.most_similar([true_word_vec], [], 1)
-        true_words_set = set([pair[0] for pair in temp1])
-        temp2 = model.most_similar([pred_word_vec], [], 10)
-        pred_words_set = set([pair[0] for pair in temp2])
-
-        if bool(true_words_set & pred_words_set):
-            correct += 1
-
-        if i % 1000 == 0:
-            print('done calculating acc idx = {}'.format(i))
-
-    return correct / len(true_words)
+    decoder = get_decoder(model)
+    if true_ids is None:
+        true_ids = decoder.nearest(true_words)
+    return get_topk_accuracy(decoder, true_ids, pred_words, topn)
 
 
 def main():
@@ -185,11 +178,7 @@ def main():
     model_params = model2_params()
 
     save_path = model_params.tf_save_path
-    save_folder = os.path.dirname(save_path)
-    while os.path.isdir(save_folder):
-        overwrite = input("There is a existing model on this path, overwrite? [y/n]")
-        if (overwrite == 'y'):
-            shutil.rmtree(save_folder)
+    prepare_save_path(save_path, model_params.save_policy)
 
     start_train, end_train = model_params.train_start, model_params.train_end
     start_test, end_test = model_params.test_start, model_params.test_end
@@ -197,38 +186,55 @@ def main():
     print('---------------- Getting Data ----------------')
     wv_model, train_sentences, train_stars = get_word_embedding(sys_params.all_reviews_jsonfn, start_train, end_train, use_glove=True)
     test_sentences, test_stars = get_review_data(sys_params.all_reviews_jsonfn, start_test, end_test, shuffle=False, training=False)
+    train_sentences, train_stars, val_sentences, val_stars = split_validation(train_sentences, train_stars, model_params.validation_fraction)
     print('---------------- Done Getting Data ----------------')
 
     print('---------------- Prepaing Input for Neural Network ----------------')
     train_fea, train_label = prepare_input_for_nn(wv_model, train_sentences, train_stars, reverse=False)
+    val_fea, val_label = prepare_input_for_nn(wv_model, val_sentences, val_stars, reverse=False)
     print('---------------- Done Prepaing Input for Neural Network ----------------')
     
-    input_ph = tf.placeholder(tf.float32, [None, wv_model.vector_size+1], name='train_input')
-    word_ph = tf.placeholder(tf.float32, [None, wv_model.vector_size], name='train_label')
+    features_ph, labels_ph, iterator = get_input_pipeline(
+        wv_model.vector_size+1,
+        wv_model.vector_size,
+        model_params.batch_size,
+        1,
+        shuffle_buffer=model_params.shuffle_buffer,
+        prefetch=model_params.prefetch)
+    batch_inputs, batch_words = iterator.get_next()
+    # training reads from the pipeline, prediction feeds these directly
+    input_ph = tf.placeholder_with_default(batch_inputs, [None, wv_model.vector_size+1], name='train_input')
+    word_ph = tf.placeholder_with_default(batch_words, [None, wv_model.vector_size], name='train_label')
     training = tf.placeholder(tf.bool)
     
     nn_model = build_nn(input_ph)
     loss = get_loss(nn_model, word_ph)
     train_op = get_optimizer(loss, model_params.learning_rate)
-    saver = tf.train.Saver()
+    manager = CheckpointManager(save_path, model_params.patience, model_params.min_delta)
+    validation_loss = None
+    if len(val_fea) > 0:
+        validation_loss = lambda sess: get_validation_loss(sess, loss, get_validation_batches(input_ph, word_ph, val_fea, val_label, model_params.predict_batch_size))
 
     # begin training
     print("---------------- Training ----------------")
     init = tf.global_variables_initializer()
     with tf.Session() as sess:
         sess.run(init)
-        train_nn(wv_model, sess, saver, input_ph, word_ph, loss, train_op, train_fea, train_label, 32, training, num_epoch=model_params.epoches, save_path=save_path)
+        manager.restore(sess)
+        train_nn(sess, manager, loss, train_op, iterator, features_ph, labels_ph, train_fea, train_label, model_params.epoches,
+                 log_every=model_params.log_every, checkpoint_every=model_params.checkpoint_every, validation_loss=validation_loss)
     print("---------------- Done Training ----------------")
     # t_input_ph = tf.placeholder(tf.float32, [None, model.vector_size], name='test_input')
     # t_word_ph = tf.placeholder(tf.float32, [None, model.vector_size], name='test_predicted_label')
     print("---------------- Predicting ----------------")
-    test_true_words, test_pred_words = get_prediction(wv_model, nn_model, test_sentences, test_stars, input_ph, word_ph, training, save_path)
+    test_true_words, test_pred_words, test_true_ids = get_prediction(wv_model, nn_model, test_sentences, test_stars, input_ph, save_path,
+                                                                     batch_size=model_params.predict_batch_size, return_ids=True)
     print("---------------- Done Predicting ----------------")
     print("---------------- Getting Accuracy ----------------")
-    acc = get_accuracy(wv_model, test_true_words, test_pred_words)
+    acc = get_accuracy(wv_model, test_true_words, test_pred_words, true_ids=test_true_ids)
     print('Accuracy is {}'.format(acc))
     print("---------------- Getting esaved ----------------")
-    eSaved = get_esaved(wv_model, test_true_words, test_pred_words, topn=1, cons=20)
+    eSaved = get_esaved(wv_model, test_true_words, test_pred_words, topn=1, cons=20, true_ids=test_true_ids)
     print("----------------------- DONE WITH GET ESAVED -----------------------")
     print('eSaved = {}'.format(eSaved))
 
@@ -0,0 +1,146 @@
+# model2_compress.py
+
+'''
+Post-training compression of model 2 for CPU latency.
+Inference cost of build_nn is dominated by the 256x512 and 512x256 matmuls.
+Every dense layer is replaced by a truncated-SVD factorization (kernel ~ A B with rank r),
+the factors are magnitude pruned, and the result is fine-tuned briefly on the training features
+with the pruned weights held at zero.
+The compressed graph names its output 'prediction' like build_nn, so it plugs into get_prediction.
+'''
+
+import sys, os
+import numpy as np
+import tensorflow as tf
+from model2_config import model2_params
+from model2 import prepare_input_for_nn, build_nn, get_loss, get_optimizer, get_input_pipeline, train_nn, get_prediction, get_accuracy
+from model2_numpy import load_dense_weights
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from system_config import system_params
+from prep_data import get_review_data, get_word_embedding
+from train_utils import prepare_save_path, CheckpointManager
+
+os.environ["TF_CPP_MIN_LOG_LEVEL"]="3"
+
+
+def magnitude_prune(weight, sparsity):
+    '''
+    Return the mask keeping the largest (1 - sparsity) fraction of the weights by magnitude.
+    '''
+    if sparsity <= 0:
+        return np.ones(weight.shape, dtype=np.float32)
+    threshold = np.percentile(np.abs(weight), sparsity * 100)
+    return (np.abs(weight) > threshold).astype(np.float32)
+
+
+def compress_layer(kernel, rank_ratio=0.25, sparsity=0.5):
+    '''
+    Factorize a kernel by truncated SVD and prune the factors.
+    The kernel is only factorized when the factors are smaller than the kernel itself.
+    Input:
+        kernel: array of shape (in, out)
+        rank_ratio: the kept rank as a fraction of min(in, out)
+        sparsity: the fraction of weights of every factor set to zero
+    Output:
+        a list of (factor, mask) pairs whose masked product approximates kernel
+    '''
+    n_in, n_out = kernel.shape
+    rank = max(1, int(rank_ratio * min(n_in, n_out)))
+    if rank * (n_in + n_out) < n_in * n_out:
+        u, s, vt = np.linalg.svd(kernel, full_matrices=False)
+        factors = [u[:, :rank] * s[:rank], vt[:rank]]
+    else:
+        factors = [kernel]
+    return [(factor.astype(np.float32), magnitude_prune(factor, sparsity)) for factor in factors]
+
+
+def compress_weights(kernels, rank_ratio=0.25, sparsity=0.5):
+    layers = [compress_layer(kernel, rank_ratio, sparsity) for kernel in kernels]
+    for i, layer in enumerate(layers):
+        num_weights = sum(int(mask.sum()) for factor, mask in layer)
+        print('layer {}: {} -> {} factors, {} -> {} nonzero weights'.format(
+            i, kernels[i].shape, len(layer), kernels[i].size, num_weights))
+    return layers
+
+
+def build_compressed_nn(input_ph, layers, biases):
+    '''
+    The graph of build_nn with every kernel replaced by the product of its masked factors.
+    '''
+    output = input_ph
+    last = len(layers) - 1
+    for i in range(len(layers)):
+        with tf.variable_scope('compressed_{}'.format(i)):
+            for j, (factor, mask) in enumerate(layers[i]):
+                weight = tf.get_variable('factor_{}'.format(j), initializer=factor * mask)
+                output = tf.matmul(output, weight * tf.constant(mask))
+            bias = tf.get_variable('bias', initializer=biases[i].astype(np.float32))
+            output = output + bias
+        if i != last:
+            output = tf.nn.relu(output)
+    output = tf.identity(output, name='prediction')
+    return output
+
+
+def cosine_loss(true_words, pred_words):
+    '''
+    The mean cosine distance between every predicted vector and its true word vector.
+    '''
+    true_norm = true_words / np.linalg.norm(true_words, axis=1, keepdims=True)
+    pred_norm = pred_words / np.maximum(np.linalg.norm(pred_words, axis=1, keepdims=True), 1e-12)
+    return float(np.mean(1 - np.sum(true_norm * pred_norm, axis=1)))
+
+
+def main():
+    sys_params = system_params()
+    model_params = model2_params()
+
+    start_train, end_train = model_params.train_start, model_params.train_end
+    start_test, end_test = model_params.test_start, model_params.test_end
+
+    print('---------------- Getting Data ----------------')
+    wv_model, train_sentences, train_stars = get_word_embedding(sys_params.all_reviews_jsonfn, start_train, end_train, use_glove=True)
+    test_sentences, test_stars = get_review_data(sys_params.all_reviews_jsonfn, start_test, end_test, shuffle=False, training=False)
+    train_fea, train_label = prepare_input_for_nn(wv_model, train_sentences, train_stars, reverse=False)
+    print('---------------- Done Getting Data ----------------')
+
+    print('---------------- Compressing ----------------')
+    kernels, biases = load_dense_weights(model_params.tf_save_path)
+    layers = compress_weights(kernels, model_params.compress_rank_ratio, model_params.compress_sparsity)
+
+    results = {}
+    for name, save_path in [('original', model_params.tf_save_path), ('compressed', model_params.compressed_save_path)]:
+        with tf.Graph().as_default():
+            if name == 'original':
+                input_ph = tf.placeholder(tf.float32, [None, wv_model.vector_size+1], name='train_input')
+                nn_model = build_nn(input_ph)
+            else:
+                print('---------------- Fine-tuning ----------------')
+                features_ph, labels_ph, iterator = get_input_pipeline(
+                    wv_model.vector_size+1,
+                    wv_model.vector_size,
+                    model_params.batch_size,
+                    1,
+                    shuffle_buffer=model_params.shuffle_buffer,
+                    prefetch=model_params.prefetch)
+                batch_inputs, batch_words = iterator.get_next()
+                input_ph = tf.placeholder_with_default(batch_inputs, [None, wv_model.vector_size+1], name='train_input')
+                word_ph = tf.placeholder_with_default(batch_words, [None, wv_model.vector_size], name='train_label')
+                nn_model = build_compressed_nn(input_ph, layers, biases)
+                loss = get_loss(nn_model, word_ph)
+                train_op = get_optimizer(loss, model_params.compress_learning_rate)
+                prepare_save_path(save_path, 'overwrite')
+                manager = CheckpointManager(save_path)
+                with tf.Session() as sess:
+                    sess.run(tf.global_variables_initializer())
+                    train_nn(sess, manager, loss, train_op, iterator, features_ph, labels_ph, train_fea, train_label, model_params.compress_finetune_epochs,
+                             log_every=model_params.log_every)
+            test_true_words, test_pred_words = get_prediction(wv_model, nn_model, test_sentences, test_stars, input_ph, save_path, batch_size=model_params.predict_batch_size)
+        results[name] = (cosine_loss(test_true_words, test_pred_words), get_accuracy(wv_model, test_true_words, test_pred_words, 10))
+
+    print('---------------- Compression Report ----------------')
+    for name in ['original', 'compressed']:
+        print('{}: cosine loss = {}, top-10 accuracy = {}'.format(name, *results[name]))
+
+if __name__ == '__main__':
+    main()
@@ -10,6 +10,21 @@ class model2_params:
         self.epoches = 3
         self.learning_rate = 0.001
         self.is_shuffle = True
+
+        self.batch_size = 32
+        self.shuffle_buffer = 100000
+        self.prefetch = 2
+        # fetch the loss and summary every log_every batches
+        self.log_every = 1000
+        self.predict_batch_size = 1024
+        # what to do with an existing run in the folder of tf_save_path: 'resume', 'overwrite' or 'fail'
+        self.save_policy = 'resume'
+        # a checkpoint every checkpoint_every batches as well as after every epoch, 0 for after epochs only
+        self.checkpoint_every = 1000
+        # the last fraction of the training reviews is held out to stop early once its loss stops improving by min_delta for patience epochs
+        self.validation_fraction = 0.1
+        self.patience = 2
+        self.min_delta = 0.0
         
         self.train_size = 10000
         self.train_start = 0
@@ -20,4 +35,13 @@ class model2_params:
         self.test_end = self.test_start + self.test_size
         
         self.tf_save_path = './model2_train_{}_test_{}/m.cpkt'.format(self.train_size, self.test_size)
+        # weights exported by model2_numpy.py, served without TensorFlow if the file exists
+        self.npz_path = './model2_train_{}_test_{}/m.npz'.format(self.train_size, self.test_size)
+
+        # post-training compression, see model2_compress.py
+        self.compress_rank_ratio = 0.25
+        self.compress_sparsity = 0.5
+        self.compress_finetune_epochs = 1
+        self.compress_learning_rate = 0.0001
+        self.compressed_save_path = './model2_train_{}_test_{}_compressed/m.cpkt'.format(self.train_size, self.test_size)
         
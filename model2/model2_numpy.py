@@ -0,0 +1,108 @@
+# model2_numpy.py
+
+'''
+A NumPy runtime for model 2, so serving does not need TensorFlow.
+export_npz dumps the weights of the dense layers of build_nn from a checkpoint into one .npz file,
+and NumpyMLP runs the forward pass on batches of inputs with preallocated buffers.
+Only the checkpoint reading imports TensorFlow.
+'''
+
+import re, sys, os
+import numpy as np
+from model2_config import model2_params
+
+DENSE_KERNEL = re.compile(r'^dense(_(\d+))?/kernel$')
+
+
+def load_dense_weights(save_path):
+    '''
+    Read the kernels and biases of the dense layers of a model 2 checkpoint, in the order build_nn creates them.
+    '''
+    import tensorflow as tf
+    reader = tf.train.load_checkpoint(save_path)
+    layers = []
+    for name, shape in tf.train.list_variables(save_path):
+        match = DENSE_KERNEL.match(name)
+        if match:
+            # tf.layers names the layers dense, dense_1, dense_2, ...
+            layers.append((int(match.group(2) or 0), name[:-len('/kernel')]))
+    layers.sort()
+    kernels = [reader.get_tensor(scope + '/kernel') for _, scope in layers]
+    biases = [reader.get_tensor(scope + '/bias') for _, scope in layers]
+    return kernels, biases
+
+
+def export_npz(save_path, npz_path, dtype=np.float32):
+    '''
+    Export the dense layers of a model 2 checkpoint.
+    Input:
+        save_path: the checkpoint path, as given to saver.save
+        npz_path: the file to write
+        dtype: the dtype the weights are stored in, np.float16 halves the file and the serving memory
+    '''
+    kernels, biases = load_dense_weights(save_path)
+    weights = {}
+    for i in range(len(kernels)):
+        weights['kernel_{}'.format(i)] = kernels[i].astype(dtype)
+        weights['bias_{}'.format(i)] = biases[i].astype(dtype)
+    np.savez(npz_path, **weights)
+    print('exported {} dense layers to {}'.format(len(kernels), npz_path))
+
+
+class NumpyMLP(object):
+    '''
+    The forward pass of build_nn: ReLU after every layer but the last.
+    '''
+    def __init__(self, kernels, biases, dtype=np.float32):
+        self.dtype = dtype
+        self.kernels = [np.ascontiguousarray(kernel, dtype=dtype) for kernel in kernels]
+        self.biases = [np.asarray(bias, dtype=dtype) for bias in biases]
+        self.input_size = self.kernels[0].shape[0]
+        self.output_size = self.kernels[-1].shape[1]
+        self._buffers = {}
+
+    @classmethod
+    def load(cls, npz_path, dtype=np.float32):
+        '''
+        Load exported weights. The file may hold float16 weights; dtype is what they are computed in.
+        '''
+        with np.load(npz_path) as f:
+            num_layers = len([key for key in f.files if key.startswith('kernel_')])
+            kernels = [f['kernel_{}'.format(i)] for i in range(num_layers)]
+            biases = [f['bias_{}'.format(i)] for i in range(num_layers)]
+        return cls(kernels, biases, dtype)
+
+    def _get_buffers(self, batch_size):
+        # one output buffer per layer, reused by every batch of this size
+        if batch_size not in self._buffers:
+            self._buffers[batch_size] = [np.empty((batch_size, kernel.shape[1]), dtype=self.dtype) for kernel in self.kernels]
+        return self._buffers[batch_size]
+
+    def forward(self, inputs):
+        '''
+        Input:
+            inputs: array of shape (batch, vector_size+1), as made by prepare_input_for_nn
+        Output:
+            the predicted word vectors, of shape (batch, vector_size)
+        '''
+        x = np.ascontiguousarray(inputs, dtype=self.dtype)
+        buffers = self._get_buffers(x.shape[0])
+        last = len(self.kernels) - 1
+        for i in range(len(self.kernels)):
+            out = buffers[i]
+            np.dot(x, self.kernels[i], out=out)
+            out += self.biases[i]
+            if i != last:
+                np.maximum(out, 0, out=out)
+            x = out
+        return x.copy()
+
+    __call__ = forward
+
+
+def main():
+    model_params = model2_params()
+    export_npz(model_params.tf_save_path, model_params.npz_path)
+
+if __name__ == '__main__':
+    main()
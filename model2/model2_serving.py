@@ -0,0 +1,129 @@
+# model2_serving.py
+
+'''
+Interactive serving for model 2.
+The input of model 2 is the weighted average of the embeddings of the previous words,
+so instead of recomputing it from the whole sentence on every input (as deprecated/demo_rev.py does)
+a session keeps the running weighted sum and total weight and updates them when a word is committed.
+Each committed word costs one O(vector_size) update and one forward pass of the network on a single vector;
+keystrokes inside a word only filter the cached prediction by the typed prefix.
+'''
+
+import sys, os
+import numpy as np
+import gensim.models.keyedvectors as word2vec
+from model2_config import model2_params
+from model2_numpy import NumpyMLP
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from dict_filter import pred_dict_filter
+from system_config import system_params
+from ann_index import use_ann_index
+
+os.environ["TF_CPP_MIN_LOG_LEVEL"]="3"
+
+
+class Model2Session(object):
+    '''
+    The state of one review being typed.
+    Word i (counting from 0) gets weight i+1, the same as prepare_input_for_nn with reverse=False.
+    '''
+    def __init__(self, wv_model, predict_fn, star):
+        '''
+        Input:
+            wv_model: the word2vec model precalculated
+            predict_fn: maps a float32 array of inputs (batch, vector_size+1) to predicted word vectors
+            star: the star rating of the review
+        '''
+        self.wv_model = wv_model
+        self.predict_fn = predict_fn
+        self.star = star
+        self.weighted_sum = np.zeros(wv_model.vector_size)
+        self.total_weight = 0
+        self.num_words = 0
+        self._pred_word_vec = None
+
+    def commit(self, word):
+        '''
+        Add a finished word to the context.
+        '''
+        self.num_words += 1
+        if word in self.wv_model.wv.vocab:
+            self.weighted_sum += self.wv_model[word] * self.num_words
+        self.total_weight += self.num_words
+        self._pred_word_vec = None
+
+    def get_input(self):
+        cur_input = np.empty((1, self.wv_model.vector_size + 1), dtype=np.float32)
+        cur_input[0, :-1] = self.weighted_sum / self.total_weight
+        cur_input[0, -1] = self.star
+        return cur_input
+
+    def predict_vector(self):
+        '''
+        The predicted vector of the next word, computed once per committed word.
+        '''
+        if self._pred_word_vec is None:
+            self._pred_word_vec = self.predict_fn(self.get_input())[0]
+        return self._pred_word_vec
+
+    def predict(self, inputs='', topn=2, cons=200):
+        '''
+        Predict the word being typed, given the characters typed so far.
+        Output:
+            The predicted words as a list, empty before the first word is committed.
+        '''
+        if self.num_words == 0:
+            return []
+        return pred_dict_filter(self.wv_model, inputs, self.predict_vector(), topn=topn, cons=cons)
+
+
+def get_tf_predict_fn(sess, save_path):
+    '''
+    Restore a model 2 checkpoint into sess and return a predict_fn running it.
+    '''
+    import tensorflow as tf
+    saver = tf.train.import_meta_graph(save_path + '.meta')
+    saver.restore(sess, save_path)
+    graph = tf.get_default_graph()
+    input_ph = graph.get_tensor_by_name('train_input:0')
+    nn_model = graph.get_tensor_by_name('prediction:0')
+    return lambda inputs: sess.run(nn_model, feed_dict={input_ph: inputs})
+
+
+def serve(wv_model, predict_fn):
+    while True:
+        rate = input("Please give a rating in the scale of 5:\n")
+        rate = int(rate)
+        assert(rate >= 1 and rate <= 5)
+        session = Model2Session(wv_model, predict_fn, rate)
+        print("Please type the review, an empty line starts a new one")
+        while True:
+            # every line continues the review, the last word is still being typed unless followed by a space
+            line = input().lower()
+            if line == '':
+                break
+            words = line.split()
+            inputs = ''
+            if not line.endswith(' ') and len(words) > 0:
+                inputs = words.pop()
+            for word in words:
+                session.commit(word)
+            print(session.predict(inputs))
+
+
+def main():
+    sys_params = system_params()
+    model_params = model2_params()
+    wv_model = word2vec.KeyedVectors.load_word2vec_format('glove.6B.100d.txt', binary=False)
+    if os.path.isfile(sys_params.ann_index_path):
+        use_ann_index(wv_model, sys_params.ann_index_path, sys_params.ann_nprobe, sys_params.ann_rerank)
+
+    if os.path.isfile(model_params.npz_path):
+        serve(wv_model, NumpyMLP.load(model_params.npz_path))
+    else:
+        import tensorflow as tf
+        with tf.Session() as sess:
+            serve(wv_model, get_tf_predict_fn(sess, model_params.tf_save_path))
+
+if __name__ == '__main__':
+    main()
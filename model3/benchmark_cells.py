@@ -0,0 +1,79 @@
+# benchmark_cells.py
+
+'''
+Benchmark the training steps per second of model 3 for every cell type, platform and thread count.
+The graph is the one model3.py trains (build_nn with in-graph embedding lookup) on random token ids,
+so no data or word embedding has to be loaded.
+Usage:
+    python model3/benchmark_cells.py [thread counts ...]
+'''
+
+import sys, os, time
+import numpy as np
+import tensorflow as tf
+from model3_config import model3_params
+from model3 import build_nn, get_loss, get_optimizer, get_session_config, select_platform
+
+os.environ["TF_CPP_MIN_LOG_LEVEL"]="3"
+
+VOCAB_SIZE = 10000
+EMBEDDING_SIZE = 100
+
+
+def benchmark(cell_type, platform, threads, model_params, num_steps=20, num_warmup=3):
+    '''
+    Output:
+        the number of training steps per second
+    '''
+    n_steps, batch_size = model_params.num_steps, model_params.batch_size
+    with tf.Graph().as_default():
+        input_ph = tf.placeholder(tf.int32, [None, n_steps], name='train_input')
+        stars_ph = tf.placeholder(tf.float32, [None], name='train_star_input')
+        word_ph = tf.placeholder(tf.int32, [None], name='train_label')
+        training = tf.placeholder(tf.bool)
+        seq_length_ph = tf.placeholder(tf.int32, [None])
+        embedding = tf.constant(np.random.randn(VOCAB_SIZE, EMBEDDING_SIZE).astype(np.float32))
+
+        nn_model = build_nn(model_params.num_layers, platform, cell_type, training, stars_ph, input_ph, n_steps, EMBEDDING_SIZE,
+                            model_params.num_neurons, seq_length_ph, out_size=EMBEDDING_SIZE, bidirection=model_params.if_bidirect, embedding=embedding)
+        loss = get_loss(nn_model, tf.nn.embedding_lookup(embedding, word_ph))
+        train_op = get_optimizer(loss)
+
+        feed_dict = {
+            training: True,
+            input_ph: np.random.randint(0, VOCAB_SIZE, (batch_size, n_steps)),
+            stars_ph: np.random.randint(1, 6, batch_size),
+            word_ph: np.random.randint(0, VOCAB_SIZE, batch_size),
+            seq_length_ph: np.full(batch_size, n_steps),
+        }
+        with tf.Session(config=get_session_config(threads, threads)) as sess:
+            sess.run(tf.global_variables_initializer())
+            for _ in range(num_warmup):
+                sess.run(train_op, feed_dict=feed_dict)
+            start = time.time()
+            for _ in range(num_steps):
+                sess.run(train_op, feed_dict=feed_dict)
+            return num_steps / (time.time() - start)
+
+
+def main():
+    model_params = model3_params()
+    if len(sys.argv) > 1:
+        thread_counts = [int(arg) for arg in sys.argv[1:]]
+    else:
+        thread_counts = sorted(set([1, 2, 4, os.cpu_count()]))
+    platforms = ['cpu', 'cpu_block']
+    if select_platform('auto') == 'gpu':
+        platforms.append('gpu')
+
+    print('{} layers, {} neurons, bidirectional {}, batch size {}, {} steps'.format(
+        model_params.num_layers, model_params.num_neurons, model_params.if_bidirect, model_params.batch_size, model_params.num_steps))
+    print('{:<6}{:<12}{:<10}{}'.format('cell', 'platform', 'threads', 'steps/sec'))
+    for cell_type in ['lstm', 'gru']:
+        for platform in platforms:
+            for threads in thread_counts:
+                steps_per_sec = benchmark(cell_type, platform, threads, model_params)
+                print('{:<6}{:<12}{:<10}{:.2f}'.format(cell_type, platform, threads, steps_per_sec))
+
+if __name__ == '__main__':
+    main()
@@ -8,69 +8,173 @@ from gensim.models import Word2Vec
 import gensim.models.keyedvectors as word2vec
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 from dict_filter import get_esaved
-from prep_data import get_review_data, get_word_embedding
-
-SAVE_PATH = './model/m.cpkt'
+from word_decoder import get_decoder, get_topk_accuracy
+from prep_data import get_review_data, get_word_embedding, get_word_ids, get_embedding_matrix
+from system_config import system_params
+from model3_config import model3_params
+from model3_vocab import get_head_vocab, VocabDecoder, get_vocab_accuracy, get_vocab_esaved
+from train_utils import prepare_save_path, split_validation, CheckpointManager, get_validation_loss, train_epochs, skip_batches
 
 class DataSet(object):
     '''
     This is an object that is holding the data and generate batches.
+    Only the id-encoded reviews, the (position, seq_length) of every sample and the embedding matrix are stored;
+    the padded and possibly reversed windows are gathered for the current batch only,
+    so memory scales with the number of tokens rather than tokens x n_steps.
+    Batches hold token ids, the graph looks the embeddings up itself (see get_embedding_variable).
+    With bucket_width > 0 every batch only holds samples whose seq_length falls in the same bucket
+    and its windows are trimmed to the longest of them, so short contexts do not pay for n_steps timesteps.
     '''
     def __init__(self,
-                 data,
-                 label,
+                 tokens,
+                 positions,
                  seq_length,
                  stars,
-                 training=True):
-        self.data = data
-        self.label = label
+                 embedding,
+                 n_steps,
+                 reverse=True,
+                 training=True,
+                 bucket_width=0):
+        '''
+        Input:
+            tokens: int32 array of all reviews concatenated, words not in the vocabulary mapped to the last (zero) row of embedding
+            positions: index into tokens of the true word of every sample
+            seq_length: the number of previous words in the window of every sample
+            stars: the stars of the review of every sample
+            embedding: the embedding matrix, its last row is zeros and used for padding
+        '''
+        self.tokens = tokens
+        self.positions = positions
         self.seq_length = seq_length
-        self.training = training
         self.stars = stars
+        self.embedding = embedding
+        self.n_steps = n_steps
+        self.reverse = reverse
+        self.pad_id = embedding.shape[0] - 1
+        self.training = training
+        self.bucket_width = bucket_width
         self._epochs_completed = 0
         self._index_in_epoch = 0
-        self._num_data = data.shape[0]
+        self._num_data = positions.shape[0]
         self._curr_order = np.arange(self._num_data)
+        self._batch_plan = None
+
+    def get_window_ids(self, index, num_steps=None):
+        '''
+        The token ids of the windows of the samples in index, shape (len(index), num_steps), num_steps defaults to n_steps.
+        Padding goes before the window, so if reversed the most recent word comes first and the padding last.
+        '''
+        if num_steps is None:
+            num_steps = self.n_steps
+        positions = self.positions[index]
+        seq_length = self.seq_length[index]
+        offsets = np.arange(num_steps)
+        if self.reverse:
+            token_index = positions[:, None] - 1 - offsets
+            valid = offsets < seq_length[:, None]
+        else:
+            token_index = positions[:, None] - num_steps + offsets
+            valid = offsets >= num_steps - seq_length[:, None]
+        return np.where(valid, self.tokens[np.where(valid, token_index, 0)], self.pad_id)
+
+    def get_batch(self, index):
+        '''
+        Output:
+            X_batch: the window ids, shape (len(index), n_steps), or the longest seq_length in the batch if bucketed
+            y_batch: the ids of the true words
+            seq_length_batch, stars_batch
+        '''
+        num_steps = None
+        if self.bucket_width > 0 and len(index) > 0:
+            num_steps = int(self.seq_length[index].max())
+        X_batch = self.get_window_ids(index, num_steps)
+        y_batch = self.tokens[self.positions[index]]
+        return X_batch, y_batch, self.seq_length[index], self.stars[index]
+
+    def get_bucketed_batches(self, batch_size, shuffle=True):
+        '''
+        Split the samples into batches that each hold one bucket of seq_length.
+        With shuffle, the samples are shuffled within buckets and the batches across buckets.
+        Output:
+            a list of index arrays, one per batch
+        '''
+        order = np.random.permutation(self._num_data) if shuffle else np.arange(self._num_data)
+        buckets = self.seq_length // self.bucket_width
+        # a stable sort keeps the shuffled order within every bucket
+        order = order[np.argsort(buckets[order], kind='stable')]
+        splits = np.nonzero(np.diff(buckets[order]))[0] + 1
+        batches = []
+        for group in np.split(order, splits):
+            batches += [group[i:i + batch_size] for i in range(0, len(group), batch_size)]
+        if shuffle:
+            batches = [batches[i] for i in np.random.permutation(len(batches))]
+        return batches
 
     def next_batch(self, batch_size, shuffle=True):
         start = self._index_in_epoch
-        #print(self.training)
         if self.training == False:
-            return self.data, self.label, self.seq_length, self.stars
+            return self.get_batch(np.arange(self._num_data))
+        if self.bucket_width > 0:
+            if not self._batch_plan:
+                if self._batch_plan is not None:
+                    self._epochs_completed += 1
+                self._batch_plan = self.get_bucketed_batches(batch_size, shuffle)
+            return self.get_batch(self._batch_plan.pop())
         if start == 0 and self._epochs_completed == 0 and shuffle:
             np.random.shuffle(self._curr_order)
         if start + batch_size > self._num_data:
             self._epochs_completed += 1
             num_feeded = self._num_data - start
             num_rest = batch_size - num_feeded
-            X_batch_feeded = self.data[self._curr_order[self._index_in_epoch:]]
-            y_batch_feeded = self.label[self._curr_order[self._index_in_epoch:]]
-            seq_length_feeded = self.seq_length[self._curr_order[self._index_in_epoch:]]
-            stars_feeded = self.stars[self._curr_order[self._index_in_epoch:]]
-
+            index_feeded = self._curr_order[start:]
             if shuffle:
                 np.random.shuffle(self._curr_order)
-
-            X_batch_rest = self.data[self._curr_order[:num_rest]]
-            y_batch_rest = self.label[self._curr_order[:num_rest]]
-            seq_length_rest = self.seq_length[self._curr_order[:num_rest]]
-            stars_rest = self.seq_length[self._curr_order[:num_rest]]
+            index = np.concatenate((index_feeded, self._curr_order[:num_rest]), axis=0)
             self._index_in_epoch = num_rest
-            X_batch = np.concatenate((X_batch_feeded, X_batch_rest), axis=0)
-            y_batch = np.concatenate((y_batch_feeded, y_batch_rest), axis=0)
-            seq_length_batch = np.concatenate((seq_length_feeded, seq_length_rest), axis=0)
-            stars_batch = np.concatenate((stars_feeded, stars_rest), axis=0)
         else:
-            X_batch = self.data[self._curr_order[self._index_in_epoch:self._index_in_epoch + batch_size]]
-            y_batch = self.label[self._curr_order[self._index_in_epoch:self._index_in_epoch + batch_size]]
-            seq_length_batch = self.seq_length[self._curr_order[self._index_in_epoch:self._index_in_epoch + batch_size]]
-            stars_batch = self.stars[self._curr_order[self._index_in_epoch:self._index_in_epoch + batch_size]]
+            index = self._curr_order[start:start + batch_size]
             self._index_in_epoch += batch_size
-        return X_batch, y_batch, seq_length_batch, stars_batch
+        return self.get_batch(index)
+
+    def iter_batches(self, batch_size):
+        '''
+        Go through the samples once, batch_size at a time, in order unless bucketed.
+        Output:
+            the index of the samples and the batch, for every batch
+        '''
+        if self.bucket_width > 0:
+            batches = self.get_bucketed_batches(batch_size, shuffle=False)
+        else:
+            batches = [np.arange(start, min(start + batch_size, self._num_data)) for start in range(0, self._num_data, batch_size)]
+        for index in batches:
+            yield index, self.get_batch(index)
+
+
+_gpu_available = None
+
+def select_platform(platform):
+    '''
+    Resolve platform 'auto' to 'gpu' if TensorFlow sees a GPU and to 'cpu_block' otherwise.
+    '''
+    global _gpu_available
+    if platform != 'auto':
+        return platform
+    if _gpu_available is None:
+        _gpu_available = tf.test.is_gpu_available(cuda_only=True)
+    return 'gpu' if _gpu_available else 'cpu_block'
+
+
+def get_session_config(intra_op_threads=0, inter_op_threads=0):
+    '''
+    Session config with the given thread pool sizes, 0 leaves the choice to TensorFlow.
+    '''
+    return tf.ConfigProto(intra_op_parallelism_threads=intra_op_threads, inter_op_parallelism_threads=inter_op_threads)
 
 
 def get_rnn_cell(att, typ, platform, **kwargs):
     # get an rnn cell with the specified type on specific platform
+    # 'cpu_block' uses the fused block kernels, which keep the variable names of LSTMCell and GRUCell
+    platform = select_platform(platform)
 
     if typ == 'rnn':
         cell= tf.nn.rnn_cell.BasicRNNCell(**kwargs)
@@ -78,12 +182,16 @@ def get_rnn_cell(att, typ, platform, **kwargs):
         #return tf.contrib.cudnn_rnn.CudnnRNNTanhSaveable(**kwargs)
     elif typ == 'lstm' and platform == 'cpu':
         cell= tf.nn.rnn_cell.LSTMCell(**kwargs)
+    elif typ == 'lstm' and platform == 'cpu_block':
+        cell= tf.contrib.rnn.LSTMBlockCell(**kwargs)
     elif typ == 'lstm' and platform == 'gpu':
         cell= tf.contrib.cudnn_rnn.CudnnCompatibleLSTMCell(**kwargs)
     #elif typ == 'lstmbn' and (platform == 'cpu' or platform == 'gpu'):
         #return tf.contrib.rnn.LayerNormBasicLSTMCell(**kwargs)
     elif typ == 'gru' and platform == 'cpu':
         cell= tf.nn.rnn_cell.GRUCell(**kwargs)
+    elif typ == 'gru' and platform == 'cpu_block':
+        cell= tf.contrib.rnn.GRUBlockCellV2(**kwargs)
     elif typ == 'gru' and platform == 'gpu':
         cell= tf.contrib.cudnn_rnn.CudnnCompatibleGRUCell(**kwargs)
     else:
@@ -96,57 +204,92 @@ def get_rnn_cell(att, typ, platform, **kwargs):
     return cell
 
 
-def prepare_input_for_nn(model, sentences, n_steps, stars, reverse=True, training=True):
+def prepare_input_for_nn(model, sentences, n_steps, stars, reverse=True, training=True, embedding=None, bucket_width=0):
     '''
     Prepare the input for the seq2seq model, with the pre-defined length and order.
     It is being said that reversed model leads to a better performance.
     n_steps = number of words we are going to feed into the network for the prediction of next.
+    Every word in the vocabulary from the 6th word on is a sample, its window is the up to n_steps words before it.
+    embedding: the matrix from get_embedding_matrix, pass it to share one copy between datasets
+    bucket_width: batch samples by seq_length buckets of this width, 0 to not bucket
     '''
-    # list of numpy array (each is a embedding representing the previous sequence)
-    inputs = []
-    # list of vector (true word representing by vector)
-    true_words = []
-    # list of seq_lengths (the length of each sequence)
+    if embedding is None:
+        embedding = get_embedding_matrix(model)
+    pad_id = embedding.shape[0] - 1
+    tokens = []
+    positions = []
     seq_lengths = []
-    # list of stars (the stars of each review)
     stars_list = []
 
+    offset = 0
     for k in range(len(sentences)):
-        sentence = sentences[k]
-        star = stars[k]
-        sentence_embedding = []
+        ids = get_word_ids(model, sentences[k])
         # get rid of reviews with smaller than 5 words
-        if len(sentence) < 5:
+        if len(ids) < 5:
             continue
-        for i in range(len(sentence)):
-            if sentence[i] in model.wv.vocab:
-                sentence_embedding.append(model[sentence[i]])
-            else:
-                sentence_embedding.append(np.zeros(model.vector_size, dtype=np.float32))
-        sentence_embedding = np.array(sentence_embedding)
-        # begin prepare input and label
-        for i in range(5, len(sentence)):
-            seq_begin = np.max([0, i-n_steps])
-            seq_length = np.min([i, n_steps])
-            cur_input = sentence_embedding[seq_begin:i]
-            cur_label = sentence[i]
-            if seq_length < n_steps:
-                pad_num = n_steps - seq_length
-                pad = np.zeros((pad_num, model.vector_size))
-                cur_input = np.concatenate((pad, cur_input), axis=0) 
-            if reverse:
-                cur_input = np.flip(cur_input,0)
-            if cur_label in model.wv.vocab:
-                inputs.append(cur_input)
-                true_words.append(model[cur_label])
-                seq_lengths.append(seq_length)
-                stars_list.append(star)
-    inputs, true_words, seq_lengths = np.array(inputs, dtype=np.float32), np.array(true_words), np.array(seq_lengths)
-    stars_list = np.array(stars_list, dtype=np.int)
-    return DataSet(inputs, true_words, seq_lengths, stars_list)
-
-
-def build_nn(n_layers, xpu, cell_type, training, stars, input_ph, n_steps, n_inputs, n_neurons, seq_length_ph, out_size=100, keep_prob=0.5, bidirection=False, attention=False, mode=""):
+        known = ids >= 0
+        ids[~known] = pad_id
+        targets = np.nonzero(known[5:])[0] + 5
+        tokens.append(ids)
+        positions.append(targets + offset)
+        seq_lengths.append(np.minimum(targets, n_steps))
+        stars_list.append(np.full(len(targets), stars[k]))
+        offset += len(ids)
+
+    tokens = np.concatenate(tokens).astype(np.int32) if tokens else np.zeros(0, dtype=np.int32)
+    positions = np.concatenate(positions) if positions else np.zeros(0, dtype=np.int64)
+    seq_lengths = np.concatenate(seq_lengths).astype(np.int32) if seq_lengths else np.zeros(0, dtype=np.int32)
+    stars_list = np.concatenate(stars_list).astype(np.float32) if stars_list else np.zeros(0, dtype=np.float32)
+    return DataSet(tokens, positions, seq_lengths, stars_list, embedding, n_steps, reverse, training, bucket_width)
+
+
+def get_embedding_variable(embedding_shape):
+    '''
+    A frozen embedding matrix kept in the graph, so batches only carry token ids.
+    It is loaded through a placeholder when the variables are initialized, to keep it out of the graph definition,
+    and saved with the checkpoint, so a restored model serves from token ids as well.
+    Output:
+        embedding_ph: feed the matrix to it when running the initializer
+        embedding_var: the variable to look up
+    '''
+    embedding_ph = tf.placeholder(tf.float32, embedding_shape)
+    embedding_var = tf.Variable(embedding_ph, trainable=False, name='embedding')
+    return embedding_ph, embedding_var
+
+
+def attention_head(query, memory, seq_length_ph):
+    '''
+    Scaled dot-product attention of the final state over all outputs of the encoder, computed after the recurrent loop
+    for every timestep at once, instead of inside it like AttentionCellWrapper.
+    Input:
+        query: the final state, shape (batch, n_neurons)
+        memory: the outputs of the encoder, shape (batch, steps, n_neurons)
+        seq_length_ph: steps from seq_length on are padding and get no weight
+    Output:
+        the attention-weighted sum of memory, shape (batch, n_neurons)
+    '''
+    with tf.name_scope('attention'):
+        scale = 1.0 / np.sqrt(memory.get_shape().as_list()[-1])
+        # (batch, steps, n) x (batch, n, 1) -> (batch, steps, 1)
+        scores = tf.matmul(memory, query[:, :, None]) * scale
+        mask = tf.sequence_mask(seq_length_ph, tf.shape(memory)[1])[:, :, None]
+        scores = tf.where(mask, scores, tf.fill(tf.shape(scores), -1e9))
+        weights = tf.nn.softmax(scores, axis=1)
+        # (batch, 1, steps) x (batch, steps, n) -> (batch, 1, n)
+        context = tf.matmul(weights, memory, transpose_a=True)
+        return context[:, 0]
+
+
+def build_nn(n_layers, xpu, cell_type, training, stars, input_ph, n_steps, n_inputs, n_neurons, seq_length_ph, out_size=100, keep_prob=0.5, bidirection=False, attention=False, mode="", embedding=None):
+    '''
+    attention: True wraps every cell in AttentionCellWrapper,
+    'batched' concatenates the final state with attention_head over the outputs of the last layer instead
+    '''
+    if embedding is not None:
+        # input_ph holds token ids
+        input_ph = tf.nn.embedding_lookup(embedding, input_ph)
+    batched_attention = attention == 'batched'
+    attention = attention is True
     if mode == "big_fc":
         stacked_cells = [get_rnn_cell(att=attention,typ=cell_type, platform=xpu, num_units = n_neurons) for _ in range(n_layers)]
         cell =tf.contrib.rnn.MultiRNNCell(stacked_cells)
@@ -170,6 +313,7 @@ def build_nn(n_layers, xpu, cell_type, training, stars, input_ph, n_steps, n_inp
             #print("forward")
             outputs, state = tf.nn.dynamic_rnn(cell, input_ph, dtype=tf.float32, sequence_length=seq_length_ph)
             #print(outputs, state)
+            memory = outputs
         else:
             #print("bidirection")
             if n_layers ==1:
@@ -187,6 +331,8 @@ def build_nn(n_layers, xpu, cell_type, training, stars, input_ph, n_steps, n_inp
             state = state_fb[-1]
             #first time
             #state = state_fb[0]
+            # attend over the outputs of the direction the state comes from
+            memory = outputs_fb[-1]
         
         if n_layers !=1:
             #print('\nALL :',state)
@@ -196,6 +342,8 @@ def build_nn(n_layers, xpu, cell_type, training, stars, input_ph, n_steps, n_inp
             #print("LSTM :", state)
             state = state[-1]
             #print('\nLSTM last state :', state)
+        if batched_attention:
+            state = tf.concat((state, attention_head(state, memory, seq_length_ph)), 1)
         
     
     #reshape stars from ? to ?,1
@@ -208,129 +356,275 @@ def build_nn(n_layers, xpu, cell_type, training, stars, input_ph, n_steps, n_inp
     return output
 
 
+def build_params_nn(model_params, training, stars, input_ph, seq_length_ph, embedding_shape, embedding):
+    '''
+    build_nn with the architecture fields of model_params, so every script that trains, restores or evaluates
+    the checkpoint at model_params.tf_save_path builds the same network.
+    '''
+    return build_nn(model_params.num_layers, model_params.cpu_or_gpu, model_params.cell_type, training, stars, input_ph, model_params.num_steps,
+                    embedding_shape[1], model_params.num_neurons, seq_length_ph, out_size=embedding_shape[1], bidirection=model_params.if_bidirect,
+                    attention=model_params.attention, mode=model_params.mode, embedding=embedding)
+
+
 def get_loss(pred_word, true_word):
     # consine distance
     loss = tf.losses.cosine_distance(tf.nn.l2_normalize(pred_word, 0), tf.nn.l2_normalize(true_word, 0), dim=0)
     return loss
 
 
+def build_vocab_head(pred_word, head_ids, embedding_ph):
+    '''
+    The vocabulary head on top of the predicted vector of build_nn, decoded by model3_vocab.py.
+    The weights of every head word start from its embedding, so the initial logits rank the words by dot product.
+    Input:
+        pred_word: the output of build_nn
+        head_ids: the embedding ids of the head words, from get_head_vocab
+        embedding_ph: the placeholder of get_embedding_variable, fed when the variables are initialized
+    Output:
+        weights, biases: one row per head word
+        logits: shape (batch, len(head_ids))
+    '''
+    with tf.variable_scope('vocab_head'):
+        # saved with the checkpoint so the decoder knows the words of the rows
+        tf.Variable(head_ids, trainable=False, name='ids')
+        weights = tf.Variable(tf.gather(embedding_ph, head_ids), name='weights')
+        biases = tf.Variable(tf.zeros([len(head_ids)]), name='biases')
+    logits = tf.matmul(pred_word, weights, transpose_b=True) + biases
+    return weights, biases, logits
+
+
+def get_vocab_loss(weights, biases, pred_word, word_ph, head_ids, num_sampled=1000):
+    '''
+    Sampled softmax loss of the vocabulary head, averaged over the windows whose true word is in the head.
+    The head is ordered by the words, not by frequency as the default log-uniform sampler assumes,
+    so the negatives are drawn by a Zipf law over the frequency rank (the embedding id) of the words.
+    '''
+    # the head position of every embedding id up to the last head id, -1 for the ones after
+    positions = np.full(len(head_ids) + 1, -1, dtype=np.int32)
+    positions[head_ids] = np.arange(len(head_ids))
+    labels = tf.gather(positions, tf.minimum(word_ph, len(head_ids)))
+    inside = labels >= 0
+    labels = tf.cast(tf.boolean_mask(labels, inside), tf.int64)[:, None]
+    sampled_values = tf.nn.fixed_unigram_candidate_sampler(
+        true_classes=labels,
+        num_true=1,
+        num_sampled=num_sampled,
+        unique=True,
+        range_max=len(head_ids),
+        unigrams=list(1.0 / (head_ids + 1.0)))
+    losses = tf.nn.sampled_softmax_loss(weights, biases, labels, tf.boolean_mask(pred_word, inside), num_sampled, len(head_ids), sampled_values=sampled_values)
+    return tf.reduce_sum(losses) / tf.maximum(tf.reduce_sum(tf.cast(inside, tf.float32)), 1.0)
+
+
 def get_optimizer(loss, lr=0.001):
     # return a tf operation
     return tf.train.AdamOptimizer(learning_rate=lr, beta1=0.9, beta2=0.99).minimize(loss)
 
 
-def train_nn(seq_length_ph,n_steps, n_inputs, training, model, sess, saver,stars_ph, input_ph, word_ph, loss, train_op, dataset, batch_size, num_epoch):
-    print("begin training")
+def get_input_pipeline(dataset, batch_size, shuffle_buffer=100000, prefetch=2, num_parallel_calls=4):
+    '''
+    Build a tf.data pipeline over the samples of dataset that shuffles, batches, gathers the windows and prefetches,
+    so batches are prepared by TensorFlow threads while the previous step runs.
+    Only the per-sample (position, seq_length, star) are sliced; the windows are gathered per batch in the graph
+    from the token array, the same way as DataSet.get_window_ids, and trimmed to the longest seq_length if bucketed.
+    The arrays are fed through placeholders when the iterator is initialized, so they are not stored in the graph.
+    Output:
+        iterator: an initializable iterator over one epoch of (window ids, true word ids, seq_length, stars) batches
+        feed_dict: the arrays to feed when running iterator.initializer
+    '''
+    n_steps, reverse, pad_id, bucket_width = dataset.n_steps, dataset.reverse, dataset.pad_id, dataset.bucket_width
+    tokens_ph = tf.placeholder(tf.int32, [None])
+    positions_ph = tf.placeholder(tf.int32, [None])
+    seq_length_ph = tf.placeholder(tf.int32, [None])
+    stars_ph = tf.placeholder(tf.float32, [None])
+
+    def gather_batch(positions, seq_length, stars):
+        num_steps = tf.reduce_max(seq_length) if bucket_width > 0 else n_steps
+        offsets = tf.range(num_steps)
+        if reverse:
+            token_index = positions[:, None] - 1 - offsets
+            valid = offsets < seq_length[:, None]
+        else:
+            token_index = positions[:, None] - num_steps + offsets
+            valid = offsets >= num_steps - seq_length[:, None]
+        window = tf.gather(tokens_ph, tf.where(valid, token_index, tf.zeros_like(token_index)))
+        window = tf.where(valid, window, tf.fill(tf.shape(window), pad_id))
+        return window, tf.gather(tokens_ph, positions), seq_length, stars
+
+    data = tf.data.Dataset.from_tensor_slices((positions_ph, seq_length_ph, stars_ph))
+    data = data.shuffle(shuffle_buffer)
+    if bucket_width > 0:
+        # every batch holds samples of one seq_length bucket
+        data = data.apply(tf.contrib.data.group_by_window(
+            key_func=lambda position, seq_length, star: tf.cast(seq_length // bucket_width, tf.int64),
+            reduce_func=lambda key, window: window.batch(batch_size),
+            window_size=batch_size))
+    else:
+        data = data.batch(batch_size)
+    data = data.map(gather_batch, num_parallel_calls=num_parallel_calls).prefetch(prefetch)
+    iterator = data.make_initializable_iterator()
+    feed_dict = {
+        tokens_ph: dataset.tokens,
+        positions_ph: dataset.positions.astype(np.int32),
+        seq_length_ph: dataset.seq_length,
+        stars_ph: dataset.stars,
+    }
+    return iterator, feed_dict
+
+
+def train_nn(sess, manager, training, loss, train_op, iterator, feed_dict, num_epoch, log_every=1000, checkpoint_every=0, validation_loss=None):
+    '''
+    Train for the epochs manager has not finished yet, with an iterator over one epoch of the pipeline.
+    manager: the CheckpointManager of the run, it saves the checkpoints and decides when to stop early
+    feed_dict: the arrays to feed when initializing the iterator
+    validation_loss: a function of the session returning the held-out loss
+    '''
+    # the graph reads its batches from the iterator, only training has to be fed
+    next_seq_length = iterator.get_next()[2]
+    def init_epoch(sess, skip):
+        sess.run(iterator.initializer, feed_dict=feed_dict)
+        skip_batches(sess, next_seq_length, skip)
+    train_epochs(sess, manager, loss, train_op, num_epoch, init_epoch, feed_dict={training: True}, log_every=log_every,
+                 checkpoint_every=checkpoint_every, validation_loss=validation_loss)
 
-    for r in range(num_epoch):
-        for i in range(dataset._num_data // batch_size + 1):
-            X_batch, y_batch, seq_length_batch, stars_batch = dataset.next_batch(batch_size)
-            #print(X_batch.shape)
-            X_batch = X_batch.reshape((-1, n_steps, n_inputs))
-            sess.run(train_op, feed_dict={training: True, stars_ph:stars_batch, input_ph: X_batch, word_ph: y_batch, seq_length_ph: seq_length_batch})
-            cur_loss = sess.run(loss, feed_dict={training: True, stars_ph:stars_batch,input_ph: X_batch, word_ph: y_batch, seq_length_ph: seq_length_batch})
-            if i%1000==0:
-                print("loss for batch {} is {}".format(i, cur_loss))
-        print("loss for epoch {} is {}".format(r, cur_loss))
-    saver.save(sess, SAVE_PATH)
 
+def get_validation_batches(dataset, training, stars_ph, input_ph, word_ph, seq_length_ph, batch_size=1024):
+    '''
+    The (feed_dict, batch size) pairs of get_validation_loss over the samples of dataset.
+    '''
+    for index, (X_batch, y_batch, seq_length_batch, stars_batch) in dataset.iter_batches(batch_size):
+        yield {training: False, stars_ph: stars_batch, input_ph: X_batch, word_ph: y_batch, seq_length_ph: seq_length_batch}, len(index)
 
-def get_prediction(seq_length_ph, training, model, nn_model, test_sentences, stars, stars_ph, input_ph, word_ph, n_steps,reverse=True):
-    print('begin predicting')
-    dataset = prepare_input_for_nn(model, test_sentences, n_steps, stars, reverse, training = False)
-    X_batch, y_batch, seq_length_batch = dataset.data, dataset.label, dataset.seq_length
-    test_stars = dataset.stars
-    test_inputs = X_batch
-    test_true_words = y_batch
-    print('test true word len = {}'.format(len(test_true_words)))
-    #test_inputs = np.reshape(np.array(test_inputs), (len(test_inputs), model.vector_size))
-    #test_true_words = np.reshape(np.array(test_true_words), (len(test_true_words), model.vector_size))
-    with tf.Session() as sess:
+
+def get_dataset_prediction(seq_length_ph, training, nn_model, dataset, stars_ph, input_ph, save_path, batch_size=1024, session_config=None):
+    '''
+    Predict every sample of dataset with the checkpoint at save_path, streaming fixed-size batches through one session.
+    Output:
+        the true and the predicted word vectors, shape (number of samples, embedding size)
+    '''
+    vector_size = dataset.embedding.shape[1]
+    test_true_words = np.empty((dataset._num_data, vector_size), dtype=np.float32)
+    test_pred_words = np.empty((dataset._num_data, vector_size), dtype=np.float32)
+    with tf.Session(config=session_config) as sess:
         saver = tf.train.Saver()
-        saver.restore(sess, SAVE_PATH)
-        test_pred_words = sess.run(nn_model, feed_dict={training: False, stars_ph:test_stars, input_ph: test_inputs, word_ph: test_true_words, seq_length_ph: seq_length_batch})
-    print('test pred word len = {}'.format(len(test_pred_words)))
+        saver.restore(sess, save_path)
+        for index, (X_batch, y_batch, seq_length_batch, stars_batch) in dataset.iter_batches(batch_size):
+            test_true_words[index] = dataset.embedding[y_batch]
+            test_pred_words[index] = sess.run(nn_model, feed_dict={training: False, stars_ph: stars_batch, input_ph: X_batch, seq_length_ph: seq_length_batch})
     return test_true_words, test_pred_words
 
 
-def get_accuracy(model, true_words, pred_words, topn=10):
-    print('begin getting accuracy')
-    correct = 0
-    for i in range(len(true_words)):
-
-        true_word_vec = true_words[i]
-        pred_word_vec = pred_words[i]
+def get_prediction(seq_length_ph, training, model, nn_model, test_sentences, stars, stars_ph, input_ph, n_steps, save_path, reverse=True, batch_size=1024, embedding=None, bucket_width=0, session_config=None, return_ids=False):
+    '''
+    Predict every window of the test reviews, streaming fixed-size batches through one session,
+    so memory does not grow with the size of the test set beyond the output arrays.
+    return_ids: also return the embedding ids of the true words
+    '''
+    print('begin predicting')
+    dataset = prepare_input_for_nn(model, test_sentences, n_steps, stars, reverse, training=False, embedding=embedding, bucket_width=bucket_width)
+    print('test true word len = {}'.format(dataset._num_data))
+    test_true_words, test_pred_words = get_dataset_prediction(seq_length_ph, training, nn_model, dataset, stars_ph, input_ph, save_path, batch_size, session_config)
+    print('test pred word len = {}'.format(len(test_pred_words)))
+    if return_ids:
+        return test_true_words, test_pred_words, dataset.tokens[dataset.positions]
+    return test_true_words, test_pred_words
 
-        temp1 = model.most_similar([true_word_vec], [], 1)
-        true_words_set = set([pair[0] for pair in temp1])
-        temp2 = model.most_similar([pred_word_vec], [], topn)
-        pred_words_set = set([pair[0] for pair in temp2])
 
-        if bool(true_words_set & pred_words_set):
-            correct += 1
-    return correct / len(true_words)
+def get_accuracy(model, true_words, pred_words, topn=10, true_ids=None):
+    '''
+    The fraction of predictions whose true word is among their topn nearest words, decoded in batches.
+    true_ids: the ids of the true words in the model, recovered from true_words if not given
+    '''
+    print('begin getting accuracy')
+    decoder = get_decoder(model)
+    if true_ids is None:
+        true_ids = decoder.nearest(true_words)
+    return get_topk_accuracy(decoder, true_ids, pred_words, topn)
 
 
 def main():
+    model_params = model3_params()
+    session_config = get_session_config(model_params.intra_op_threads, model_params.inter_op_threads)
+    save_path = model_params.tf_save_path
+    prepare_save_path(save_path, model_params.save_policy)
     # filename='partial_reviews1000.json'
-    filename='large_dataset_12000.json'
+    # the reviews are the ranges of model_params, which the save path is named after
+    filename = system_params().all_reviews_jsonfn
     if_pretrained = True
 
-    model, sentences, stars = get_word_embedding(filename,0, 10000,use_glove=if_pretrained)
+    model, sentences, stars = get_word_embedding(filename, model_params.train_start, model_params.train_end, use_glove=if_pretrained)
+    sentences, stars, val_sentences, val_stars = split_validation(sentences, stars, model_params.validation_fraction)
     #Zprint(stars)
     #TODO: to change
     #average 118 tokens per review, so 118/2=59
-    n_steps = 50
-    reverse = True
-    dataset = prepare_input_for_nn(model, sentences, n_steps,stars,  reverse)
-    test_sentences, stars = get_review_data(filename, 11, 12)
+    n_steps = model_params.num_steps
+    reverse = model_params.reverse
+    # the big_fc head flattens all n_steps outputs, so it cannot take trimmed batches
+    bucket_width = 5 if model_params.mode != "big_fc" else 0
+    embedding = get_embedding_matrix(model)
+    dataset = prepare_input_for_nn(model, sentences, n_steps, stars, reverse, embedding=embedding, bucket_width=bucket_width)
+    val_dataset = prepare_input_for_nn(model, val_sentences, n_steps, val_stars, reverse, training=False, embedding=embedding, bucket_width=bucket_width)
+    test_sentences, stars = get_review_data(filename, model_params.test_start, model_params.test_end, shuffle=False, training=False)
 
     print("----------------------- DONE WITH GET REVIEW DATA -----------------------")
 
-    #embedded vector size
-    n_inputs = model.vector_size
-    #each vector is converted into dim=n_neurons
-    n_neurons = 128
-    batch_size= 128
-    # do reset_graph()?
-    cpu_or_gpu = 'gpu'
-    cell_ty = 'lstm'
-    n_layers = 3
-    if_bidirect = True
-    if_attention = False
+    # the architecture is the one of model_params, as model3_parallel.py, model3_numpy.py and model3_distill.py expect
+    batch_size = model_params.batch_size
     choose_n = 10
-    mode_ = ""
     
-    input_ph = tf.placeholder(tf.float32, [None, n_steps, model.vector_size], name='train_input')
-    stars_ph = tf.placeholder(tf.float32, [None], name='train_star_input')
-    word_ph = tf.placeholder(tf.float32, [None, model.vector_size], name='train_label')
+    iterator, pipeline_feed = get_input_pipeline(
+        dataset,
+        batch_size,
+        shuffle_buffer=model_params.shuffle_buffer,
+        prefetch=model_params.prefetch,
+        num_parallel_calls=model_params.num_parallel_calls)
+    batch_inputs, batch_words, batch_seq_length, batch_stars = iterator.get_next()
+    # training reads from the pipeline, prediction feeds these directly
+    input_ph = tf.placeholder_with_default(batch_inputs, [None, n_steps if bucket_width == 0 else None], name='train_input')
+    stars_ph = tf.placeholder_with_default(batch_stars, [None], name='train_star_input')
+    word_ph = tf.placeholder_with_default(batch_words, [None], name='train_label')
     training = tf.placeholder(tf.bool)
-    seq_length_ph = tf.placeholder(tf.int32, [None])
+    seq_length_ph = tf.placeholder_with_default(batch_seq_length, [None])
+    embedding_ph, embedding_var = get_embedding_variable(embedding.shape)
     
-    nn_model = build_nn(n_layers, cpu_or_gpu, cell_ty, training, stars_ph, input_ph, n_steps, n_inputs, n_neurons, seq_length_ph, out_size=model.vector_size, bidirection=if_bidirect, attention=if_attention, mode=mode_)
+    nn_model = build_params_nn(model_params, training, stars_ph, input_ph, seq_length_ph, embedding.shape, embedding_var)
     #state is the state of last time stamp (word) for EACH sentence
 
-    loss = get_loss(nn_model, word_ph)
+    loss = get_loss(nn_model, tf.nn.embedding_lookup(embedding_var, word_ph))
+    vocab_head_size = model_params.vocab_head_size
+    if vocab_head_size > 0:
+        head_ids = get_head_vocab(model, vocab_head_size)
+        weights, biases, _ = build_vocab_head(nn_model, head_ids, embedding_ph)
+        loss = loss + get_vocab_loss(weights, biases, nn_model, word_ph, head_ids, model_params.num_sampled)
     train_op = get_optimizer(loss)
-    saver = tf.train.Saver()
+    manager = CheckpointManager(save_path, model_params.patience, model_params.min_delta)
+    validation_loss = None
+    if val_dataset._num_data > 0:
+        validation_loss = lambda sess: get_validation_loss(sess, loss, get_validation_batches(val_dataset, training, stars_ph, input_ph, word_ph, seq_length_ph))
     # begin training
     init = tf.global_variables_initializer()
     
-    with tf.Session() as sess:
-        sess.run(init)
-        train_nn(seq_length_ph,n_steps, n_inputs, training, model, sess, saver, stars_ph,input_ph, word_ph, loss, train_op, dataset, batch_size, num_epoch=3)
+    with tf.Session(config=session_config) as sess:
+        sess.run(init, feed_dict={embedding_ph: embedding})
+        manager.restore(sess)
+        train_nn(sess, manager, training, loss, train_op, iterator, pipeline_feed, num_epoch=model_params.epoches,
+                 checkpoint_every=model_params.checkpoint_every, validation_loss=validation_loss)
     print("----------------------- DONE WITH TRAINING -----------------------")
     # t_input_ph = tf.placeholder(tf.float32, [None, model.vector_size], name='test_input')
     # t_word_ph = tf.placeholder(tf.float32, [None, model.vector_size], name='test_predicted_label')
-    test_true_words, test_pred_words = get_prediction(seq_length_ph, training, model, nn_model, test_sentences,  stars, stars_ph, input_ph, word_ph, n_steps)
+    test_true_words, test_pred_words, test_true_ids = get_prediction(seq_length_ph, training, model, nn_model, test_sentences, stars, stars_ph, input_ph, n_steps, save_path, reverse, embedding=embedding, bucket_width=bucket_width, session_config=session_config, return_ids=True)
     print("----------------------- DONE WITH PREDICTION -----------------------")
-    acc = get_accuracy(model, test_true_words, test_pred_words, topn=choose_n)
+    acc = get_accuracy(model, test_true_words, test_pred_words, topn=choose_n, true_ids=test_true_ids)
     print("----------------------- DONE WITH GET ACCURACY -----------------------")
     print('accuracy = {}'.format(acc))
-    eSaved = get_esaved(model, test_true_words, test_pred_words, topn=1, cons=20)
+    eSaved = get_esaved(model, test_true_words, test_pred_words, topn=1, cons=20, true_ids=test_true_ids)
     print("----------------------- DONE WITH GET ESAVED -----------------------")
     print('eSaved = {}'.format(eSaved))
-    description=str(n_neurons) +'_'+ str(batch_size) +'_'+cell_ty+'_'+str(n_layers)+'_'+str(if_bidirect)+'_'+str(if_attention) +'_'+str(choose_n)+'_'+str(if_pretrained)
+    if vocab_head_size > 0:
+        decoder = VocabDecoder.from_checkpoint(model, save_path)
+        print('accuracy with the vocabulary head = {}'.format(get_vocab_accuracy(decoder, test_true_ids, test_pred_words, topn=choose_n)))
+        print('eSaved with the vocabulary head = {}'.format(get_vocab_esaved(decoder, test_true_ids, test_pred_words, topn=1)))
+    description=str(model_params.num_neurons) +'_'+ str(batch_size) +'_'+model_params.cell_type+'_'+str(model_params.num_layers)+'_'+str(model_params.if_bidirect)+'_'+str(model_params.attention) +'_'+str(choose_n)+'_'+str(if_pretrained)
     print(description)
 if __name__ == '__main__':
     main()
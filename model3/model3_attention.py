@@ -1,16 +1,19 @@
 from pathlib import Path
 from operator import itemgetter
-import json
+import json, sys, os
 import numpy as np
 import nltk
 import tensorflow as tf
 from gensim.models import Word2Vec
 import gensim.models.keyedvectors as word2vec
-from dict_filter import get_esaved
 from model3_config import model3_params
+from model3 import select_platform, attention_head
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from dict_filter import get_esaved
+from word_decoder import get_decoder
 from system_config import system_params
 from prep_data import get_review_data, get_word_embedding
+from train_utils import prepare_save_path, split_validation, CheckpointManager, get_validation_loss, train_epochs
 import warnings
 warnings.filterwarnings("ignore")
 
@@ -75,18 +78,24 @@ class DataSet(object):
 
 def get_rnn_cell(att, typ, platform, **kwargs):
     # get an rnn cell with the specified type on specific platform
-    if typ == 'rnn' and platform == 'cpu':
+    platform = select_platform(platform)
+    # there is no fused or cuDNN-compatible basic cell, every platform uses BasicRNNCell
+    if typ == 'rnn':
         cell= tf.nn.rnn_cell.BasicRNNCell(**kwargs)
     #elif typ == 'rnn' and platform == 'gpu':
         #return tf.contrib.cudnn_rnn.CudnnRNNTanhSaveable(**kwargs)
     elif typ == 'lstm' and platform == 'cpu':
         cell= tf.nn.rnn_cell.LSTMCell(**kwargs)
+    elif typ == 'lstm' and platform == 'cpu_block':
+        cell= tf.contrib.rnn.LSTMBlockCell(**kwargs)
     elif typ == 'lstm' and platform == 'gpu':
         cell= tf.contrib.cudnn_rnn.CudnnCompatibleLSTMCell(**kwargs)
     #elif typ == 'lstmbn' and (platform == 'cpu' or platform == 'gpu'):
         #return tf.contrib.rnn.LayerNormBasicLSTMCell(**kwargs)
     elif typ == 'gru' and platform == 'cpu':
         cell= tf.nn.rnn_cell.GRUCell(**kwargs)
+    elif typ == 'gru' and platform == 'cpu_block':
+        cell= tf.contrib.rnn.GRUBlockCellV2(**kwargs)
     elif typ == 'gru' and platform == 'gpu':
         cell= tf.contrib.cudnn_rnn.CudnnCompatibleGRUCell(**kwargs)
     else:
@@ -149,7 +158,12 @@ def prepare_input_for_nn(wv_model, sentences, n_steps, stars, reverse=True, trai
 
 
 def build_nn(n_layers, xpu, cell_type, training, stars, input_ph, n_steps, num_inputs, n_neurons, seq_length_ph, out_size=100, keep_prob=0.5, bidirection=False, attention = False):
-    
+    '''
+    attention: True wraps every cell in AttentionCellWrapper,
+    'batched' concatenates the final state with attention_head over the outputs of the last layer instead
+    '''
+    batched_attention = attention == 'batched'
+    attention = attention is True
     if n_layers ==1:
         print("1 layer")
         cell = get_rnn_cell(att=attention, typ=cell_type, platform=xpu, num_units = n_neurons, )
@@ -161,6 +175,7 @@ def build_nn(n_layers, xpu, cell_type, training, stars, input_ph, n_steps, num_i
         print("forward")
         outputs, state = tf.nn.dynamic_rnn(cell, input_ph, dtype=tf.float32, sequence_length=seq_length_ph)
         print(tf.shape(outputs), tf.shape(state))
+        memory = outputs
     else:
         print("bidirection")
         cell_bw = get_rnn_cell(att=attention, typ=cell_type, platform=xpu, num_units = n_neurons)
@@ -172,12 +187,15 @@ def build_nn(n_layers, xpu, cell_type, training, stars, input_ph, n_steps, num_i
         state = state_fb[-1]
         #first time
         #state = state_fb[0]
+        memory = outputs_fb[-1]
 
     if n_layers !=1:
         state = state[-1]
     if cell_type=='lstm' or cell_type == "lstmbn":
         print("LSTM")
         state = state[-1]
+    if batched_attention:
+        state = tf.concat((state, attention_head(state, memory, seq_length_ph)), 1)
         
     #reshape stars from ? to ?,1
     stars=tf.reshape(stars,[-1,1])
@@ -200,24 +218,28 @@ def get_optimizer(loss, lr=0.003):
     return tf.train.AdamOptimizer(learning_rate=lr, beta1=0.9, beta2=0.99).minimize(loss)
 
 
-def train_nn(seq_length_ph,n_steps, num_inputs, training, wv_model, sess, saver,stars_ph, input_ph, word_ph, loss, train_op, dataset, batch_size, num_epoch):
-    print("begin training")
-
-    for r in range(num_epoch):
-        for i in range(dataset._num_data // batch_size + 1):
+def train_nn(seq_length_ph,n_steps, num_inputs, training, sess, manager, stars_ph, input_ph, word_ph, loss, train_op, dataset, batch_size, num_epoch, checkpoint_every=0, validation_loss=None):
+    '''
+    Train for the epochs manager has not finished yet, on dataset._num_data // batch_size + 1 batches an epoch.
+    manager: the CheckpointManager of the run, it saves the checkpoints and decides when to stop early
+    validation_loss: a function of the session returning the held-out loss
+    '''
+    num_batches = dataset._num_data // batch_size + 1
+    def init_epoch(sess, skip):
+        # the batches trained before resuming are drawn and dropped, so the epoch keeps its length
+        for i in range(num_batches):
             X_batch, y_batch, seq_length_batch, stars_batch = dataset.next_batch(batch_size)
+            if i < skip:
+                continue
             #?????
             #print(X_batch.shape)
             X_batch = X_batch.reshape((-1, n_steps, num_inputs))
-            sess.run(train_op, feed_dict={training: True, stars_ph:stars_batch, input_ph: X_batch, word_ph: y_batch, seq_length_ph: seq_length_batch})
-            cur_loss = sess.run(loss, feed_dict={training: True, stars_ph:stars_batch,input_ph: X_batch, word_ph: y_batch, seq_length_ph: seq_length_batch})
-            if i%1000==0:
-                print("loss for batch {} is {}".format(i, cur_loss))
-        print("loss for epoch {} is {}".format(r, cur_loss))
-    saver.save(sess, SAVE_PATH)
+            yield {stars_ph:stars_batch, input_ph: X_batch, word_ph: y_batch, seq_length_ph: seq_length_batch}
+    train_epochs(sess, manager, loss, train_op, num_epoch, init_epoch, feed_dict={training: True}, checkpoint_every=checkpoint_every,
+                 validation_loss=validation_loss)
 
 
-def get_prediction(seq_length_ph, training, wv_model, nn_model, test_sentences, stars, stars_ph, input_ph, word_ph, n_steps,reverse=True):
+def get_prediction(seq_length_ph, training, wv_model, nn_model, test_sentences, stars, stars_ph, input_ph, word_ph, n_steps, save_path, reverse=True):
     print('begin predicting')
     dataset = prepare_input_for_nn(wv_model, test_sentences, n_steps, stars, reverse, training = False)
     X_batch, y_batch, seq_length_batch = dataset.data, dataset.label, dataset.seq_length
@@ -229,26 +251,23 @@ def get_prediction(seq_length_ph, training, wv_model, nn_model, test_sentences,
     #test_true_words = np.reshape(np.array(test_true_words), (len(test_true_words), wv_model.vector_size))
     with tf.Session() as sess:
         saver = tf.train.Saver()
-        saver.restore(sess, SAVE_PATH)
+        saver.restore(sess, save_path)
         test_pred_words = sess.run(nn_model, feed_dict={training: False, stars_ph:test_stars, input_ph: test_inputs, word_ph: test_true_words, seq_length_ph: seq_length_batch})
     print('test pred word len = {}'.format(len(test_pred_words)))
     return test_true_words, test_pred_words
 
 
 def get_accuracy(wv_model, true_words, pred_words, topn=10):
+    '''
+    The fraction of predictions sharing a word with the true word among their topn nearest words, decoded in batches.
+    '''
     print('begin getting accuracy')
+    decoder = get_decoder(wv_model)
+    true_top = decoder.topk(true_words, topn)
+    pred_top = decoder.topk(pred_words, topn)
     correct = 0
     for i in range(len(true_words)):
-
-        true_word_vec = true_words[i]
-        pred_word_vec = pred_words[i]
-
-        temp1 = wv_model.most_similar([true_word_vec], [], topn)
-        true_words_set = set([pair[0] for pair in temp1])
-        temp2 = wv_model.most_similar([pred_word_vec], [], topn)
-        pred_words_set = set([pair[0] for pair in temp2])
-
-        if bool(true_words_set & pred_words_set):
+        if np.intersect1d(true_top[i], pred_top[i]).size > 0:
             correct += 1
     return correct / len(true_words)
 
@@ -257,12 +276,8 @@ def main():
     sys_params = system_params()
     model_params = model3_params()
 
-    save_path = model_params.tf_save_path
-    save_folder = os.path.dirname(save_path)
-    while os.path.isdir(save_folder):
-        overwrite = input("There is a existing model on this path, overwrite? [y/n]")
-        if (overwrite == 'y'):
-            shutil.rmtree(save_folder)
+    save_path = model_params.attention_save_path
+    prepare_save_path(save_path, model_params.save_policy)
 
     start_train, end_train = model_params.train_start, model_params.train_end
     start_test, end_test = model_params.test_start, model_params.test_end
@@ -274,8 +289,10 @@ def main():
     start_test = 101
     end_test = 120
     wv_model, sentences, stars = get_word_embedding(filename, start_train, end_train)
+    sentences, stars, val_sentences, val_stars = split_validation(sentences, stars, model_params.validation_fraction)
     test_sentences, stars = get_review_data(filename, start_test, end_test, model_params.is_shuffle)
     dataset = prepare_input_for_nn(wv_model, sentences, model_params.num_steps, stars,  model_params.reverse)
+    val_dataset = prepare_input_for_nn(wv_model, val_sentences, model_params.num_steps, val_stars, model_params.reverse, training=False)
 
     print("----------------------- DONE WITH GET REVIEW DATA -----------------------")
     
@@ -302,24 +319,33 @@ def main():
         num_inputs, 
         model_params.num_neurons, 
         seq_length_ph, 
-        bidirection=model_params.if_bidirect)
+        bidirection=model_params.if_bidirect,
+        # this script trains an attention model, the batched head unless model_params asks for AttentionCellWrapper
+        attention=model_params.attention or 'batched')
     #state is the state of last time stamp (word) for EACH sentence
 
     loss = get_loss(nn_model, word_ph)
     train_op = get_optimizer(
         loss,
         lr=model_params.learning_rate)
-    saver = tf.train.Saver()
+    manager = CheckpointManager(save_path, model_params.patience, model_params.min_delta)
+    validation_loss = None
+    if val_dataset._num_data > 0:
+        # the validation windows are fed in one batch, as get_prediction does
+        val_feed = {training: False, stars_ph: val_dataset.stars, input_ph: val_dataset.data, word_ph: val_dataset.label, seq_length_ph: val_dataset.seq_length}
+        validation_loss = lambda sess: get_validation_loss(sess, loss, [(val_feed, val_dataset._num_data)])
     # begin training
     init = tf.global_variables_initializer()
     
     with tf.Session() as sess:
         sess.run(init)
-        train_nn(seq_length_ph,n_steps, num_inputs, training, wv_model, sess, saver, stars_ph,input_ph, word_ph, loss, train_op, dataset, batch_size, num_epoch=3)
+        manager.restore(sess)
+        train_nn(seq_length_ph,model_params.num_steps, num_inputs, training, sess, manager, stars_ph,input_ph, word_ph, loss, train_op, dataset, model_params.batch_size,
+                 model_params.epoches, checkpoint_every=model_params.checkpoint_every, validation_loss=validation_loss)
     print("----------------------- DONE WITH TRAINING -----------------------")
     # t_input_ph = tf.placeholder(tf.float32, [None, wv_model.vector_size], name='test_input')
     # t_word_ph = tf.placeholder(tf.float32, [None, wv_model.vector_size], name='test_predicted_label')
-    test_true_words, test_pred_words = get_prediction(seq_length_ph, training, wv_model, nn_model, test_sentences,  stars, stars_ph, input_ph, word_ph, n_steps)
+    test_true_words, test_pred_words = get_prediction(seq_length_ph, training, wv_model, nn_model, test_sentences,  stars, stars_ph, input_ph, word_ph, model_params.num_steps, save_path)
     print("----------------------- DONE WITH PREDICTION -----------------------")
     #acc = get_accuracy(wv_model, test_true_words, test_pred_words)
     #print("----------------------- DONE WITH GET ACCURACY -----------------------")
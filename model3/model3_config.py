@@ -14,18 +14,76 @@ class model3_params:
         self.num_steps = 50
         self.reverse = True
 
+        # the baseline network model3.py has always trained: 3 bidirectional layers of 128 LSTM cells, batches of 128
         self.num_neurons = 128
-        self.batch_size = 64
-        self.cpu_or_gpu = 'gpu'
-        self.cell_type = 'gru'
+        self.batch_size = 128
+        # 'cpu', 'cpu_block' (fused kernels), 'gpu' or 'auto' (gpu if available, else cpu_block)
+        self.cpu_or_gpu = 'auto'
+        # session thread pools, 0 lets TensorFlow choose
+        self.intra_op_threads = 0
+        self.inter_op_threads = 0
+        # processes of model3_parallel.py, 0 for one per core
+        self.num_workers = 0
+        self.cell_type = 'lstm'
         self.num_layers = 3
         self.if_bidirect = True
+        # False, True (AttentionCellWrapper inside the loop) or 'batched' (one attention over all outputs after it)
+        # model3_attention.py trains with 'batched' when this is False
+        self.attention = False
+        # the head of build_nn: '' for the last output or 'big_fc' for all n_steps outputs
+        self.mode = ''
+        # truncated BPTT length for model3_seq.py, 0 runs over whole reviews
+        self.bptt_steps = 0
+        # memory cap of the recurrent state cache in model3_serving.py
+        self.cache_max_bytes = 256 * 2**20
+        # tf.data input pipeline of model3.py
+        self.shuffle_buffer = 100000
+        self.prefetch = 2
+        self.num_parallel_calls = 4
+        # words of the vocabulary head trained with sampled softmax next to the cosine loss, 0 for no head
+        self.vocab_head_size = 0
+        self.num_sampled = 1000
+        # what to do with an existing run in the folder of a save path: 'resume', 'overwrite' or 'fail'
+        self.save_policy = 'resume'
+        # a checkpoint every checkpoint_every batches as well as after every epoch, 0 for after epochs only
+        self.checkpoint_every = 1000
+        # the last fraction of the training reviews is held out to stop early once its loss stops improving by min_delta for patience epochs
+        self.validation_fraction = 0.1
+        self.patience = 2
+        self.min_delta = 0.0
+        # model3_sweep.py trains one model per combination of these values, they override the fields of the same name
+        self.sweep_grid = {
+            'cell_type': ['lstm', 'gru'],
+            'num_neurons': [128, 256],
+            'num_layers': [1, 3],
+            'if_bidirect': [True, False],
+            'attention': [False, 'batched'],
+        }
+        # processes of model3_sweep.py, each training one combination at a time
+        self.sweep_workers = 2
+        # model3_distill.py: the weight of the teacher prediction against the true word in the loss of the student,
+        # and the number of test windows predicted one at a time to measure latency
+        self.distill_alpha = 0.5
+        self.distill_latency_samples = 200
 
-        self.train_size = 100
+        # the first 10000 reviews of system_params.all_reviews_jsonfn, which model3.py has always trained on,
+        # and the 2000 after them as the test reviews
+        self.train_size = 10000
         self.train_start = 0
         self.train_end = self.train_start + self.train_size
 
         self.test_size = (int)(0.2 * self.train_size)
         self.test_start = self.train_end
         self.test_end = self.test_start + self.test_size
+        # the window model of model3.py and model3_parallel.py
         self.tf_save_path = './model3_train_{}_test_{}/m.cpkt'.format(self.train_size, self.test_size)
+        # the weights exported by model3_numpy.py and model3_vocab.py, next to the checkpoint
+        self.npz_path = './model3_train_{}_test_{}/m.npz'.format(self.train_size, self.test_size)
+        self.vocab_npz_path = './model3_train_{}_test_{}/vocab.npz'.format(self.train_size, self.test_size)
+        # the full-sequence model of model3_seq.py, served by model3_serving.py
+        self.seq_save_path = './model3_seq_train_{}_test_{}/m.cpkt'.format(self.train_size, self.test_size)
+        self.attention_save_path = './model3_attention_train_{}_test_{}/m.cpkt'.format(self.train_size, self.test_size)
+        # the shared data, one checkpoint folder per combination and results.csv of model3_sweep.py
+        self.sweep_folder = './model3_sweep_train_{}_test_{}'.format(self.train_size, self.test_size)
+        # the model 2 student of model3_distill.py
+        self.distill_save_path = './model3_distill_train_{}_test_{}/m.cpkt'.format(self.train_size, self.test_size)
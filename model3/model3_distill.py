@@ -0,0 +1,186 @@
+# model3_distill.py
+
+'''
+Distillation of the window model of model 3 into the MLP of model 2, for per-keystroke serving on CPU.
+The teacher is the checkpoint at model3_params.tf_save_path, rebuilt with build_params_nn from the architecture fields
+of model3_params, as model3.py and model3_parallel.py build it when they train it.
+Its predictions on the training reviews are the soft targets of the student. The student is build_nn of model2.py over
+the weighted average of the previous words. It is trained on a mix of the cosine loss to the teacher prediction and to the
+true word, weighted by model3_params.distill_alpha. Both prepare_input_for_nn functions make one sample per known word
+from the 6th word on, in the same order, so the samples of the two models line up without matching them.
+The student checkpoint has the graph of model2.py, so model2_numpy.py and model2_serving.py serve it as they are.
+At the end the teacher, the student and the student on the NumPy runtime are compared on the test reviews:
+the latency of predicting one window at a time, accuracy and eSaved.
+'''
+
+import sys, os, time
+import numpy as np
+import tensorflow as tf
+from model3_config import model3_params
+from model3 import (prepare_input_for_nn, get_embedding_variable, build_params_nn, get_dataset_prediction, get_accuracy, get_session_config)
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'model2'))
+from system_config import system_params
+from dict_filter import get_esaved
+from prep_data import get_review_data, get_word_embedding, get_embedding_matrix
+from train_utils import prepare_save_path, split_validation, CheckpointManager, get_validation_loss
+from model2_config import model2_params
+from model2 import (prepare_input_for_nn as prepare_student_input, build_nn as build_student_nn, get_loss as get_student_loss,
+                    get_optimizer as get_student_optimizer, get_input_pipeline as get_student_pipeline, train_nn as train_student_nn,
+                    get_validation_batches as get_student_validation_batches, get_prediction as get_student_prediction)
+from model2_numpy import NumpyMLP, load_dense_weights
+
+os.environ["TF_CPP_MIN_LOG_LEVEL"]="3"
+
+BUCKET_WIDTH = 5
+
+
+def build_teacher(model_params, embedding_shape, bucket_width):
+    '''
+    The placeholders and the network of the teacher, the one model3.py and model3_parallel.py train with the same model_params.
+    '''
+    graph = {}
+    graph['input_ph'] = tf.placeholder(tf.int32, [None, model_params.num_steps if bucket_width == 0 else None], name='train_input')
+    graph['stars_ph'] = tf.placeholder(tf.float32, [None], name='train_star_input')
+    graph['training'] = tf.placeholder(tf.bool)
+    graph['seq_length_ph'] = tf.placeholder(tf.int32, [None])
+    graph['embedding_ph'], embedding_var = get_embedding_variable(embedding_shape)
+    graph['nn_model'] = build_params_nn(model_params, graph['training'], graph['stars_ph'], graph['input_ph'], graph['seq_length_ph'],
+                                        embedding_shape, embedding_var)
+    return graph
+
+
+def measure_latency(predict_one, num_samples):
+    '''
+    The mean wall time in milliseconds of predict_one(i) for i in range(num_samples), after one call to warm up.
+    '''
+    if num_samples == 0:
+        return float('nan')
+    predict_one(0)
+    start = time.time()
+    for i in range(num_samples):
+        predict_one(i)
+    return (time.time() - start) / num_samples * 1000
+
+
+def get_teacher_predictions(model_params, save_path, datasets, num_latency_samples, session_config=None):
+    '''
+    Predict every sample of datasets with the teacher, and measure its latency on the first samples of the last one.
+    Output:
+        the predicted word vectors of every dataset, and the latency in milliseconds
+    '''
+    embedding = datasets[0].embedding
+    bucket_width = datasets[0].bucket_width
+    predictions = []
+    with tf.Graph().as_default():
+        graph = build_teacher(model_params, embedding.shape, bucket_width)
+        for dataset in datasets:
+            predictions.append(get_dataset_prediction(graph['seq_length_ph'], graph['training'], graph['nn_model'], dataset, graph['stars_ph'],
+                                                      graph['input_ph'], save_path, session_config=session_config)[1])
+        dataset = datasets[-1]
+        with tf.Session(config=session_config) as sess:
+            tf.train.Saver().restore(sess, save_path)
+            def predict_one(i):
+                X_batch, y_batch, seq_length_batch, stars_batch = dataset.get_batch(np.array([i]))
+                return sess.run(graph['nn_model'], feed_dict={graph['training']: False, graph['stars_ph']: stars_batch,
+                                                              graph['input_ph']: X_batch, graph['seq_length_ph']: seq_length_batch})
+            latency = measure_latency(predict_one, min(num_latency_samples, dataset._num_data))
+    return predictions, latency
+
+
+def train_student(model_params, student_params, save_path, inputs, targets, val_inputs, val_targets):
+    '''
+    Train the MLP of model 2 on the soft targets.
+    Input:
+        targets: the teacher predictions and the true word vectors side by side, shape (num samples, 2 * vector_size)
+    '''
+    num_features, vector_size = inputs.shape[1], targets.shape[1] // 2
+    alpha = model_params.distill_alpha
+    with tf.Graph().as_default():
+        features_ph, labels_ph, iterator = get_student_pipeline(num_features, 2 * vector_size, student_params.batch_size, 1,
+                                                                shuffle_buffer=student_params.shuffle_buffer, prefetch=student_params.prefetch)
+        batch_inputs, batch_targets = iterator.get_next()
+        input_ph = tf.placeholder_with_default(batch_inputs, [None, num_features], name='train_input')
+        target_ph = tf.placeholder_with_default(batch_targets, [None, 2 * vector_size], name='train_label')
+        student = build_student_nn(input_ph, vector_size)
+        loss = alpha * get_student_loss(student, target_ph[:, :vector_size]) + (1 - alpha) * get_student_loss(student, target_ph[:, vector_size:])
+        train_op = get_student_optimizer(loss, student_params.learning_rate)
+        manager = CheckpointManager(save_path, model_params.patience, model_params.min_delta)
+        validation_loss = None
+        if len(val_inputs) > 0:
+            validation_loss = lambda sess: get_validation_loss(sess, loss, get_student_validation_batches(input_ph, target_ph, val_inputs, val_targets,
+                                                                                                          student_params.predict_batch_size))
+        with tf.Session() as sess:
+            sess.run(tf.global_variables_initializer())
+            manager.restore(sess)
+            train_student_nn(sess, manager, loss, train_op, iterator, features_ph, labels_ph, inputs, targets, student_params.epoches,
+                             log_every=student_params.log_every, checkpoint_every=model_params.checkpoint_every, validation_loss=validation_loss)
+
+
+def get_student_predictions(wv_model, save_path, test_sentences, test_stars, num_latency_samples, batch_size=1024):
+    '''
+    Predict the test reviews with the student, and measure its latency in TensorFlow and on the NumPy runtime.
+    Output:
+        the true and the predicted word vectors, the TensorFlow latency and the NumPy latency in milliseconds
+    '''
+    test_inputs, _ = prepare_student_input(wv_model, test_sentences, test_stars, reverse=False)
+    num_samples = min(num_latency_samples, len(test_inputs))
+    with tf.Graph().as_default():
+        input_ph = tf.placeholder(tf.float32, [None, test_inputs.shape[1]], name='train_input')
+        student = build_student_nn(input_ph, wv_model.vector_size)
+        test_true_words, test_pred_words = get_student_prediction(wv_model, student, test_sentences, test_stars, input_ph, save_path, batch_size)
+        with tf.Session() as sess:
+            tf.train.Saver().restore(sess, save_path)
+            latency = measure_latency(lambda i: sess.run(student, feed_dict={input_ph: test_inputs[i:i + 1]}), num_samples)
+    runtime = NumpyMLP(*load_dense_weights(save_path))
+    numpy_latency = measure_latency(lambda i: runtime(test_inputs[i:i + 1]), num_samples)
+    return test_true_words, test_pred_words, latency, numpy_latency
+
+
+def main():
+    sys_params = system_params()
+    model_params = model3_params()
+    student_params = model2_params()
+    session_config = get_session_config(model_params.intra_op_threads, model_params.inter_op_threads)
+    bucket_width = BUCKET_WIDTH if model_params.mode != 'big_fc' else 0
+    save_path = model_params.distill_save_path
+    prepare_save_path(save_path, model_params.save_policy)
+
+    wv_model, sentences, stars = get_word_embedding(sys_params.all_reviews_jsonfn, model_params.train_start, model_params.train_end)
+    sentences, stars, val_sentences, val_stars = split_validation(sentences, stars, model_params.validation_fraction)
+    test_sentences, test_stars = get_review_data(sys_params.all_reviews_jsonfn, model_params.test_start, model_params.test_end, shuffle=False, training=False)
+    embedding = get_embedding_matrix(wv_model)
+    datasets = [prepare_input_for_nn(wv_model, name_sentences, model_params.num_steps, name_stars, model_params.reverse, training=False,
+                                     embedding=embedding, bucket_width=bucket_width)
+                for name_sentences, name_stars in [(sentences, stars), (val_sentences, val_stars), (test_sentences, test_stars)]]
+    inputs, true_words = prepare_student_input(wv_model, sentences, stars, reverse=False)
+    val_inputs, val_true_words = prepare_student_input(wv_model, val_sentences, val_stars, reverse=False)
+    print("----------------------- DONE WITH GET REVIEW DATA -----------------------")
+
+    (teacher_words, val_teacher_words, test_teacher_words), teacher_latency = get_teacher_predictions(
+        model_params, model_params.tf_save_path, datasets, model_params.distill_latency_samples, session_config)
+    if len(teacher_words) != len(inputs) or len(val_teacher_words) != len(val_inputs):
+        raise ValueError('the samples of the teacher and the student do not line up')
+    print("----------------------- DONE WITH TEACHER PREDICTION -----------------------")
+
+    train_student(model_params, student_params, save_path, inputs, np.hstack([teacher_words, true_words]),
+                  val_inputs, np.hstack([val_teacher_words, val_true_words]))
+    print("----------------------- DONE WITH TRAINING -----------------------")
+
+    test_true_words, test_student_words, student_latency, numpy_latency = get_student_predictions(
+        wv_model, save_path, test_sentences, test_stars, model_params.distill_latency_samples, student_params.predict_batch_size)
+    print("----------------------- DONE WITH PREDICTION -----------------------")
+    test_true_ids = datasets[-1].tokens[datasets[-1].positions]
+    results = []
+    for name, pred_words, latency in [('teacher', test_teacher_words, teacher_latency), ('student', test_student_words, student_latency)]:
+        acc = get_accuracy(wv_model, test_true_words, pred_words, topn=10, true_ids=test_true_ids)
+        eSaved = get_esaved(wv_model, test_true_words, pred_words, topn=1, cons=20, true_ids=test_true_ids)
+        results.append((name, latency, acc, eSaved))
+    # the NumPy runtime computes the same function as the student graph
+    results.append(('student (numpy)', numpy_latency, results[-1][2], results[-1][3]))
+    print('{:<16} {:>12} {:>10} {:>10}'.format('model', 'latency (ms)', 'accuracy', 'eSaved'))
+    for name, latency, acc, eSaved in results:
+        print('{:<16} {:>12.3f} {:>10.4f} {:>10.4f}'.format(name, latency, acc, eSaved))
+
+if __name__ == '__main__':
+    main()
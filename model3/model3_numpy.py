@@ -0,0 +1,465 @@
+# model3_numpy.py
+
+'''
+A NumPy runtime for the window model of model3.py (build_nn), so serving does not need TensorFlow.
+export_npz dumps the embedding, the recurrent layers and the dense head of a checkpoint into one .npz file,
+and NumpyRNN runs the forward pass on batches of windows with preallocated buffers.
+Only the checkpoint reading and verify import TensorFlow.
+Usage:
+    python model3/model3_numpy.py [export|verify|serve]
+'''
+
+import re, sys, os
+import numpy as np
+import gensim.models.keyedvectors as word2vec
+from model3_config import model3_params
+from model3_vocab import VocabDecoder
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from dict_filter import pred_dict_filter
+from prep_data import get_word_embedding, get_word_ids
+from system_config import system_params
+from ann_index import use_ann_index
+
+os.environ["TF_CPP_MIN_LOG_LEVEL"]="3"
+
+DENSE_KERNEL = re.compile(r'^dense(_(\d+))?/kernel$')
+# only the weights of the cells, not the slots the optimizer keeps next to them (e.g. kernel/Adam, kernel/Adam_1)
+RNN_VARIABLE = re.compile(r'^(rnn|bidirectional_rnn/(fw|bw))/(multi_rnn_cell/cell_(\d+)/)?(\w+_cell)/'
+                          r'((gates/|candidate/|candidate/(input|hidden)_projection/)?(kernel|bias))$')
+# the scope every supported cell creates its variables in, and the cell type of the runtime
+CELL_SCOPES = {
+    'basic_rnn_cell': 'rnn',
+    'lstm_cell': 'lstm',
+    'cudnn_compatible_lstm_cell': 'lstm',
+    'gru_cell': 'gru',
+    'cudnn_compatible_gru_cell': 'cudnn_gru',
+}
+
+
+def load_rnn_weights(save_path):
+    '''
+    Read the variables of a checkpoint written by model3.py.
+    build_nn only uses the final state of the backward cells of a bidirectional network,
+    so only those are read; the forward cells are read for a unidirectional one.
+    Output:
+        a dict with the cell type, forget bias, direction, embedding, the variables of every layer and the dense head
+    '''
+    import tensorflow as tf
+    reader = tf.train.load_checkpoint(save_path)
+    names = [name for name, shape in tf.train.list_variables(save_path)]
+    bidirectional = any(name.startswith('bidirectional_rnn/bw/') for name in names)
+    direction = 'bidirectional_rnn/bw' if bidirectional else 'rnn'
+
+    layers = {}
+    scopes = set()
+    for name in names:
+        match = RNN_VARIABLE.match(name)
+        if match is None or not name.startswith(direction + '/'):
+            continue
+        if match.group(5) not in CELL_SCOPES:
+            raise ValueError('cannot export the cell {}, only plain GRU, LSTM and RNN cells are supported'.format(name))
+        scopes.add(match.group(5))
+        layer = int(match.group(4) or 0)
+        layers.setdefault(layer, {})[match.group(6)] = reader.get_tensor(name)
+    if len(layers) == 0:
+        raise ValueError('no recurrent layers found in {}'.format(save_path))
+    if len(scopes) != 1:
+        raise ValueError('mixed cell types {} are not supported'.format(sorted(scopes)))
+    scope = scopes.pop()
+
+    dense = sorted((int(match.group(2) or 0), name[:-len('/kernel')]) for name in names for match in [DENSE_KERNEL.match(name)] if match)
+    if len(dense) != 2:
+        # the big_fc mode flattens every output into an extra dense layer
+        raise ValueError('expected the two dense layers of the build_nn head, found {}'.format(len(dense)))
+    head_kernels = [reader.get_tensor(scope + '/kernel') for _, scope in dense]
+    last = layers[len(layers) - 1]
+    if 'gates/bias' in last:
+        num_neurons = last['gates/bias'].shape[0] // 2
+    else:
+        num_neurons = last['bias'].shape[0] // (4 if CELL_SCOPES[scope] == 'lstm' else 1)
+    if head_kernels[0].shape[0] != num_neurons + 1:
+        # the head of an attention model also reads the attention context
+        raise ValueError('only models without attention can be exported')
+
+    return {
+        'cell': CELL_SCOPES[scope],
+        # LSTMCell and LSTMBlockCell add 1 to the forget gate, the cudnn compatible cell does not
+        'forget_bias': 0.0 if scope == 'cudnn_compatible_lstm_cell' else 1.0,
+        'platform': 'gpu' if scope.startswith('cudnn') else 'cpu',
+        'bidirectional': bidirectional,
+        'embedding': reader.get_tensor('embedding'),
+        'layers': [layers[i] for i in range(len(layers))],
+        'head_kernels': head_kernels,
+        'head_biases': [reader.get_tensor(scope + '/bias') for _, scope in dense],
+    }
+
+
+def export_npz(save_path, npz_path, dtype=np.float32):
+    '''
+    Export a model 3 checkpoint.
+    Input:
+        save_path: the checkpoint path, as given to saver.save
+        npz_path: the file to write
+        dtype: the dtype the weights are stored in, np.float16 halves the file and the serving memory
+    '''
+    weights = load_rnn_weights(save_path)
+    arrays = {
+        'cell': np.array(weights['cell']),
+        'forget_bias': np.array(weights['forget_bias']),
+        'platform': np.array(weights['platform']),
+        'bidirectional': np.array(weights['bidirectional']),
+        'embedding': weights['embedding'].astype(dtype),
+    }
+    for i, layer in enumerate(weights['layers']):
+        for name, value in layer.items():
+            arrays['layer_{}/{}'.format(i, name)] = value.astype(dtype)
+    for i in range(len(weights['head_kernels'])):
+        arrays['head_kernel_{}'.format(i)] = weights['head_kernels'][i].astype(dtype)
+        arrays['head_bias_{}'.format(i)] = weights['head_biases'][i].astype(dtype)
+    np.savez(npz_path, **arrays)
+    print('exported {} {} layers to {}'.format(len(weights['layers']), weights['cell'], npz_path))
+
+
+def _sigmoid(x):
+    # in place, the tanh form does not overflow in float16
+    x *= 0.5
+    np.tanh(x, out=x)
+    x *= 0.5
+    x += 0.5
+
+
+class NumpyRNN(object):
+    '''
+    The forward pass of build_nn: the stacked recurrent layers over the window, the final state of the last layer
+    concatenated with the star, and the two dense layers (dropout is off at inference).
+    A bidirectional network runs its backward cells over the window reversed within seq_length, like bidirectional_dynamic_rnn.
+    The samples of a batch are sorted by seq_length, so at every step the samples still running are a prefix of the batch
+    and the recurrent matmul only covers them; the input projections of all steps are one matmul per layer.
+    '''
+    def __init__(self, cell, layers, head_kernels, head_biases, embedding, bidirectional=False, forget_bias=1.0, platform='cpu', dtype=np.float32):
+        self.cell = cell
+        self.bidirectional = bidirectional
+        self.forget_bias = forget_bias
+        self.platform = platform
+        self.dtype = dtype
+        self.embedding = np.asarray(embedding, dtype=dtype)
+        self.pad_id = self.embedding.shape[0] - 1
+        self.num_layers = len(layers)
+        self.layers = []
+        input_size = self.embedding.shape[1]
+        for layer in layers:
+            self.layers.append(self._split_layer(layer, input_size))
+            input_size = self.num_neurons
+        self.head_kernels = [np.ascontiguousarray(kernel, dtype=dtype) for kernel in head_kernels]
+        self.head_biases = [np.asarray(bias, dtype=dtype) for bias in head_biases]
+        self.output_size = self.head_kernels[-1].shape[1]
+        self._buffers = {}
+
+    def _split_layer(self, layer, input_size):
+        '''
+        Split every kernel into the rows applied to the input and the rows applied to the state.
+        Output:
+            x_kernel, x_bias: the input projection of all gates, applied to every step at once
+            h_kernel: the state projection of the gates
+            c_kernel, c_bias: the state projection of the GRU candidate
+        '''
+        def cast(value):
+            return np.ascontiguousarray(value, dtype=self.dtype)
+        split = {}
+        if self.cell in ['rnn', 'lstm']:
+            kernel, bias = layer['kernel'], layer['bias']
+            split['x_kernel'], split['x_bias'] = cast(kernel[:input_size]), cast(bias)
+            split['h_kernel'] = cast(kernel[input_size:])
+            self.num_neurons = kernel.shape[0] - input_size
+        elif self.cell == 'gru':
+            gates, candidate = layer['gates/kernel'], layer['candidate/kernel']
+            split['x_kernel'] = cast(np.concatenate([gates[:input_size], candidate[:input_size]], axis=1))
+            split['x_bias'] = cast(np.concatenate([layer['gates/bias'], layer['candidate/bias']]))
+            split['h_kernel'] = cast(gates[input_size:])
+            split['c_kernel'] = cast(candidate[input_size:])
+            self.num_neurons = candidate.shape[1]
+        elif self.cell == 'cudnn_gru':
+            gates = layer['gates/kernel']
+            split['x_kernel'] = cast(np.concatenate([gates[:input_size], layer['candidate/input_projection/kernel']], axis=1))
+            split['x_bias'] = cast(np.concatenate([layer['gates/bias'], layer['candidate/input_projection/bias']]))
+            split['h_kernel'] = cast(gates[input_size:])
+            split['c_kernel'] = cast(layer['candidate/hidden_projection/kernel'])
+            split['c_bias'] = cast(layer['candidate/hidden_projection/bias'])
+            self.num_neurons = split['c_kernel'].shape[1]
+        else:
+            raise ValueError('unknown cell type {}'.format(self.cell))
+        return split
+
+    @classmethod
+    def load(cls, npz_path, dtype=np.float32):
+        '''
+        Load exported weights. The file may hold float16 weights; dtype is what they are computed in.
+        '''
+        with np.load(npz_path) as f:
+            num_layers = len(set(key.split('/')[0] for key in f.files if key.startswith('layer_')))
+            layers = []
+            for i in range(num_layers):
+                prefix = 'layer_{}/'.format(i)
+                layers.append({key[len(prefix):]: f[key] for key in f.files if key.startswith(prefix)})
+            num_dense = len([key for key in f.files if key.startswith('head_kernel_')])
+            head_kernels = [f['head_kernel_{}'.format(i)] for i in range(num_dense)]
+            head_biases = [f['head_bias_{}'.format(i)] for i in range(num_dense)]
+            return cls(str(f['cell']), layers, head_kernels, head_biases, f['embedding'],
+                       bidirectional=bool(f['bidirectional']), forget_bias=float(f['forget_bias']), platform=str(f['platform']), dtype=dtype)
+
+    def _get_buffers(self, batch_size, num_steps):
+        # the buffers of every (batch, steps) shape, reused by every batch of that shape
+        key = (batch_size, num_steps)
+        if key not in self._buffers:
+            n = self.num_neurons
+            self._buffers[key] = {
+                'inputs': [np.empty((batch_size, num_steps, layer['x_kernel'].shape[1]), dtype=self.dtype) for layer in self.layers],
+                # steps past seq_length are never written, zeros keep them finite for the next projection
+                'outputs': np.zeros((batch_size, num_steps, n), dtype=self.dtype),
+                'gates': np.empty((batch_size, self.layers[0]['h_kernel'].shape[1]), dtype=self.dtype),
+                'candidate': np.empty((batch_size, n), dtype=self.dtype),
+                'h': np.empty((batch_size, n), dtype=self.dtype),
+                'c': np.empty((batch_size, n), dtype=self.dtype),
+                'temp': np.empty((batch_size, n), dtype=self.dtype),
+            }
+        return self._buffers[key]
+
+    def _run_layer(self, i, inputs, running, buffers, outputs):
+        '''
+        Run layer i over inputs (batch, steps, in), leaving the final state of every sample in buffers['h'].
+        running[t] is the number of samples, a prefix of the batch, whose seq_length is larger than t.
+        inputs are only read by the input projection, so they may be the outputs buffer itself.
+        '''
+        n = self.num_neurons
+        layer = self.layers[i]
+        batch_size, num_steps = inputs.shape[:2]
+        projected = buffers['inputs'][i]
+        np.dot(inputs.reshape(batch_size * num_steps, -1), layer['x_kernel'], out=projected.reshape(batch_size * num_steps, -1))
+        projected += layer['x_bias']
+        h, c = buffers['h'], buffers['c']
+        h.fill(0)
+        c.fill(0)
+        for t in range(num_steps):
+            b = running[t]
+            if b == 0:
+                break
+            h_b = h[:b]
+            gates = buffers['gates'][:b]
+            np.dot(h_b, layer['h_kernel'], out=gates)
+            if self.cell == 'rnn':
+                gates += projected[:b, t]
+                np.tanh(gates, out=h_b)
+            elif self.cell == 'lstm':
+                gates += projected[:b, t]
+                i, j, f, o = gates[:, :n], gates[:, n:2 * n], gates[:, 2 * n:3 * n], gates[:, 3 * n:]
+                f += self.forget_bias
+                _sigmoid(i)
+                _sigmoid(f)
+                _sigmoid(o)
+                np.tanh(j, out=j)
+                c_b = c[:b]
+                c_b *= f
+                j *= i
+                c_b += j
+                temp = buffers['temp'][:b]
+                np.tanh(c_b, out=temp)
+                np.multiply(o, temp, out=h_b)
+            else:
+                gates += projected[:b, t, :2 * n]
+                _sigmoid(gates)
+                r, u = gates[:, :n], gates[:, n:]
+                candidate = buffers['candidate'][:b]
+                if self.cell == 'gru':
+                    # GRUCell resets the state before the candidate matmul
+                    temp = buffers['temp'][:b]
+                    np.multiply(r, h_b, out=temp)
+                    np.dot(temp, layer['c_kernel'], out=candidate)
+                else:
+                    # the cudnn GRU resets after it
+                    np.dot(h_b, layer['c_kernel'], out=candidate)
+                    candidate += layer['c_bias']
+                    candidate *= r
+                candidate += projected[:b, t, 2 * n:]
+                np.tanh(candidate, out=candidate)
+                # h = u * h + (1 - u) * candidate
+                h_b -= candidate
+                h_b *= u
+                h_b += candidate
+            if outputs is not None:
+                outputs[:b, t] = h_b
+
+    def forward(self, window_ids, seq_length, stars):
+        '''
+        Input:
+            window_ids: int array of shape (batch, steps), the windows made by DataSet.get_window_ids
+            seq_length: the number of words in every window
+            stars: the star of every window
+        Output:
+            the predicted word vectors, of shape (batch, vector_size)
+        '''
+        window_ids = np.asarray(window_ids)
+        seq_length = np.asarray(seq_length)
+        batch_size = window_ids.shape[0]
+        # steps after the longest window do not change any state
+        num_steps = int(seq_length.max()) if batch_size > 0 else 0
+        order = np.argsort(-seq_length, kind='stable')
+        ids = window_ids[order, :num_steps]
+        lengths = seq_length[order]
+        if self.bidirectional:
+            # the backward cells see every window reversed within its seq_length
+            steps = np.arange(num_steps)
+            ids = ids[np.arange(batch_size)[:, None], np.where(steps < lengths[:, None], lengths[:, None] - 1 - steps, steps)]
+        running = (lengths[:, None] > np.arange(num_steps)).sum(axis=0)
+
+        buffers = self._get_buffers(batch_size, num_steps)
+        x = self.embedding[ids]
+        for i in range(self.num_layers):
+            last = i == self.num_layers - 1
+            self._run_layer(i, x, running, buffers, None if last else buffers['outputs'])
+            x = buffers['outputs']
+
+        # dense(concat(state, star)), then the second dense layer
+        kernel = self.head_kernels[0]
+        output = np.dot(buffers['h'], kernel[:-1])
+        output += np.asarray(stars, dtype=self.dtype)[order, None] * kernel[-1]
+        output += self.head_biases[0]
+        output = np.dot(output, self.head_kernels[1])
+        output += self.head_biases[1]
+        result = np.empty_like(output)
+        result[order] = output
+        return result
+
+    __call__ = forward
+
+
+def get_windows(contexts, n_steps, pad_id, reverse=True):
+    '''
+    The windows of the next word after every context, as DataSet.get_window_ids makes them.
+    Input:
+        contexts: a list of (star, word ids) pairs, word ids the committed words with words out of the vocabulary as pad_id
+    Output:
+        window_ids, seq_length, stars
+    '''
+    window_ids = np.full((len(contexts), n_steps), pad_id, dtype=np.int64)
+    seq_length = np.empty(len(contexts), dtype=np.int32)
+    stars = np.empty(len(contexts), dtype=np.float32)
+    for i, (star, ids) in enumerate(contexts):
+        window = list(ids[-n_steps:]) if len(ids) > 0 else []
+        seq_length[i] = len(window)
+        stars[i] = star
+        if reverse:
+            window_ids[i, :len(window)] = window[::-1]
+        elif len(window) > 0:
+            window_ids[i, n_steps - len(window):] = window
+    return window_ids, seq_length, stars
+
+
+def verify(save_path, npz_path, filename='small_dataset_1200.json', start=0, end=1200, n_steps=50, reverse=True, batch_size=1024, dtype=np.float32):
+    '''
+    Compare the NumPy runtime with the TensorFlow graph on the windows of the given reviews.
+    Output:
+        the largest absolute difference between the predictions
+    '''
+    import tensorflow as tf
+    from model3 import build_nn, prepare_input_for_nn, get_embedding_variable
+    wv_model, sentences, stars = get_word_embedding(filename, start, end, use_glove=True)
+    dataset = prepare_input_for_nn(wv_model, sentences, n_steps, stars, reverse, training=False)
+    rnn = NumpyRNN.load(npz_path, dtype)
+
+    with tf.Graph().as_default():
+        input_ph = tf.placeholder(tf.int32, [None, None], name='train_input')
+        stars_ph = tf.placeholder(tf.float32, [None], name='train_star_input')
+        training = tf.placeholder(tf.bool)
+        seq_length_ph = tf.placeholder(tf.int32, [None])
+        _, embedding_var = get_embedding_variable(rnn.embedding.shape)
+        cell_type = 'gru' if rnn.cell == 'cudnn_gru' else rnn.cell
+        nn_model = build_nn(rnn.num_layers, rnn.platform, cell_type, training, stars_ph, input_ph, n_steps, rnn.embedding.shape[1],
+                            rnn.num_neurons, seq_length_ph, out_size=rnn.output_size, bidirection=rnn.bidirectional, embedding=embedding_var)
+        max_diff = 0.0
+        with tf.Session() as sess:
+            tf.train.Saver().restore(sess, save_path)
+            for index, (X_batch, y_batch, seq_length_batch, stars_batch) in dataset.iter_batches(batch_size):
+                tf_pred = sess.run(nn_model, feed_dict={training: False, stars_ph: stars_batch, input_ph: X_batch, seq_length_ph: seq_length_batch})
+                np_pred = rnn(X_batch, seq_length_batch, stars_batch)
+                max_diff = max(max_diff, float(np.abs(tf_pred - np_pred).max()))
+    print('{} windows, max abs difference = {}'.format(dataset._num_data, max_diff))
+    return max_diff
+
+
+class NumpyServer(object):
+    '''
+    Batches the next word predictions of many reviews being typed through one NumpyRNN.
+    '''
+    def __init__(self, wv_model, rnn, n_steps, reverse=True):
+        self.wv_model = wv_model
+        self.rnn = rnn
+        self.n_steps = n_steps
+        self.reverse = reverse
+        self.pad_id = rnn.pad_id
+
+    def predict_vectors(self, contexts):
+        '''
+        Input:
+            contexts: a list of (star, word ids) pairs, word ids the committed words of a review
+        Output:
+            a list of predicted vectors, None for contexts without words
+        '''
+        nonempty = [i for i in range(len(contexts)) if len(contexts[i][1]) > 0]
+        results = [None] * len(contexts)
+        if nonempty:
+            pred_words = self.rnn(*get_windows([contexts[i] for i in nonempty], self.n_steps, self.pad_id, self.reverse))
+            for j, i in enumerate(nonempty):
+                results[i] = pred_words[j]
+        return results
+
+
+def serve(server, decoder=None):
+    '''
+    decoder: a VocabDecoder to take the predictions from, instead of the nearest neighbours of the predicted vector
+    '''
+    while True:
+        rate = input("Please give a rating in the scale of 5:\n")
+        rate = int(rate)
+        assert(rate >= 1 and rate <= 5)
+        word_ids = []
+        print("Please type the review, an empty line starts a new one")
+        while True:
+            # every line continues the review, the last word is still being typed unless followed by a space
+            line = input().lower()
+            if line == '':
+                break
+            words = line.split()
+            inputs = ''
+            if not line.endswith(' ') and len(words) > 0:
+                inputs = words.pop()
+            for word_id in get_word_ids(server.wv_model, words):
+                word_ids.append(word_id if word_id >= 0 else server.pad_id)
+            pred_word_vec = server.predict_vectors([(rate, word_ids)])[0]
+            if pred_word_vec is None:
+                print([])
+            elif decoder is not None:
+                print(decoder.topk(pred_word_vec, 1, inputs))
+            else:
+                print(pred_dict_filter(server.wv_model, inputs, pred_word_vec))
+
+
+def main():
+    model_params = model3_params()
+    command = sys.argv[1] if len(sys.argv) > 1 else 'export'
+    if command == 'serve':
+        wv_model = word2vec.KeyedVectors.load_word2vec_format('glove.6B.100d.txt', binary=False)
+        sys_params = system_params()
+        if os.path.isfile(sys_params.ann_index_path):
+            use_ann_index(wv_model, sys_params.ann_index_path, sys_params.ann_nprobe, sys_params.ann_rerank)
+        decoder = VocabDecoder.load(model_params.vocab_npz_path) if os.path.isfile(model_params.vocab_npz_path) else None
+        serve(NumpyServer(wv_model, NumpyRNN.load(model_params.npz_path), model_params.num_steps, model_params.reverse), decoder)
+        return
+    if command == 'export':
+        export_npz(model_params.tf_save_path, model_params.npz_path)
+    elif command == 'verify':
+        verify(model_params.tf_save_path, model_params.npz_path, n_steps=model_params.num_steps, reverse=model_params.reverse)
+    else:
+        print('unknown command {}, choose export, verify or serve'.format(command))
+
+if __name__ == '__main__':
+    main()
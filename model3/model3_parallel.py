@@ -0,0 +1,270 @@
+# model3_parallel.py
+
+'''
+Synchronous data-parallel training of the window model of model3.py with several worker processes on one machine.
+The review data and the embedding are put in shared memory once by the parent, and every worker trains on its own shard
+of the samples. After each step a worker writes its flattened gradients into a shared (num_workers, num_params) array;
+every worker then averages its slice of the columns (a reduce-scatter through shared memory) and all of them apply
+the averaged gradients. Workers start from the parameters of worker 0 and apply identical updates, so they stay in sync
+without sending parameters around. Only the variables with a gradient are trained: of a bidirectional network build_nn
+reads the final state of the backward cells, or the outputs of the forward cells with mode 'big_fc', so the cells
+of the other direction keep the initial values of worker 0, which every worker and checkpoint share. Worker 0 checkpoints to model3_params.tf_save_path with a CheckpointManager, as model3.py does,
+and decides when to stop early on the validation reviews; every worker resumes from its latest checkpoint.
+The parent then evaluates the best checkpoint as model3.py does.
+'''
+
+import sys, os
+import multiprocessing as mp
+import numpy as np
+import tensorflow as tf
+from model3_config import model3_params
+from model3 import (DataSet, prepare_input_for_nn, get_embedding_variable, build_params_nn, get_loss, get_validation_batches, get_prediction,
+                    get_accuracy, get_session_config)
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from system_config import system_params
+from dict_filter import get_esaved
+from prep_data import get_review_data, get_word_embedding, get_embedding_matrix
+from train_utils import prepare_save_path, split_validation, CheckpointManager, get_validation_loss, train_epochs
+
+os.environ["TF_CPP_MIN_LOG_LEVEL"]="3"
+
+# shared array typecodes of the DataSet arrays
+SHARED_TYPES = {'tokens': 'i', 'positions': 'q', 'seq_length': 'i', 'stars': 'f', 'embedding': 'f'}
+DATASET_ARRAYS = ('tokens', 'positions', 'seq_length', 'stars')
+NUMPY_TYPES = {'i': np.int32, 'q': np.int64, 'f': np.float32, 'd': np.float64}
+
+
+def to_shared(ctx, array, typecode):
+    '''
+    Copy an array into a new RawArray, which child processes can map without copying.
+    '''
+    shared = ctx.RawArray(typecode, int(array.size))
+    np.frombuffer(shared, dtype=NUMPY_TYPES[typecode])[:] = array.ravel()
+    return shared
+
+
+def from_shared(shared, typecode, shape):
+    return np.frombuffer(shared, dtype=NUMPY_TYPES[typecode]).reshape(shape)
+
+
+def build_graph(model_params, embedding_shape, bucket_width):
+    '''
+    The placeholders and the network, the same in the workers and in the parent that evaluates.
+    '''
+    graph = {}
+    graph['input_ph'] = tf.placeholder(tf.int32, [None, model_params.num_steps if bucket_width == 0 else None], name='train_input')
+    graph['stars_ph'] = tf.placeholder(tf.float32, [None], name='train_star_input')
+    graph['word_ph'] = tf.placeholder(tf.int32, [None], name='train_label')
+    graph['training'] = tf.placeholder(tf.bool)
+    graph['seq_length_ph'] = tf.placeholder(tf.int32, [None])
+    graph['embedding_ph'], embedding_var = get_embedding_variable(embedding_shape)
+    graph['nn_model'] = build_params_nn(model_params, graph['training'], graph['stars_ph'], graph['input_ph'], graph['seq_length_ph'],
+                                        embedding_shape, embedding_var)
+    graph['loss'] = get_loss(graph['nn_model'], tf.nn.embedding_lookup(embedding_var, graph['word_ph']))
+    return graph
+
+
+def get_gradients(graph, model_params):
+    '''
+    The optimizer, the gradients of the loss and the variables they belong to. The variables the loss does not depend on,
+    e.g. the unused direction of a bidirectional network, have no gradient and are left out.
+    '''
+    optimizer = tf.train.AdamOptimizer(learning_rate=model_params.learning_rate, beta1=0.9, beta2=0.99)
+    grads_and_vars = [(grad, var) for grad, var in optimizer.compute_gradients(graph['loss']) if grad is not None]
+    return optimizer, [grad for grad, var in grads_and_vars], [var for grad, var in grads_and_vars]
+
+
+def get_offsets(variables):
+    '''
+    The shapes of variables, and where each of them starts and ends in a flat array of all of them.
+    '''
+    var_shapes = [var.get_shape().as_list() for var in variables]
+    return var_shapes, np.cumsum([0] + [int(np.prod(shape)) for shape in var_shapes])
+
+
+def count_params(model_params, embedding_shape, bucket_width):
+    '''
+    The number of values of all the trainable variables the workers build, and of the ones with a gradient.
+    '''
+    with tf.Graph().as_default():
+        graph = build_graph(model_params, embedding_shape, bucket_width)
+        _, _, variables = get_gradients(graph, model_params)
+        return int(get_offsets(tf.trainable_variables())[1][-1]), int(get_offsets(variables)[1][-1])
+
+
+class WorkerCheckpointManager(CheckpointManager):
+    '''
+    The CheckpointManager of one worker. Every worker restores the same checkpoint, but only worker 0 saves
+    and decides when to stop early; the others follow its decision through shared memory, so all of them run the same steps.
+    '''
+    def __init__(self, save_path, patience, min_delta, rank, stop, barrier):
+        super(WorkerCheckpointManager, self).__init__(save_path, patience, min_delta)
+        self.rank = rank
+        self.stop = stop
+        self.barrier = barrier
+
+    def save(self, sess, step, epoch_step):
+        if self.rank == 0:
+            super(WorkerCheckpointManager, self).save(sess, step, epoch_step)
+
+    def end_epoch(self, sess, step, val_loss):
+        if self.rank == 0:
+            self.stop[0] = super(WorkerCheckpointManager, self).end_epoch(sess, step, val_loss)
+        self.barrier.wait()
+        return bool(self.stop[0])
+
+
+def train_worker(rank, num_workers, shared, shapes, model_params, bucket_width, steps_per_epoch, barrier, threads, val_arrays=None):
+    '''
+    Train on the samples rank, rank + num_workers, ... for model_params.epoches epochs of steps_per_epoch synchronous steps.
+    Input:
+        shared: the RawArrays of the DataSet, and 'params', 'grads', 'avg', 'losses' and 'stop' for the exchange;
+                'params' holds every trainable variable, 'grads' and 'avg' only the ones with a gradient
+        shapes: the shape of every array in shared
+        val_arrays: the DataSet arrays of the validation samples, given to worker 0 only
+    '''
+    arrays = {name: from_shared(shared[name], SHARED_TYPES[name], shapes[name]) for name in SHARED_TYPES}
+    shard = np.arange(rank, len(arrays['positions']), num_workers)
+    dataset = DataSet(arrays['tokens'], arrays['positions'][shard], arrays['seq_length'][shard], arrays['stars'][shard],
+                      arrays['embedding'], model_params.num_steps, model_params.reverse, training=True, bucket_width=bucket_width)
+
+    graph = build_graph(model_params, shapes['embedding'], bucket_width)
+    optimizer, grads, variables = get_gradients(graph, model_params)
+    grad_phs = [tf.placeholder(tf.float32, var.get_shape()) for var in variables]
+    apply_op = optimizer.apply_gradients(zip(grad_phs, variables))
+    manager = WorkerCheckpointManager(model_params.tf_save_path, model_params.patience, model_params.min_delta, rank,
+                                      from_shared(shared['stop'], 'i', (1,)), barrier)
+    validation_loss = None
+    if val_arrays is not None and len(val_arrays['positions']) > 0:
+        val_dataset = DataSet(*[val_arrays[name] for name in DATASET_ARRAYS], arrays['embedding'], model_params.num_steps, model_params.reverse,
+                              training=False, bucket_width=bucket_width)
+        validation_loss = lambda sess: get_validation_loss(sess, graph['loss'], get_validation_batches(val_dataset, graph['training'], graph['stars_ph'],
+                                                                                                      graph['input_ph'], graph['word_ph'], graph['seq_length_ph']))
+
+    var_shapes, offsets = get_offsets(variables)
+    # every trainable variable, the ones without a gradient included, starts from the values of worker 0
+    all_variables = tf.trainable_variables()
+    all_shapes, all_offsets = get_offsets(all_variables)
+    params = from_shared(shared['params'], 'f', (all_offsets[-1],))
+    all_grads = from_shared(shared['grads'], 'f', (num_workers, offsets[-1]))
+    avg = from_shared(shared['avg'], 'f', (offsets[-1],))
+    losses = from_shared(shared['losses'], 'd', (num_workers,))
+    # the columns this worker averages
+    bounds = np.linspace(0, offsets[-1], num_workers + 1).astype(np.int64)
+    lo, hi = bounds[rank], bounds[rank + 1]
+
+    def init_epoch(sess, skip):
+        # every worker takes steps_per_epoch batches of its shard, the batches trained before resuming are drawn and dropped
+        for i in range(steps_per_epoch):
+            X_batch, y_batch, seq_length_batch, stars_batch = dataset.next_batch(model_params.batch_size)
+            if i >= skip:
+                yield {graph['training']: True, graph['stars_ph']: stars_batch, graph['input_ph']: X_batch, graph['word_ph']: y_batch,
+                       graph['seq_length_ph']: seq_length_batch}
+
+    def train_step(sess, feed_dict):
+        grad_values, cur_loss = sess.run([grads, graph['loss']], feed_dict=feed_dict)
+        for i, value in enumerate(grad_values):
+            all_grads[rank, offsets[i]:offsets[i + 1]] = value.ravel()
+        losses[rank] = cur_loss
+        barrier.wait()
+        avg[lo:hi] = all_grads[:, lo:hi].mean(axis=0)
+        mean_loss = losses.mean()
+        barrier.wait()
+        # avg is only written again after every worker passed the first barrier of the next step
+        sess.run(apply_op, feed_dict={grad_phs[i]: avg[offsets[i]:offsets[i + 1]].reshape(var_shapes[i]) for i in range(len(variables))})
+        return mean_loss
+
+    with tf.Session(config=get_session_config(threads, 1)) as sess:
+        sess.run(tf.global_variables_initializer(), feed_dict={graph['embedding_ph']: arrays['embedding']})
+        # every worker restores the latest checkpoint, the optimizer state included; worker 0 only saves after the first step,
+        # which waits for all of them
+        manager.restore(sess)
+        if rank == 0:
+            params[:] = np.concatenate([value.ravel() for value in sess.run(all_variables)])
+        barrier.wait()
+        if rank != 0:
+            for i, var in enumerate(all_variables):
+                var.load(params[all_offsets[i]:all_offsets[i + 1]].reshape(all_shapes[i]), sess)
+        # only worker 0 prints the loss of the batches, which is the mean over the workers
+        train_epochs(sess, manager, graph['loss'], apply_op, model_params.epoches, init_epoch, log_every=1000 if rank == 0 else 0,
+                     checkpoint_every=model_params.checkpoint_every, validation_loss=validation_loss, train_step=train_step)
+
+
+def train_parallel(dataset, model_params, num_workers, bucket_width=0, val_dataset=None):
+    '''
+    Train on dataset with num_workers processes for model_params.epoches epochs of the samples of the largest shard.
+    The processes are spawned, not forked, so none of them inherits TensorFlow state from the parent.
+    val_dataset: the samples worker 0 computes the validation loss on, to stop early
+    '''
+    ctx = mp.get_context('spawn')
+    arrays = {
+        'tokens': dataset.tokens,
+        'positions': dataset.positions,
+        'seq_length': dataset.seq_length,
+        'stars': dataset.stars,
+        'embedding': dataset.embedding,
+    }
+    shared = {name: to_shared(ctx, arrays[name], SHARED_TYPES[name]) for name in arrays}
+    shapes = {name: arrays[name].shape for name in arrays}
+
+    # count the parameters once, with the graph the workers build
+    num_params, num_trained = count_params(model_params, dataset.embedding.shape, bucket_width)
+    shared['params'] = ctx.RawArray('f', num_params)
+    shared['grads'] = ctx.RawArray('f', num_workers * num_trained)
+    shared['avg'] = ctx.RawArray('f', num_trained)
+    shared['losses'] = ctx.RawArray('d', num_workers)
+    shared['stop'] = ctx.RawArray('i', 1)
+
+    shard_size = (dataset._num_data + num_workers - 1) // num_workers
+    steps_per_epoch = shard_size // model_params.batch_size + 1
+    threads = model_params.intra_op_threads or max(1, os.cpu_count() // num_workers)
+    print('training with {} workers of {} threads, {} of {} parameters trained, {} steps an epoch'.format(num_workers, threads, num_trained, num_params,
+                                                                                                      steps_per_epoch))
+    val_arrays = None
+    if val_dataset is not None:
+        val_arrays = {name: getattr(val_dataset, name) for name in DATASET_ARRAYS}
+
+    barrier = ctx.Barrier(num_workers)
+    workers = [ctx.Process(target=train_worker, args=(rank, num_workers, shared, shapes, model_params, bucket_width, steps_per_epoch, barrier, threads,
+                                                      val_arrays if rank == 0 else None))
+               for rank in range(num_workers)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    if any(worker.exitcode != 0 for worker in workers):
+        raise RuntimeError('a training worker failed')
+
+
+def main():
+    sys_params = system_params()
+    model_params = model3_params()
+    num_workers = model_params.num_workers or os.cpu_count()
+    # the big_fc head flattens all n_steps outputs, so it cannot take trimmed batches
+    bucket_width = 5 if model_params.mode != 'big_fc' else 0
+    prepare_save_path(model_params.tf_save_path, model_params.save_policy)
+
+    wv_model, sentences, stars = get_word_embedding(sys_params.all_reviews_jsonfn, model_params.train_start, model_params.train_end)
+    sentences, stars, val_sentences, val_stars = split_validation(sentences, stars, model_params.validation_fraction)
+    test_sentences, test_stars = get_review_data(sys_params.all_reviews_jsonfn, model_params.test_start, model_params.test_end, shuffle=False, training=False)
+    embedding = get_embedding_matrix(wv_model)
+    dataset = prepare_input_for_nn(wv_model, sentences, model_params.num_steps, stars, model_params.reverse, embedding=embedding, bucket_width=bucket_width)
+    val_dataset = prepare_input_for_nn(wv_model, val_sentences, model_params.num_steps, val_stars, model_params.reverse, training=False,
+                                       embedding=embedding, bucket_width=bucket_width)
+    print("----------------------- DONE WITH GET REVIEW DATA -----------------------")
+
+    train_parallel(dataset, model_params, num_workers, bucket_width, val_dataset)
+    print("----------------------- DONE WITH TRAINING -----------------------")
+
+    graph = build_graph(model_params, embedding.shape, bucket_width)
+    test_true_words, test_pred_words, test_true_ids = get_prediction(graph['seq_length_ph'], graph['training'], wv_model, graph['nn_model'], test_sentences, test_stars,
+                                                                     graph['stars_ph'], graph['input_ph'], model_params.num_steps, model_params.tf_save_path,
+                                                                     model_params.reverse, embedding=embedding, bucket_width=bucket_width, return_ids=True)
+    print("----------------------- DONE WITH PREDICTION -----------------------")
+    acc = get_accuracy(wv_model, test_true_words, test_pred_words, topn=10, true_ids=test_true_ids)
+    print('accuracy = {}'.format(acc))
+    eSaved = get_esaved(wv_model, test_true_words, test_pred_words, topn=1, cons=20, true_ids=test_true_ids)
+    print('eSaved = {}'.format(eSaved))
+
+if __name__ == '__main__':
+    main()
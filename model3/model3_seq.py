@@ -0,0 +1,312 @@
+# model3_seq.py
+
+'''
+Full-sequence training and evaluation for model 3.
+The window model re-encodes up to n_steps previous words from scratch for every target word,
+so a review of length L costs about L x n_steps RNN steps.
+Here a unidirectional RNN runs once over each review (or over truncated-BPTT chunks of it, carrying the state across chunks)
+and predicts the next word from its output at every timestep, so a review costs about L steps.
+The same samples as prepare_input_for_nn are scored: every word in the vocabulary from the 6th word on.
+'''
+
+import sys, os
+import numpy as np
+import tensorflow as tf
+from model3_config import model3_params
+from model3 import get_rnn_cell, get_embedding_variable, get_optimizer, get_accuracy, get_session_config
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from system_config import system_params
+from dict_filter import get_esaved
+from prep_data import get_review_data, get_word_embedding, get_word_ids, get_embedding_matrix
+from train_utils import prepare_save_path, split_validation, CheckpointManager, train_epochs
+
+os.environ["TF_CPP_MIN_LOG_LEVEL"]="3"
+nest = tf.contrib.framework.nest
+
+
+class SequenceDataSet(object):
+    '''
+    This is an object that is holding the id-encoded reviews and generate batches of whole reviews.
+    '''
+    def __init__(self,
+                 tokens,
+                 starts,
+                 lengths,
+                 stars,
+                 embedding,
+                 training=True):
+        '''
+        Input:
+            tokens: int32 array of all reviews concatenated, words not in the vocabulary mapped to the last (zero) row of embedding
+            starts, lengths: where every review is in tokens
+            stars: the stars of every review
+        '''
+        self.tokens = tokens
+        self.starts = starts
+        self.lengths = lengths
+        self.stars = stars
+        self.embedding = embedding
+        self.pad_id = embedding.shape[0] - 1
+        self.training = training
+        self._epochs_completed = 0
+        self._index_in_epoch = 0
+        self._num_data = starts.shape[0]
+        self._curr_order = np.arange(self._num_data)
+
+    def get_batch(self, index):
+        '''
+        Output:
+            ids: the token ids of the reviews, shape (len(index), max length), padded with pad_id
+            lengths, stars: of every review
+        '''
+        lengths = self.lengths[index]
+        offsets = np.arange(lengths.max())
+        valid = offsets < lengths[:, None]
+        token_index = self.starts[index][:, None] + offsets
+        ids = np.where(valid, self.tokens[np.where(valid, token_index, 0)], self.pad_id)
+        return ids, lengths, self.stars[index]
+
+    def next_batch(self, batch_size, shuffle=True):
+        start = self._index_in_epoch
+        if start == 0 and shuffle:
+            np.random.shuffle(self._curr_order)
+        index = self._curr_order[start:start + batch_size]
+        self._index_in_epoch += batch_size
+        if self._index_in_epoch >= self._num_data:
+            self._epochs_completed += 1
+            self._index_in_epoch = 0
+        return self.get_batch(index)
+
+    def iter_batches(self, batch_size):
+        '''
+        Go through the reviews once in order, batch_size at a time.
+        '''
+        for start in range(0, self._num_data, batch_size):
+            yield self.get_batch(np.arange(start, min(start + batch_size, self._num_data)))
+
+
+def prepare_sequences_for_nn(model, sentences, stars, training=True, embedding=None):
+    '''
+    Encode the reviews with at least 5 words as token ids.
+    '''
+    if embedding is None:
+        embedding = get_embedding_matrix(model)
+    pad_id = embedding.shape[0] - 1
+    tokens = []
+    lengths = []
+    stars_list = []
+    for k in range(len(sentences)):
+        ids = get_word_ids(model, sentences[k])
+        # get rid of reviews with smaller than 5 words
+        if len(ids) < 5:
+            continue
+        ids[ids < 0] = pad_id
+        tokens.append(ids)
+        lengths.append(len(ids))
+        stars_list.append(stars[k])
+    lengths = np.array(lengths, dtype=np.int64)
+    starts = np.cumsum(lengths) - lengths
+    tokens = np.concatenate(tokens).astype(np.int32) if tokens else np.zeros(0, dtype=np.int32)
+    return SequenceDataSet(tokens, starts, lengths, np.array(stars_list, dtype=np.float32), embedding, training)
+
+
+def get_chunks(ids, lengths, pad_id, bptt_steps=0):
+    '''
+    Split a batch of reviews into the inputs and targets of consecutive chunks of at most bptt_steps timesteps.
+    The input at timestep t is word t and the target is word t+1,
+    which is scored if it is in the vocabulary and is the 6th word or later.
+    Output:
+        a list of (input ids, target ids, target mask, seq_length) per chunk
+    '''
+    inputs, targets = ids[:, :-1], ids[:, 1:]
+    input_lengths = lengths - 1
+    positions = np.arange(1, ids.shape[1])
+    mask = (positions >= 5) & (positions < lengths[:, None]) & (targets != pad_id)
+    num_steps = inputs.shape[1]
+    if bptt_steps <= 0:
+        bptt_steps = num_steps
+    chunks = []
+    for begin in range(0, num_steps, bptt_steps):
+        end = begin + bptt_steps
+        seq_length = np.clip(input_lengths - begin, 0, bptt_steps)
+        chunks.append((inputs[:, begin:end], targets[:, begin:end], mask[:, begin:end].astype(np.float32), seq_length))
+    return chunks
+
+
+def build_sequence_nn(n_layers, xpu, cell_type, training, stars, input_ph, n_neurons, seq_length_ph, out_size=100, keep_prob=0.5, embedding=None):
+    '''
+    A unidirectional RNN over whole sequences with the dense head of build_nn applied at every timestep.
+    Output:
+        output: the predicted vectors, shape (batch, time, out_size)
+        initial_state: the state the sequences start from, zeros unless fed
+        final_state: the state after the last valid timestep of every sequence, to feed into the next chunk
+    '''
+    if embedding is not None:
+        # input_ph holds token ids
+        input_ph = tf.nn.embedding_lookup(embedding, input_ph)
+    if n_layers == 1:
+        cell = get_rnn_cell(att=False, typ=cell_type, platform=xpu, num_units=n_neurons)
+    else:
+        stacked_cells = [get_rnn_cell(att=False, typ=cell_type, platform=xpu, num_units=n_neurons) for _ in range(n_layers)]
+        cell = tf.contrib.rnn.MultiRNNCell(stacked_cells)
+    initial_state = cell.zero_state(tf.shape(input_ph)[0], tf.float32)
+    outputs, final_state = tf.nn.dynamic_rnn(cell, input_ph, initial_state=initial_state, sequence_length=seq_length_ph)
+
+    # add the star of the review to every timestep
+    stars = tf.tile(tf.reshape(stars, [-1, 1, 1]), [1, tf.shape(outputs)[1], 1])
+    state = tf.concat((outputs, stars), 2)
+    output = tf.layers.dense(inputs=state, units=out_size)
+    output = tf.cond(training, lambda: tf.nn.dropout(output, keep_prob), lambda:output)
+    output = tf.layers.dense(inputs=output, units=out_size)
+    return output, initial_state, final_state
+
+
+def get_sequence_loss(pred_words, true_words, mask):
+    # consine distance at every scored timestep
+    loss = tf.losses.cosine_distance(tf.nn.l2_normalize(pred_words, -1), tf.nn.l2_normalize(true_words, -1), axis=-1, weights=tf.expand_dims(mask, -1))
+    return loss
+
+
+def run_chunks(sess, fetches, feed_dict, chunks, initial_state, final_state, input_ph, word_ph, mask_ph, seq_length_ph):
+    '''
+    Run fetches on every chunk of a batch, starting every chunk from the final state of the one before.
+    Output:
+        the results of fetches for every chunk
+    '''
+    results = []
+    state = None
+    for inputs, targets, mask, seq_length in chunks:
+        feed = dict(feed_dict)
+        feed.update({input_ph: inputs, word_ph: targets, mask_ph: mask, seq_length_ph: seq_length})
+        if state is not None:
+            feed.update(zip(nest.flatten(initial_state), nest.flatten(state)))
+        result, state = sess.run([fetches, final_state], feed_dict=feed)
+        results.append(result)
+    return results
+
+
+def train_sequence_nn(sess, manager, training, stars_ph, input_ph, word_ph, mask_ph, seq_length_ph, initial_state, final_state, loss, train_op, dataset, batch_size, num_epoch, bptt_steps,
+                      checkpoint_every=0, validation_loss=None):
+    '''
+    Train for the epochs manager has not finished yet, every chunk of a batch of reviews one step of train_op.
+    manager: the CheckpointManager of the run, it saves the checkpoints and decides when to stop early
+    validation_loss: a function of the session returning the held-out loss
+    '''
+    num_batches = (dataset._num_data - 1) // batch_size + 1
+    def init_epoch(sess, skip):
+        # the batches trained before resuming are drawn and dropped, so the epoch keeps its length
+        for i in range(num_batches):
+            batch = dataset.next_batch(batch_size)
+            if i >= skip:
+                yield batch
+    def train_step(sess, batch):
+        ids, lengths, stars_batch = batch
+        chunks = get_chunks(ids, lengths, dataset.pad_id, bptt_steps)
+        results = run_chunks(sess, [train_op, loss], {training: True, stars_ph: stars_batch}, chunks, initial_state, final_state, input_ph, word_ph, mask_ph, seq_length_ph)
+        return results[-1][1]
+    train_epochs(sess, manager, loss, train_op, num_epoch, init_epoch, checkpoint_every=checkpoint_every, validation_loss=validation_loss,
+                 train_step=train_step)
+
+
+def get_sequence_validation_loss(sess, training, stars_ph, input_ph, word_ph, mask_ph, seq_length_ph, initial_state, final_state, loss, dataset, batch_size=64, bptt_steps=0):
+    '''
+    The mean of loss over the scored words of the reviews in dataset, the loss of every chunk weighted by its scored words.
+    '''
+    total, num_words = 0.0, 0.0
+    for ids, lengths, stars_batch in dataset.iter_batches(batch_size):
+        chunks = get_chunks(ids, lengths, dataset.pad_id, bptt_steps)
+        results = run_chunks(sess, loss, {training: False, stars_ph: stars_batch}, chunks, initial_state, final_state, input_ph, word_ph, mask_ph, seq_length_ph)
+        for chunk, chunk_loss in zip(chunks, results):
+            total += chunk_loss * chunk[2].sum()
+            num_words += chunk[2].sum()
+    return total / max(num_words, 1)
+
+
+def get_sequence_prediction(sess, training, stars_ph, input_ph, word_ph, mask_ph, seq_length_ph, initial_state, final_state, nn_model, dataset, batch_size=64, bptt_steps=0):
+    '''
+    Predict every scored word of the reviews in dataset, in the same order as get_prediction.
+    Output:
+        test_true_words, test_pred_words: float32 arrays of shape (num samples, vector_size)
+    '''
+    print('begin predicting')
+    true_words = []
+    pred_words = []
+    for ids, lengths, stars_batch in dataset.iter_batches(batch_size):
+        chunks = get_chunks(ids, lengths, dataset.pad_id, bptt_steps)
+        results = run_chunks(sess, nn_model, {training: False, stars_ph: stars_batch}, chunks, initial_state, final_state, input_ph, word_ph, mask_ph, seq_length_ph)
+        mask = np.concatenate([chunk[2] for chunk in chunks], axis=1) > 0
+        targets = np.concatenate([chunk[1] for chunk in chunks], axis=1)
+        # boolean indexing keeps the reviews in order and the positions in order within them
+        pred_words.append(np.concatenate(results, axis=1)[mask])
+        true_words.append(dataset.embedding[targets[mask]])
+    test_true_words, test_pred_words = np.concatenate(true_words), np.concatenate(pred_words)
+    print('test pred word len = {}'.format(len(test_pred_words)))
+    return test_true_words, test_pred_words
+
+
+def main():
+    sys_params = system_params()
+    model_params = model3_params()
+    prepare_save_path(model_params.seq_save_path, model_params.save_policy)
+
+    start_train, end_train = model_params.train_start, model_params.train_end
+    start_test, end_test = model_params.test_start, model_params.test_end
+
+    wv_model, sentences, stars = get_word_embedding(sys_params.all_reviews_jsonfn, start_train, end_train)
+    sentences, stars, val_sentences, val_stars = split_validation(sentences, stars, model_params.validation_fraction)
+    test_sentences, test_stars = get_review_data(sys_params.all_reviews_jsonfn, start_test, end_test, shuffle=False, training=False)
+    embedding = get_embedding_matrix(wv_model)
+    dataset = prepare_sequences_for_nn(wv_model, sentences, stars, embedding=embedding)
+    val_dataset = prepare_sequences_for_nn(wv_model, val_sentences, val_stars, training=False, embedding=embedding)
+    test_dataset = prepare_sequences_for_nn(wv_model, test_sentences, test_stars, training=False, embedding=embedding)
+    print("----------------------- DONE WITH GET REVIEW DATA -----------------------")
+
+    input_ph = tf.placeholder(tf.int32, [None, None], name='train_input')
+    stars_ph = tf.placeholder(tf.float32, [None], name='train_star_input')
+    word_ph = tf.placeholder(tf.int32, [None, None], name='train_label')
+    mask_ph = tf.placeholder(tf.float32, [None, None], name='train_mask')
+    training = tf.placeholder(tf.bool)
+    seq_length_ph = tf.placeholder(tf.int32, [None])
+    embedding_ph, embedding_var = get_embedding_variable(embedding.shape)
+
+    nn_model, initial_state, final_state = build_sequence_nn(
+        model_params.num_layers,
+        model_params.cpu_or_gpu,
+        model_params.cell_type,
+        training,
+        stars_ph,
+        input_ph,
+        model_params.num_neurons,
+        seq_length_ph,
+        out_size=wv_model.vector_size,
+        embedding=embedding_var)
+    loss = get_sequence_loss(nn_model, tf.nn.embedding_lookup(embedding_var, word_ph), mask_ph)
+    train_op = get_optimizer(loss, lr=model_params.learning_rate)
+    manager = CheckpointManager(model_params.seq_save_path, model_params.patience, model_params.min_delta)
+    validation_loss = None
+    if val_dataset._num_data > 0:
+        validation_loss = lambda sess: get_sequence_validation_loss(sess, training, stars_ph, input_ph, word_ph, mask_ph, seq_length_ph, initial_state, final_state, loss,
+                                                                    val_dataset, model_params.batch_size, model_params.bptt_steps)
+    init = tf.global_variables_initializer()
+
+    with tf.Session(config=get_session_config(model_params.intra_op_threads, model_params.inter_op_threads)) as sess:
+        sess.run(init, feed_dict={embedding_ph: embedding})
+        manager.restore(sess)
+        train_sequence_nn(sess, manager, training, stars_ph, input_ph, word_ph, mask_ph, seq_length_ph, initial_state, final_state, loss, train_op,
+                          dataset, model_params.batch_size, model_params.epoches, model_params.bptt_steps,
+                          checkpoint_every=model_params.checkpoint_every, validation_loss=validation_loss)
+        print("----------------------- DONE WITH TRAINING -----------------------")
+        # predict with the checkpoint of the best validation loss, which model3_serving.py serves
+        manager.best_saver.restore(sess, model_params.seq_save_path)
+        test_true_words, test_pred_words = get_sequence_prediction(sess, training, stars_ph, input_ph, word_ph, mask_ph, seq_length_ph, initial_state, final_state,
+                                                                   nn_model, test_dataset, model_params.batch_size, model_params.bptt_steps)
+    print("----------------------- DONE WITH PREDICTION -----------------------")
+    acc = get_accuracy(wv_model, test_true_words, test_pred_words, topn=10)
+    print("----------------------- DONE WITH GET ACCURACY -----------------------")
+    print('accuracy = {}'.format(acc))
+    eSaved = get_esaved(wv_model, test_true_words, test_pred_words, topn=1, cons=20)
+    print("----------------------- DONE WITH GET ESAVED -----------------------")
+    print('eSaved = {}'.format(eSaved))
+
+if __name__ == '__main__':
+    main()
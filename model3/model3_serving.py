@@ -0,0 +1,209 @@
+# model3_serving.py
+
+'''
+Keystroke-by-keystroke completion with model 3.
+Serving uses the unidirectional full-sequence model of model3_seq.py, run one timestep at a time:
+the RNN state after every committed-word prefix is kept in an LRU cache,
+so appending a word costs one RNN step from the cached state of the prefix before it.
+Steps of many concurrent typists are batched into one session run.
+'''
+
+import sys, os
+from collections import OrderedDict
+import numpy as np
+import tensorflow as tf
+import gensim.models.keyedvectors as word2vec
+from model3_config import model3_params
+from model3 import get_embedding_variable, get_session_config
+from model3_seq import build_sequence_nn
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from dict_filter import pred_dict_filter
+from prep_data import get_word_ids
+from system_config import system_params
+from ann_index import use_ann_index
+
+os.environ["TF_CPP_MIN_LOG_LEVEL"]="3"
+nest = tf.contrib.framework.nest
+
+
+class StateCache(object):
+    '''
+    An LRU cache from a (star, word ids...) prefix to the RNN state after it and the predicted next word vector.
+    Entries are evicted, least recently used first, once they take more than max_bytes.
+    '''
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.num_bytes = 0
+        self._entries = OrderedDict()
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        if key not in self._entries:
+            return None
+        self._entries.move_to_end(key)
+        return self._entries[key][0]
+
+    def put(self, key, value):
+        '''
+        value: a (state, pred_word_vec) pair, state a list of per-layer arrays
+        '''
+        if key in self._entries:
+            self.num_bytes -= self._entries.pop(key)[1]
+        state, pred_word_vec = value
+        size = sum(array.nbytes for array in state) + pred_word_vec.nbytes + 8 * len(key)
+        self._entries[key] = (value, size)
+        self.num_bytes += size
+        while self.num_bytes > self.max_bytes and len(self._entries) > 1:
+            _, (_, evicted) = self._entries.popitem(last=False)
+            self.num_bytes -= evicted
+
+
+class Model3Server(object):
+    '''
+    Holds a forward-only step graph restored from a model3_seq.py checkpoint and the state cache.
+    '''
+    def __init__(self, sess, wv_model, model_params, save_path, max_bytes=256 * 2**20, max_batch=1024):
+        self.sess = sess
+        self.wv_model = wv_model
+        self.max_batch = max_batch
+        self.cache = StateCache(max_bytes)
+
+        self.input_ph = tf.placeholder(tf.int32, [None, 1], name='train_input')
+        self.stars_ph = tf.placeholder(tf.float32, [None], name='train_star_input')
+        self.seq_length_ph = tf.placeholder(tf.int32, [None])
+        training = tf.constant(False)
+        _, embedding_var = get_embedding_variable((len(wv_model.wv.vectors) + 1, wv_model.vector_size))
+        self.nn_model, initial_state, final_state = build_sequence_nn(
+            model_params.num_layers,
+            model_params.cpu_or_gpu,
+            model_params.cell_type,
+            training,
+            self.stars_ph,
+            self.input_ph,
+            model_params.num_neurons,
+            self.seq_length_ph,
+            out_size=wv_model.vector_size,
+            embedding=embedding_var)
+        self.initial_state = nest.flatten(initial_state)
+        self.final_state = nest.flatten(final_state)
+        saver = tf.train.Saver()
+        saver.restore(sess, save_path)
+        # the state before the first word, batch of one
+        self.zero_state = sess.run(self.initial_state, feed_dict={self.input_ph: np.zeros((1, 1), dtype=np.int32)})
+        self.pad_id = len(wv_model.wv.vectors)
+
+    def _step(self, keys, computed):
+        '''
+        Run one RNN step for every key from the state of its prefix, which is in computed.
+        '''
+        states = []
+        for key in keys:
+            parent = key[:-1]
+            if len(parent) == 1:
+                states.append(self.zero_state)
+            else:
+                states.append(computed[parent][0])
+        feed = {
+            self.input_ph: np.array([[key[-1]] for key in keys]),
+            self.stars_ph: np.array([key[0] for key in keys], dtype=np.float32),
+            self.seq_length_ph: np.ones(len(keys), dtype=np.int32),
+        }
+        for i, state_ph in enumerate(self.initial_state):
+            feed[state_ph] = np.concatenate([state[i] for state in states], axis=0)
+        pred_words, final_state = self.sess.run([self.nn_model, self.final_state], feed_dict=feed)
+        for j, key in enumerate(keys):
+            value = ([layer[j:j + 1].copy() for layer in final_state], pred_words[j, 0].copy())
+            computed[key] = value
+            self.cache.put(key, value)
+
+    def predict_vectors(self, contexts):
+        '''
+        Predict the next word vector for a batch of contexts.
+        Input:
+            contexts: a list of (star, word ids) pairs, word ids the committed words of a review
+        Output:
+            a list of predicted vectors, None for contexts without words
+        '''
+        keys = [(star,) + tuple(int(i) for i in ids) for star, ids in contexts]
+        # walk back from every key to its longest cached prefix, every prefix on the way has to be computed.
+        # cached values are held in computed, so evictions while stepping cannot lose them
+        computed = {}
+        todo = set()
+        for key in keys:
+            while len(key) > 1 and key not in computed and key not in todo:
+                value = self.cache.get(key)
+                if value is not None:
+                    computed[key] = value
+                    break
+                todo.add(key)
+                key = key[:-1]
+        for length in sorted(set(len(key) for key in todo)):
+            level = [key for key in todo if len(key) == length]
+            for start in range(0, len(level), self.max_batch):
+                self._step(level[start:start + self.max_batch], computed)
+        return [computed[key][1] if len(key) > 1 else None for key in keys]
+
+
+class Model3Session(object):
+    '''
+    The state of one review being typed, served by a Model3Server.
+    '''
+    def __init__(self, server, star):
+        self.server = server
+        self.star = star
+        self.word_ids = []
+
+    def commit(self, word):
+        '''
+        Add a finished word to the context, words not in the vocabulary use the padding id like in training.
+        '''
+        word_id = get_word_ids(self.server.wv_model, [word])[0]
+        self.word_ids.append(word_id if word_id >= 0 else self.server.pad_id)
+
+    def predict(self, inputs='', topn=2, cons=200):
+        '''
+        Predict the word being typed, given the characters typed so far.
+        Output:
+            The predicted words as a list, empty before the first word is committed.
+        '''
+        pred_word_vec = self.server.predict_vectors([(self.star, self.word_ids)])[0]
+        if pred_word_vec is None:
+            return []
+        return pred_dict_filter(self.server.wv_model, inputs, pred_word_vec, topn=topn, cons=cons)
+
+
+def main():
+    sys_params = system_params()
+    model_params = model3_params()
+    wv_model = word2vec.KeyedVectors.load_word2vec_format('glove.6B.100d.txt', binary=False)
+    if os.path.isfile(sys_params.ann_index_path):
+        use_ann_index(wv_model, sys_params.ann_index_path, sys_params.ann_nprobe, sys_params.ann_rerank)
+
+    with tf.Session(config=get_session_config(model_params.intra_op_threads, model_params.inter_op_threads)) as sess:
+        server = Model3Server(sess, wv_model, model_params, model_params.seq_save_path, max_bytes=model_params.cache_max_bytes)
+        while True:
+            rate = input("Please give a rating in the scale of 5:\n")
+            rate = int(rate)
+            assert(rate >= 1 and rate <= 5)
+            session = Model3Session(server, rate)
+            print("Please type the review, an empty line starts a new one")
+            while True:
+                # every line continues the review, the last word is still being typed unless followed by a space
+                line = input().lower()
+                if line == '':
+                    break
+                words = line.split()
+                inputs = ''
+                if not line.endswith(' ') and len(words) > 0:
+                    inputs = words.pop()
+                for word in words:
+                    session.commit(word)
+                print(session.predict(inputs))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,205 @@
+# model3_sweep.py
+
+'''
+Hyperparameter sweep of the window model of model3.py over model3_params.sweep_grid.
+The reviews are read, the word embedding loaded and prepare_input_for_nn run once by the parent, which writes the
+DataSet arrays and the word embedding to model3_params.sweep_folder. A pool of worker processes then trains one
+combination each, mapping those files read-only instead of preparing the data again, and evaluates it on the test reviews.
+Every finished combination is appended to results.csv in the sweep folder:
+its values, the best validation loss, accuracy, eSaved and the wall time of training and evaluation.
+Every combination checkpoints to its own folder under the sweep folder with the save policy of model3_params,
+so with 'resume' an interrupted sweep continues the combinations it did not finish.
+A combination that already has a row without an error in results.csv is not trained or evaluated again.
+'''
+
+import sys, os, time, csv, itertools
+import multiprocessing as mp
+import numpy as np
+import tensorflow as tf
+import gensim.models.keyedvectors as word2vec
+from model3_config import model3_params
+from model3 import (DataSet, prepare_input_for_nn, get_input_pipeline, get_embedding_variable, build_params_nn, get_loss, get_optimizer,
+                    train_nn, get_validation_batches, get_dataset_prediction, get_accuracy, get_session_config)
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from system_config import system_params
+from dict_filter import get_esaved
+from prep_data import get_review_data, get_word_embedding, get_embedding_matrix
+from train_utils import prepare_save_path, split_validation, CheckpointManager, get_validation_loss
+
+os.environ["TF_CPP_MIN_LOG_LEVEL"]="3"
+
+# the data is prepared once with these, so they cannot be swept
+DATA_PARAMS = ('num_steps', 'train_size', 'train_start', 'train_end', 'test_size', 'test_start', 'test_end', 'validation_fraction')
+DATASET_ARRAYS = ('tokens', 'positions', 'seq_length', 'stars')
+BUCKET_WIDTH = 5
+
+
+def get_configs(grid):
+    '''
+    Every combination of the values of grid, as a list of {field: value} dicts.
+    '''
+    fields = sorted(grid)
+    model_params = model3_params()
+    for field in fields:
+        if field in DATA_PARAMS:
+            raise ValueError('{} is fixed by the shared data and cannot be swept'.format(field))
+        if not hasattr(model_params, field):
+            raise ValueError('{} is not a field of model3_params'.format(field))
+    return [dict(zip(fields, values)) for values in itertools.product(*[grid[field] for field in fields])]
+
+
+def save_dataset(folder, name, dataset):
+    for array in DATASET_ARRAYS:
+        np.save(os.path.join(folder, '{}_{}.npy'.format(name, array)), getattr(dataset, array))
+
+
+def load_dataset(folder, name, embedding, n_steps, reverse, training, bucket_width):
+    '''
+    A DataSet over the arrays written by save_dataset, mapped read-only, so every worker shares the pages of one copy.
+    '''
+    arrays = [np.load(os.path.join(folder, '{}_{}.npy'.format(name, array)), mmap_mode='r') for array in DATASET_ARRAYS]
+    return DataSet(*arrays, embedding, n_steps, reverse, training, bucket_width)
+
+
+def prepare_sweep_data(folder, model_params, sys_params):
+    '''
+    Read the reviews, load the word embedding and write the train, validation and test DataSet arrays,
+    the embedding matrix and the word embedding to folder.
+    '''
+    os.makedirs(folder, exist_ok=True)
+    wv_model, sentences, stars = get_word_embedding(sys_params.all_reviews_jsonfn, model_params.train_start, model_params.train_end)
+    sentences, stars, val_sentences, val_stars = split_validation(sentences, stars, model_params.validation_fraction)
+    test_sentences, test_stars = get_review_data(sys_params.all_reviews_jsonfn, model_params.test_start, model_params.test_end, shuffle=False, training=False)
+    embedding = get_embedding_matrix(wv_model)
+    for name, name_sentences, name_stars in [('train', sentences, stars), ('val', val_sentences, val_stars), ('test', test_sentences, test_stars)]:
+        dataset = prepare_input_for_nn(wv_model, name_sentences, model_params.num_steps, name_stars, embedding=embedding)
+        save_dataset(folder, name, dataset)
+        print('{} samples: {}'.format(name, dataset._num_data))
+    np.save(os.path.join(folder, 'embedding.npy'), embedding)
+    wv_model.save(os.path.join(folder, 'wv.kv'))
+
+
+def train_config(args):
+    '''
+    Train and evaluate one combination in a worker process.
+    Input:
+        args: (number of the combination, its values, the sweep folder, the session threads)
+    Output:
+        the row of results.csv, with the error instead of the scores if the combination failed
+    '''
+    index, config, folder, threads = args
+    row = dict(config, index=index)
+    try:
+        model_params = model3_params()
+        for field, value in config.items():
+            setattr(model_params, field, value)
+        n_steps, reverse = model_params.num_steps, model_params.reverse
+        # the big_fc head flattens all n_steps outputs, so it cannot take trimmed batches
+        bucket_width = BUCKET_WIDTH if model_params.mode != 'big_fc' else 0
+        session_config = get_session_config(threads, 1)
+        save_path = os.path.join(folder, 'config_{}'.format(index), 'm.cpkt')
+        prepare_save_path(save_path, model_params.save_policy)
+
+        embedding = np.load(os.path.join(folder, 'embedding.npy'), mmap_mode='r')
+        dataset = load_dataset(folder, 'train', embedding, n_steps, reverse, True, bucket_width)
+        val_dataset = load_dataset(folder, 'val', embedding, n_steps, reverse, False, bucket_width)
+        test_dataset = load_dataset(folder, 'test', embedding, n_steps, reverse, False, bucket_width)
+
+        iterator, pipeline_feed = get_input_pipeline(dataset, model_params.batch_size, shuffle_buffer=model_params.shuffle_buffer,
+                                                     prefetch=model_params.prefetch, num_parallel_calls=model_params.num_parallel_calls)
+        batch_inputs, batch_words, batch_seq_length, batch_stars = iterator.get_next()
+        input_ph = tf.placeholder_with_default(batch_inputs, [None, n_steps if bucket_width == 0 else None], name='train_input')
+        stars_ph = tf.placeholder_with_default(batch_stars, [None], name='train_star_input')
+        word_ph = tf.placeholder_with_default(batch_words, [None], name='train_label')
+        training = tf.placeholder(tf.bool)
+        seq_length_ph = tf.placeholder_with_default(batch_seq_length, [None])
+        embedding_ph, embedding_var = get_embedding_variable(embedding.shape)
+        nn_model = build_params_nn(model_params, training, stars_ph, input_ph, seq_length_ph, embedding.shape, embedding_var)
+        loss = get_loss(nn_model, tf.nn.embedding_lookup(embedding_var, word_ph))
+        train_op = get_optimizer(loss, lr=model_params.learning_rate)
+        manager = CheckpointManager(save_path, model_params.patience, model_params.min_delta)
+        validation_loss = None
+        if val_dataset._num_data > 0:
+            validation_loss = lambda sess: get_validation_loss(sess, loss, get_validation_batches(val_dataset, training, stars_ph, input_ph, word_ph, seq_length_ph))
+
+        start = time.time()
+        with tf.Session(config=session_config) as sess:
+            sess.run(tf.global_variables_initializer(), feed_dict={embedding_ph: embedding})
+            manager.restore(sess)
+            train_nn(sess, manager, training, loss, train_op, iterator, pipeline_feed, model_params.epoches,
+                     checkpoint_every=model_params.checkpoint_every, validation_loss=validation_loss)
+        row['train_time'] = time.time() - start
+
+        start = time.time()
+        test_true_words, test_pred_words = get_dataset_prediction(seq_length_ph, training, nn_model, test_dataset, stars_ph, input_ph, save_path,
+                                                                  session_config=session_config)
+        wv_model = word2vec.KeyedVectors.load(os.path.join(folder, 'wv.kv'), mmap='r')
+        row['val_loss'] = manager.state['best_loss']
+        test_true_ids = test_dataset.tokens[test_dataset.positions]
+        row['accuracy'] = get_accuracy(wv_model, test_true_words, test_pred_words, topn=10, true_ids=test_true_ids)
+        row['eSaved'] = get_esaved(wv_model, test_true_words, test_pred_words, topn=1, cons=20, true_ids=test_true_ids)
+        row['eval_time'] = time.time() - start
+    except Exception as e:
+        print('combination {} failed: {!r}'.format(index, e))
+        row['error'] = repr(e)
+    return row
+
+
+def get_finished(results_path):
+    '''
+    The numbers of the combinations results.csv holds the scores of, empty if there is no results.csv yet.
+    '''
+    if not os.path.isfile(results_path):
+        return set()
+    with open(results_path, newline='') as f:
+        return {int(row['index']) for row in csv.DictReader(f) if not row['error']}
+
+
+def run_sweep(configs, folder, num_workers, threads=0):
+    '''
+    Train the combinations with num_workers processes and append every finished one to folder/results.csv,
+    leaving out the ones a sweep before this one finished.
+    The processes are spawned, not forked, and every one trains a single combination, so no TensorFlow graph
+    or session outlives the combination it was built for.
+    Output:
+        the rows of the combinations trained by this sweep, in the order they finished
+    '''
+    threads = threads or max(1, os.cpu_count() // num_workers)
+    fields = ['index'] + sorted(configs[0]) + ['val_loss', 'accuracy', 'eSaved', 'train_time', 'eval_time', 'error']
+    results_path = os.path.join(folder, 'results.csv')
+    finished = get_finished(results_path)
+    todo = [(index, config, folder, threads) for index, config in enumerate(configs) if index not in finished]
+    print('training {} of {} combinations with {} workers of {} threads'.format(len(todo), len(configs), num_workers, threads))
+    rows = []
+    ctx = mp.get_context('spawn')
+    # a resumed sweep appends to the rows of the run before it
+    new_file = not os.path.isfile(results_path) or os.path.getsize(results_path) == 0
+    with open(results_path, 'a', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=fields)
+        if new_file:
+            writer.writeheader()
+        with ctx.Pool(num_workers, maxtasksperchild=1) as pool:
+            for row in pool.imap_unordered(train_config, todo):
+                writer.writerow(row)
+                f.flush()
+                rows.append(row)
+                print('finished {} of {} combinations'.format(len(rows), len(todo)))
+    return rows
+
+
+def main():
+    sys_params = system_params()
+    model_params = model3_params()
+    folder = model_params.sweep_folder
+    configs = get_configs(model_params.sweep_grid)
+
+    prepare_sweep_data(folder, model_params, sys_params)
+    print("----------------------- DONE WITH GET REVIEW DATA -----------------------")
+
+    rows = run_sweep(configs, folder, model_params.sweep_workers, model_params.intra_op_threads)
+    print("----------------------- DONE WITH SWEEP -----------------------")
+    for row in sorted(rows, key=lambda row: -row.get('accuracy', -1)):
+        print(row)
+
+if __name__ == '__main__':
+    main()
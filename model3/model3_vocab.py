@@ -0,0 +1,159 @@
+# model3_vocab.py
+
+'''
+Decoding with the vocabulary head of model 3 (model3_params.vocab_head_size > 0).
+The head scores the predicted vector of build_nn against one weight row per word of the head vocabulary,
+the most frequent words of the word embedding sorted alphabetically,
+so the words starting with a typed prefix are one contiguous slice of the rows.
+The top-k is then one small matmul and an argpartition, instead of most_similar over the whole embedding.
+Only reading the checkpoint imports TensorFlow.
+Usage:
+    python model3/model3_vocab.py
+exports the head of the checkpoint of model3.py for serving.
+'''
+
+import sys, os
+import numpy as np
+import gensim.models.keyedvectors as word2vec
+from model3_config import model3_params
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from dict_filter import get_prefix_range
+
+os.environ["TF_CPP_MIN_LOG_LEVEL"]="3"
+
+
+def get_head_vocab(wv_model, size):
+    '''
+    The ids of the size most frequent words, ordered by the words.
+    The word embedding lists its words from the most to the least frequent, so those are the first size ids.
+    '''
+    words = wv_model.wv.index2word[:size]
+    return np.array(sorted(range(len(words)), key=lambda i: words[i]), dtype=np.int32)
+
+
+def _top_indices(scores, k):
+    # the indices of the k largest scores, largest first
+    if k < len(scores):
+        top = np.argpartition(-scores, k - 1)[:k]
+    else:
+        top = np.arange(len(scores))
+    return top[np.argsort(-scores[top], kind='stable')]
+
+
+class VocabDecoder(object):
+    '''
+    The vocabulary head outside the graph: logits = pred_word_vec . weights^T + biases over the head words.
+    '''
+    def __init__(self, words, ids, weights, biases, dtype=np.float32):
+        '''
+        Input:
+            words: the head words, sorted
+            ids: the word embedding id of every head word
+            weights, biases: the head variables, one row per head word
+        '''
+        self.words = list(words)
+        self.ids = np.asarray(ids)
+        self.weights = np.ascontiguousarray(weights, dtype=dtype)
+        self.biases = np.asarray(biases, dtype=dtype)
+        self.dtype = dtype
+        # the head position of every word embedding id, -1 if it is not in the head
+        self.position = np.full(int(self.ids.max()) + 2 if len(self.ids) else 1, -1, dtype=np.int64)
+        self.position[self.ids] = np.arange(len(self.ids))
+
+    @classmethod
+    def from_checkpoint(cls, wv_model, save_path, dtype=np.float32):
+        import tensorflow as tf
+        reader = tf.train.load_checkpoint(save_path)
+        ids = reader.get_tensor('vocab_head/ids')
+        words = [wv_model.wv.index2word[i] for i in ids]
+        return cls(words, ids, reader.get_tensor('vocab_head/weights'), reader.get_tensor('vocab_head/biases'), dtype)
+
+    def save(self, npz_path):
+        np.savez(npz_path, words=np.array(self.words), ids=self.ids, weights=self.weights, biases=self.biases)
+
+    @classmethod
+    def load(cls, npz_path, dtype=np.float32):
+        with np.load(npz_path) as f:
+            return cls([str(word) for word in f['words']], f['ids'], f['weights'], f['biases'], dtype)
+
+    def get_positions(self, word_ids):
+        '''
+        The head position of every word embedding id, -1 for ids outside the head.
+        '''
+        word_ids = np.asarray(word_ids)
+        inside = (word_ids >= 0) & (word_ids < len(self.position))
+        return np.where(inside, self.position[np.where(inside, word_ids, 0)], -1)
+
+    def logits(self, pred_words, start=0, end=None):
+        '''
+        The logits of the head words in [start, end) for a batch of predicted vectors, shape (batch, end - start).
+        '''
+        end = len(self.words) if end is None else end
+        pred_words = np.asarray(pred_words, dtype=self.dtype)
+        return np.dot(pred_words, self.weights[start:end].T) + self.biases[start:end]
+
+    def topk(self, pred_word_vec, k=10, prefix=''):
+        '''
+        Input:
+            pred_word_vec: the predicted vector of one window
+            k: the number of words to return
+            prefix: only return words starting with it
+        Output:
+            The k most likely head words starting with prefix, most likely first.
+        '''
+        start, end = get_prefix_range(self.words, prefix)
+        if start == end:
+            return []
+        scores = self.logits(pred_word_vec[None], start, end)[0]
+        return [self.words[start + i] for i in _top_indices(scores, k)]
+
+    def topk_positions(self, pred_words, k=10):
+        '''
+        The head positions of the k most likely words of every predicted vector, shape (batch, k), unordered.
+        '''
+        scores = self.logits(pred_words)
+        if k >= scores.shape[1]:
+            return np.tile(np.arange(scores.shape[1]), (len(scores), 1))
+        return np.argpartition(-scores, k - 1, axis=1)[:, :k]
+
+
+def get_vocab_accuracy(decoder, true_ids, pred_words, topn=10, batch_size=1024):
+    '''
+    The fraction of windows whose true word is among the topn words of the head, words outside the head count as misses.
+    '''
+    print('begin getting accuracy with the vocabulary head')
+    positions = decoder.get_positions(true_ids)
+    correct = 0
+    for start in range(0, len(pred_words), batch_size):
+        top = decoder.topk_positions(pred_words[start:start + batch_size], topn)
+        correct += int(np.sum(np.any(top == positions[start:start + batch_size, None], axis=1)))
+    return correct / len(true_ids)
+
+
+def get_vocab_esaved(decoder, true_ids, pred_words, topn=1):
+    '''
+    The eSaved of get_esaved, with the candidates of every typed prefix taken from the head words starting with it.
+    '''
+    print('begin getting eSaved with the vocabulary head')
+    eSaved = 0
+    for i in range(len(true_ids)):
+        position = decoder.get_positions([true_ids[i]])[0]
+        if position < 0:
+            continue
+        true_word = decoder.words[position]
+        for j in range(len(true_word)):
+            if true_word in decoder.topk(pred_words[i], topn, true_word[:j + 1]):
+                eSaved += 1 - (j + 1) / (len(true_word) + 1)
+                break
+    return eSaved / len(true_ids)
+
+
+def main():
+    model_params = model3_params()
+    wv_model = word2vec.KeyedVectors.load_word2vec_format('glove.6B.100d.txt', binary=False)
+    decoder = VocabDecoder.from_checkpoint(wv_model, model_params.tf_save_path)
+    decoder.save(model_params.vocab_npz_path)
+    print('exported {} head words to {}'.format(len(decoder.words), model_params.vocab_npz_path))
+
+if __name__ == '__main__':
+    main()
@@ -5,7 +5,6 @@ from operator import itemgetter
 import json, sys, shutil, os
 import numpy as np
 import nltk
-import tensorflow as tf
 from gensim.models import Word2Vec
 import gensim.models.keyedvectors as word2vec
 
@@ -63,6 +62,23 @@ def get_word_embedding(filename, start_train, end_train, use_glove=True):
 
     return model, sentences, stars
 
+def get_word_ids(model, sentence):
+    '''
+    Map a tokenized sentence to row indices of the embedding matrix, -1 for words not in the vocabulary.
+    '''
+    vocab = model.wv.vocab
+    return np.array([vocab[word].index if word in vocab else -1 for word in sentence], dtype=np.int64)
+
+def get_embedding_matrix(model):
+    '''
+    The embedding matrix of the model with one extra row of zeros at the end,
+    used for padding and for words not in the vocabulary.
+    '''
+    vectors = model.wv.vectors
+    embedding = np.zeros((vectors.shape[0] + 1, vectors.shape[1]), dtype=np.float32)
+    embedding[:-1] = vectors
+    return embedding
+
 
 # Reference: https://stackoverflow.com/questions/4576077/python-split-text-on-sentences
 import re
@@ -2,3 +2,10 @@
 class system_params:
     def __init__(self):
         self.all_reviews_jsonfn = 'large_dataset_12000.json'
+        # the approximate nearest-neighbour index of ann_index.py, the serving scripts decode through it if the file exists
+        self.ann_index_path = 'glove.6B.100d.ivf.npz'
+        self.ann_num_lists = 1024
+        # product quantize the residuals with this many subspaces, 0 to score the stored vectors
+        self.ann_num_subspaces = 0
+        self.ann_nprobe = 16
+        self.ann_rerank = 0
@@ -0,0 +1,13 @@
+# conftest.py
+
+'''
+The scripts import their siblings directly, so the root and every model folder go on the path, as when running them.
+'''
+
+import sys, os
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for folder in ['', 'model1', 'model2', 'model3']:
+    path = os.path.join(ROOT, folder)
+    if path not in sys.path:
+        sys.path.append(path)
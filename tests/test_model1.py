@@ -0,0 +1,42 @@
+# test_model1.py
+
+'''
+The beam search of Language_Model.complete_phrase.
+'''
+
+import pytest
+
+pytest.importorskip('nltk')
+pytest.importorskip('gensim')
+pytest.importorskip('pygtrie')
+from collections import Counter
+from model1 import Language_Model
+
+
+@pytest.fixture
+def lm():
+    # a -> b (3), a -> c (1), b -> d (2), c -> e (1), d and e end every phrase
+    ngrams = [('a', 'b')] * 3 + [('a', 'c')] + [('b', 'd')] * 2 + [('c', 'e')]
+    voc_set = Counter({'a': 4, 'b': 3, 'c': 1, 'd': 2, 'e': 1})
+    return Language_Model(ngrams, 2, voc_set)
+
+
+def test_ranking(lm):
+    assert lm.complete_phrase(['a'], max_len=2, beam_width=2, min_prob=0.01) == [['b', 'd'], ['c', 'e']]
+
+
+def test_phrase_ends_without_continuation(lm):
+    # only the last n - 1 words are the context, and nothing follows d
+    assert lm.complete_phrase(['x', 'b'], max_len=5, beam_width=2, min_prob=0.01) == [['d']]
+
+
+def test_min_prob_cuts_off(lm):
+    assert lm.complete_phrase(['a'], max_len=2, beam_width=2, min_prob=0.5) == [['b', 'd']]
+
+
+def test_unseen_context(lm):
+    assert lm.complete_phrase(['z'], max_len=3) == []
+
+
+def test_zero_length(lm):
+    assert lm.complete_phrase(['a'], max_len=0) == []
@@ -0,0 +1,60 @@
+# test_model3_distill.py
+
+'''
+The teacher of model3_distill.py restores a checkpoint trained the way model3.py trains it.
+'''
+
+import pytest
+import numpy as np
+
+tf = pytest.importorskip('tensorflow')
+if not hasattr(tf, 'contrib'):
+    pytest.skip('model 3 needs TensorFlow 1.x', allow_module_level=True)
+pytest.importorskip('gensim')
+from model3_config import model3_params
+from model3 import DataSet, get_embedding_variable, build_params_nn, get_loss, get_optimizer
+from model3_distill import get_teacher_predictions
+from train_utils import CheckpointManager
+
+VOCAB_SIZE, VECTOR_SIZE, NUM_STEPS = 20, 6, 4
+
+
+def test_teacher_restores_checkpoint(tmp_path):
+    model_params = model3_params()
+    model_params.num_steps = NUM_STEPS
+    model_params.num_layers = 2
+    model_params.num_neurons = 5
+    model_params.cpu_or_gpu = 'cpu'
+    save_path = str(tmp_path / 'm.cpkt')
+
+    rng = np.random.RandomState(0)
+    embedding = rng.randn(VOCAB_SIZE, VECTOR_SIZE).astype(np.float32)
+    embedding[-1] = 0
+    tokens = rng.randint(0, VOCAB_SIZE - 1, 60).astype(np.int32)
+    positions = np.arange(5, 60)
+    dataset = DataSet(tokens, positions, np.minimum(positions, NUM_STEPS).astype(np.int32), rng.randint(1, 6, len(positions)).astype(np.float32),
+                      embedding, NUM_STEPS, model_params.reverse, training=False)
+
+    with tf.Graph().as_default():
+        input_ph = tf.placeholder(tf.int32, [None, NUM_STEPS])
+        stars_ph = tf.placeholder(tf.float32, [None])
+        word_ph = tf.placeholder(tf.int32, [None])
+        training = tf.placeholder(tf.bool)
+        seq_length_ph = tf.placeholder(tf.int32, [None])
+        embedding_ph, embedding_var = get_embedding_variable(embedding.shape)
+        nn_model = build_params_nn(model_params, training, stars_ph, input_ph, seq_length_ph, embedding.shape, embedding_var)
+        train_op = get_optimizer(get_loss(nn_model, tf.nn.embedding_lookup(embedding_var, word_ph)))
+        manager = CheckpointManager(save_path)
+        X_batch, y_batch, seq_length_batch, stars_batch = dataset.get_batch(np.arange(dataset._num_data))
+        feed_dict = {stars_ph: stars_batch, input_ph: X_batch, word_ph: y_batch, seq_length_ph: seq_length_batch}
+        with tf.Session() as sess:
+            sess.run(tf.global_variables_initializer(), feed_dict={embedding_ph: embedding})
+            for _ in range(3):
+                sess.run(train_op, feed_dict={training: True, **feed_dict})
+            expected = sess.run(nn_model, feed_dict={training: False, **feed_dict})
+            # writes the best checkpoint to save_path, which the teacher restores
+            manager.end_epoch(sess, 3, None)
+
+    (predictions,), latency = get_teacher_predictions(model_params, save_path, [dataset], 2)
+    np.testing.assert_allclose(predictions, expected, rtol=1e-5, atol=1e-5)
+    assert latency > 0
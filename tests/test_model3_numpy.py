@@ -0,0 +1,100 @@
+# test_model3_numpy.py
+
+'''
+The NumPy runtime of model 3: the variables export_npz reads from a checkpoint, and its predictions against the graph of build_nn.
+'''
+
+import pytest
+import numpy as np
+
+pytest.importorskip('gensim')
+from model3_numpy import RNN_VARIABLE, NumpyRNN, export_npz
+
+VOCAB_SIZE, VECTOR_SIZE, NUM_NEURONS, NUM_STEPS = 20, 6, 5, 4
+
+
+@pytest.mark.parametrize('name', [
+    'rnn/basic_rnn_cell/kernel',
+    'rnn/multi_rnn_cell/cell_1/lstm_cell/bias',
+    'bidirectional_rnn/bw/multi_rnn_cell/cell_0/gru_cell/gates/kernel',
+    'bidirectional_rnn/fw/gru_cell/candidate/bias',
+    'rnn/multi_rnn_cell/cell_2/cudnn_compatible_gru_cell/candidate/hidden_projection/kernel',
+])
+def test_cell_variables_match(name):
+    assert RNN_VARIABLE.match(name) is not None
+
+
+@pytest.mark.parametrize('name', [
+    'rnn/multi_rnn_cell/cell_0/lstm_cell/kernel/Adam',
+    'rnn/multi_rnn_cell/cell_0/lstm_cell/kernel/Adam_1',
+    'bidirectional_rnn/bw/gru_cell/gates/bias/Adam',
+    'dense/kernel',
+])
+def test_other_variables_do_not_match(name):
+    assert RNN_VARIABLE.match(name) is None
+
+
+def get_windows(rng, batch_size):
+    window_ids = rng.randint(0, VOCAB_SIZE, (batch_size, NUM_STEPS))
+    seq_length = rng.randint(1, NUM_STEPS + 1, batch_size).astype(np.int32)
+    stars = rng.randint(1, 6, batch_size).astype(np.float32)
+    return window_ids, seq_length, stars
+
+
+def test_basic_rnn_forward():
+    # one tanh layer written out step by step
+    rng = np.random.RandomState(0)
+    embedding = rng.randn(VOCAB_SIZE, VECTOR_SIZE).astype(np.float32)
+    kernel = rng.randn(VECTOR_SIZE + NUM_NEURONS, NUM_NEURONS).astype(np.float32) * 0.3
+    bias = rng.randn(NUM_NEURONS).astype(np.float32)
+    head_kernels = [rng.randn(NUM_NEURONS + 1, VECTOR_SIZE).astype(np.float32), rng.randn(VECTOR_SIZE, VECTOR_SIZE).astype(np.float32)]
+    head_biases = [rng.randn(VECTOR_SIZE).astype(np.float32), rng.randn(VECTOR_SIZE).astype(np.float32)]
+    rnn = NumpyRNN('rnn', [{'kernel': kernel, 'bias': bias}], head_kernels, head_biases, embedding)
+    window_ids, seq_length, stars = get_windows(rng, 7)
+
+    expected = []
+    for ids, length, star in zip(window_ids, seq_length, stars):
+        h = np.zeros(NUM_NEURONS, dtype=np.float32)
+        for t in range(length):
+            h = np.tanh(np.dot(np.concatenate([embedding[ids[t]], h]), kernel) + bias)
+        output = np.dot(np.append(h, star), head_kernels[0]) + head_biases[0]
+        expected.append(np.dot(output, head_kernels[1]) + head_biases[1])
+    np.testing.assert_allclose(rnn(window_ids, seq_length, stars), np.array(expected), rtol=1e-4, atol=1e-4)
+
+
+@pytest.mark.parametrize('cell_type, bidirection', [('lstm', False), ('gru', True), ('rnn', False)])
+def test_matches_tensorflow(tmp_path, cell_type, bidirection):
+    tf = pytest.importorskip('tensorflow')
+    if not hasattr(tf, 'contrib'):
+        pytest.skip('model 3 needs TensorFlow 1.x')
+    from model3 import build_nn, get_embedding_variable, get_loss, get_optimizer
+    rng = np.random.RandomState(1)
+    embedding = rng.randn(VOCAB_SIZE, VECTOR_SIZE).astype(np.float32)
+    window_ids, seq_length, stars = get_windows(rng, 16)
+    true_words = rng.randn(16, VECTOR_SIZE).astype(np.float32)
+    save_path = str(tmp_path / 'm.cpkt')
+    npz_path = str(tmp_path / 'm.npz')
+
+    with tf.Graph().as_default():
+        input_ph = tf.placeholder(tf.int32, [None, None])
+        stars_ph = tf.placeholder(tf.float32, [None])
+        training = tf.placeholder(tf.bool)
+        seq_length_ph = tf.placeholder(tf.int32, [None])
+        embedding_ph, embedding_var = get_embedding_variable(embedding.shape)
+        nn_model = build_nn(2, 'cpu', cell_type, training, stars_ph, input_ph, NUM_STEPS, VECTOR_SIZE, NUM_NEURONS, seq_length_ph,
+                            out_size=VECTOR_SIZE, bidirection=bidirection, embedding=embedding_var)
+        # train a few steps, so the checkpoint holds the Adam slots of every variable
+        train_op = get_optimizer(get_loss(nn_model, tf.constant(true_words)))
+        feed_dict = {stars_ph: stars, input_ph: window_ids, seq_length_ph: seq_length}
+        with tf.Session() as sess:
+            sess.run(tf.global_variables_initializer(), feed_dict={embedding_ph: embedding})
+            for _ in range(3):
+                sess.run(train_op, feed_dict={training: True, **feed_dict})
+            tf_pred = sess.run(nn_model, feed_dict={training: False, **feed_dict})
+            tf.train.Saver().save(sess, save_path)
+
+    export_npz(save_path, npz_path)
+    with np.load(npz_path) as f:
+        assert not any('Adam' in key for key in f.files)
+    np_pred = NumpyRNN.load(npz_path)(window_ids, seq_length, stars)
+    np.testing.assert_allclose(np_pred, tf_pred, rtol=1e-4, atol=1e-4)
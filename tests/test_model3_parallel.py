@@ -0,0 +1,40 @@
+# test_model3_parallel.py
+
+'''
+The shared arrays model3_parallel.py sizes in the parent fit the variables every worker exchanges.
+'''
+
+import pytest
+
+tf = pytest.importorskip('tensorflow')
+if not hasattr(tf, 'contrib'):
+    pytest.skip('model 3 needs TensorFlow 1.x', allow_module_level=True)
+pytest.importorskip('gensim')
+from model3_config import model3_params
+from model3_parallel import build_graph, get_gradients, get_offsets, count_params
+
+EMBEDDING_SHAPE = (20, 6)
+
+
+# build_nn reads the final state of the backward cells, and the outputs of the forward cells with big_fc
+@pytest.mark.parametrize('mode, unused', [('', '/fw/'), ('big_fc', '/bw/')])
+def test_shared_sizes_bidirectional(mode, unused):
+    model_params = model3_params()
+    model_params.num_steps = 4
+    model_params.num_layers = 2
+    model_params.num_neurons = 5
+    model_params.cpu_or_gpu = 'cpu'
+    model_params.if_bidirect = True
+    model_params.mode = mode
+    bucket_width = 5 if mode != 'big_fc' else 0
+    num_params, num_trained = count_params(model_params, EMBEDDING_SHAPE, bucket_width)
+
+    # the graph of a worker
+    with tf.Graph().as_default():
+        graph = build_graph(model_params, EMBEDDING_SHAPE, bucket_width)
+        _, grads, variables = get_gradients(graph, model_params)
+        assert get_offsets(variables)[1][-1] == num_trained
+        assert get_offsets(tf.trainable_variables())[1][-1] == num_params
+        assert not any(unused in var.name for var in variables)
+        assert any(unused in var.name for var in tf.trainable_variables())
+    assert num_trained < num_params
@@ -0,0 +1,27 @@
+# test_model3_sweep.py
+
+'''
+A resumed sweep of model3_sweep.py skips the combinations results.csv already holds the scores of.
+'''
+
+import csv
+import pytest
+
+tf = pytest.importorskip('tensorflow')
+if not hasattr(tf, 'contrib'):
+    pytest.skip('model 3 needs TensorFlow 1.x', allow_module_level=True)
+pytest.importorskip('gensim')
+from model3_sweep import get_finished
+
+
+def test_get_finished(tmp_path):
+    results_path = str(tmp_path / 'results.csv')
+    assert get_finished(results_path) == set()
+    with open(results_path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=['index', 'cell_type', 'accuracy', 'error'])
+        writer.writeheader()
+        writer.writerow({'index': 0, 'cell_type': 'gru', 'accuracy': 0.5})
+        writer.writerow({'index': 1, 'cell_type': 'lstm', 'error': "ValueError('')"})
+        writer.writerow({'index': 3, 'cell_type': 'lstm', 'accuracy': 0.25})
+    # the failed combination is trained again
+    assert get_finished(results_path) == {0, 3}
@@ -0,0 +1,63 @@
+# test_train_utils.py
+
+'''
+Resuming train_epochs within an epoch from the checkpoints of CheckpointManager.
+'''
+
+import os
+import pytest
+
+tf = pytest.importorskip('tensorflow')
+if not hasattr(tf, 'Session'):
+    pytest.skip('train_utils needs TensorFlow 1.x', allow_module_level=True)
+from train_utils import CheckpointManager, train_epochs
+
+NUM_BATCHES = 5
+
+
+class Interrupted(Exception):
+    pass
+
+
+def train(save_path, num_epoch, trained, stop_after=None):
+    '''
+    Train a counter that every batch adds 1 to, checkpointing every 2 steps.
+    Output:
+        the counter after training
+    '''
+    with tf.Graph().as_default():
+        batch_ph = tf.placeholder(tf.float32, [])
+        counter = tf.Variable(0.0)
+        train_op = tf.assign_add(counter, batch_ph)
+        manager = CheckpointManager(save_path, max_to_keep=3)
+
+        def init_epoch(sess, skip):
+            for i in range(skip, NUM_BATCHES):
+                if stop_after is not None and len(trained) == stop_after:
+                    raise Interrupted()
+                trained.append(i)
+                yield {batch_ph: 1.0}
+
+        with tf.Session() as sess:
+            sess.run(tf.global_variables_initializer())
+            manager.restore(sess)
+            try:
+                train_epochs(sess, manager, counter, train_op, num_epoch, init_epoch, log_every=0, checkpoint_every=2)
+            except Interrupted:
+                pass
+            return sess.run(counter)
+
+
+def test_resume_within_epoch(tmp_path):
+    save_path = str(tmp_path / 'm.cpkt')
+    trained = []
+    train(save_path, 2, trained, stop_after=3)
+    assert trained == [0, 1, 2]
+
+    trained = []
+    # the third batch was trained after the checkpoint of step 2, so it is trained again
+    assert train(save_path, 2, trained) == 2 * NUM_BATCHES
+    assert trained == [2, 3, 4] + list(range(NUM_BATCHES))
+    # the checkpoint of the first run counts towards max_to_keep
+    assert not os.path.exists(save_path + '-2.index')
+    assert os.path.exists(save_path + '-{}.index'.format(2 * NUM_BATCHES))
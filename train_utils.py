@@ -0,0 +1,224 @@
+# train_utils.py
+
+'''
+Checkpointing, resuming and early stopping shared by the training loops of model 2 and model 3.
+A run keeps its checkpoints in the folder of its save path:
+    save_path-<step>: the latest periodic checkpoints, resumed from
+    save_path: the checkpoint with the best validation loss so far, which prediction restores
+    train_state.json: the finished epochs, the step and the batches of the current epoch at the latest checkpoint,
+        and the early stopping state
+'''
+
+import json, os, shutil
+import tensorflow as tf
+
+TRAIN_STATE = 'train_state.json'
+
+
+def prepare_save_path(save_path, policy='resume'):
+    '''
+    Decide what to do with an existing run in the folder of save_path, without asking.
+    Input:
+        policy: 'overwrite' deletes the folder, 'resume' keeps it to continue from its latest checkpoint,
+            'fail' raises if the folder exists
+    '''
+    save_folder = os.path.dirname(save_path)
+    if os.path.isdir(save_folder):
+        if policy == 'overwrite':
+            print('overwriting the existing model in {}'.format(save_folder))
+            shutil.rmtree(save_folder)
+        elif policy == 'fail':
+            raise FileExistsError('there is an existing model in {}'.format(save_folder))
+        elif policy != 'resume':
+            raise ValueError('unknown save policy {}, choose overwrite, resume or fail'.format(policy))
+    os.makedirs(save_folder, exist_ok=True)
+
+
+def split_validation(sentences, stars, fraction=0.1):
+    '''
+    Hold out the last fraction of the reviews for validation, whole reviews so no window is shared with training.
+    Output:
+        train_sentences, train_stars, val_sentences, val_stars
+    '''
+    num_val = int(len(sentences) * fraction)
+    split = len(sentences) - num_val
+    return sentences[:split], stars[:split], sentences[split:], stars[split:]
+
+
+class CheckpointManager(object):
+    '''
+    Saves and restores the checkpoints of one run, and stops training once the validation loss has not improved
+    by more than min_delta for patience epochs (patience 0 never stops early).
+    Create it after the graph is built, its savers cover the variables that exist then.
+    '''
+    def __init__(self, save_path, patience=0, min_delta=0.0, max_to_keep=3):
+        self.save_path = save_path
+        self.save_folder = os.path.dirname(save_path)
+        self.patience = patience
+        self.min_delta = min_delta
+        self.saver = tf.train.Saver(max_to_keep=max_to_keep)
+        # a new saver only knows the checkpoints it wrote, so max_to_keep would never delete those of a resumed run
+        checkpoint = tf.train.get_checkpoint_state(self.save_folder)
+        if checkpoint is not None:
+            self.saver.recover_last_checkpoints(checkpoint.all_model_checkpoint_paths)
+        self.best_saver = tf.train.Saver(max_to_keep=1)
+        self.state = {'epoch': 0, 'step': 0, 'epoch_step': 0, 'best_loss': None, 'bad_epochs': 0, 'stopped': False}
+        state_path = os.path.join(self.save_folder, TRAIN_STATE)
+        if os.path.isfile(state_path):
+            with open(state_path) as f:
+                self.state.update(json.load(f))
+
+    @property
+    def epoch(self):
+        return self.state['epoch']
+
+    @property
+    def step(self):
+        return self.state['step']
+
+    @property
+    def epoch_step(self):
+        return self.state['epoch_step']
+
+    @property
+    def stopped(self):
+        return self.state['stopped']
+
+    def restore(self, sess):
+        '''
+        Restore the latest periodic checkpoint if there is one. Training continues from the step and the batch
+        of the epoch it was saved at, so the batches trained after it are trained again.
+        Output:
+            True if a checkpoint was restored
+        '''
+        latest = tf.train.latest_checkpoint(self.save_folder)
+        if latest is None:
+            return False
+        self.saver.restore(sess, latest)
+        print('resumed from {} after {} epochs and {} batches'.format(latest, self.epoch, self.epoch_step))
+        return True
+
+    def save(self, sess, step, epoch_step):
+        '''
+        Save a periodic checkpoint and the step and the batches of the current epoch trained so far with it.
+        '''
+        self.saver.save(sess, self.save_path, global_step=step)
+        self.state['step'] = step
+        self.state['epoch_step'] = epoch_step
+        self._save_state()
+
+    def _save_state(self):
+        with open(os.path.join(self.save_folder, TRAIN_STATE), 'w') as f:
+            json.dump(self.state, f)
+
+    def end_epoch(self, sess, step, val_loss):
+        '''
+        Checkpoint after an epoch and update the early stopping state.
+        Without a validation loss (None) every epoch counts as the best so far.
+        Output:
+            True if training should stop
+        '''
+        self.state['epoch'] += 1
+        best_loss = self.state['best_loss']
+        if val_loss is None or best_loss is None or val_loss < best_loss - self.min_delta:
+            self.state['best_loss'] = None if val_loss is None else float(val_loss)
+            self.state['bad_epochs'] = 0
+            # a separate state file, so the latest periodic checkpoint is still the one resumed from
+            self.best_saver.save(sess, self.save_path, latest_filename='best_checkpoint')
+        else:
+            self.state['bad_epochs'] += 1
+        if self.patience > 0 and self.state['bad_epochs'] >= self.patience:
+            print('validation loss did not improve for {} epochs, stopping'.format(self.patience))
+            self.state['stopped'] = True
+        self.save(sess, step, 0)
+        return self.state['stopped']
+
+
+def get_validation_loss(sess, loss, batches):
+    '''
+    The mean of loss over the validation data.
+    Input:
+        batches: an iterable of (feed_dict, batch size) pairs covering the validation data once,
+            the loss of every batch is weighted by its size
+    '''
+    total, num_data = 0.0, 0
+    for feed_dict, size in batches:
+        total += sess.run(loss, feed_dict=feed_dict) * size
+        num_data += size
+    return total / max(num_data, 1)
+
+
+def skip_batches(sess, next_batch, num_batches):
+    '''
+    Take num_batches batches from a tf.data iterator without training on them, to resume within an epoch.
+    The epoch is shuffled anew, so as many batches are skipped as were trained before, not the same ones.
+    Input:
+        next_batch: a tensor of iterator.get_next()
+    '''
+    for _ in range(num_batches):
+        sess.run(next_batch)
+
+
+def train_epochs(sess, manager, loss, train_op, num_epoch, init_epoch, feed_dict=None, log_every=1000, checkpoint_every=0, validation_loss=None,
+                 summary=None, writer=None, train_step=None):
+    '''
+    The training loop shared by the models, one epoch at a time.
+    Input:
+        manager: the CheckpointManager of the run, training continues from its epoch, step and batch within the epoch
+        init_epoch: a function of the session and the number of batches of the epoch trained before resuming, which
+            prepares the rest of the epoch. It returns None for a graph that reads its batches from a tf.data iterator,
+            which then runs until the iterator is exhausted, or else an iterable of the batches:
+            their feed_dicts, or what train_step takes
+        feed_dict: fed on every step with train_op, e.g. the training flag
+        log_every: print the loss every that many batches, 0 to not print it
+        checkpoint_every: save a periodic checkpoint every that many steps as well as after every epoch, 0 for after epochs only
+        validation_loss: a function of the session returning the held-out loss, without it the last epoch is kept as the best
+        summary, writer: a summary fetched and written every log_every steps
+        train_step: a function of the session and a batch that trains on it and returns its loss,
+            for batches that take more than one run of train_op, which is not run then
+    '''
+    print("begin training")
+    if manager.stopped:
+        print('training stopped early before, nothing to do')
+        return
+    step = manager.step
+    skip = manager.epoch_step
+    for epoch in range(manager.epoch, num_epoch):
+        batches = init_epoch(sess, skip)
+        batches = iter(batches) if batches is not None else None
+        i, skip = skip, 0
+        cur_loss = None
+        while True:
+            batch = feed_dict
+            if batches is not None:
+                batch = next(batches, None)
+                if batch is None:
+                    break
+                if train_step is None and feed_dict is not None:
+                    batch_feed = dict(feed_dict)
+                    batch_feed.update(batch)
+                    batch = batch_feed
+            log = log_every > 0 and i % log_every == 0
+            try:
+                if train_step is not None:
+                    cur_loss = train_step(sess, batch)
+                elif summary is not None and log:
+                    _, cur_loss, cur_summary = sess.run([train_op, loss, summary], feed_dict=batch)
+                    writer.add_summary(cur_summary, step)
+                else:
+                    _, cur_loss = sess.run([train_op, loss], feed_dict=batch)
+            except tf.errors.OutOfRangeError:
+                break
+            if log:
+                print("loss for batch {} is {}".format(i, cur_loss))
+            i += 1
+            step += 1
+            if checkpoint_every > 0 and step % checkpoint_every == 0:
+                manager.save(sess, step, i)
+        print("loss for epoch {} is {}".format(epoch, cur_loss))
+        val_loss = None
+        if validation_loss is not None:
+            val_loss = validation_loss(sess)
+            print("validation loss for epoch {} is {}".format(epoch, val_loss))
+        if manager.end_epoch(sess, step, val_loss):
+            break
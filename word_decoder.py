@@ -0,0 +1,95 @@
+# word_decoder.py
+
+'''
+Batched nearest-neighbour decoding of predicted vectors into words, shared by the evaluation of the models.
+The embedding matrix is L2-normalized once; a batch of predicted vectors is then scored against every word with one
+matmul, and the top-k taken with argpartition, which ranks the words the same way as model.most_similar.
+The evaluation carries the ids of the true words through, so they are not recovered from their vectors again.
+'''
+
+import numpy as np
+
+_decoders = {}
+
+
+def normalize_rows(vectors):
+    '''
+    The rows of vectors scaled to unit length, rows of zeros stay zero.
+    '''
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+class WordDecoder(object):
+    '''
+    Exact cosine nearest neighbours of predicted vectors among the words of a word embedding.
+    '''
+    def __init__(self, vectors, words):
+        '''
+        Input:
+            vectors: the embedding matrix, one row per word
+            words: the word of every row
+        '''
+        self.vectors = normalize_rows(vectors)
+        self.words = list(words)
+
+    @classmethod
+    def from_model(cls, model):
+        return cls(model.wv.vectors, model.wv.index2word)
+
+    def topk(self, pred_words, k=10, batch_size=256):
+        '''
+        Input:
+            pred_words: the predicted vectors, shape (num vectors, vector size)
+            k: the number of neighbours of every vector
+            batch_size: the vectors scored by one matmul, the scores take batch_size x vocabulary floats
+        Output:
+            the ids of the k most similar words of every vector, most similar first, shape (num vectors, k)
+        '''
+        pred_words = normalize_rows(pred_words)
+        k = min(k, len(self.words))
+        top = np.empty((len(pred_words), k), dtype=np.int64)
+        for start in range(0, len(pred_words), batch_size):
+            scores = np.dot(pred_words[start:start + batch_size], self.vectors.T)
+            if k < scores.shape[1]:
+                index = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+            else:
+                index = np.tile(np.arange(scores.shape[1]), (len(scores), 1))
+            order = np.argsort(-np.take_along_axis(scores, index, axis=1), axis=1, kind='stable')
+            top[start:start + batch_size] = np.take_along_axis(index, order, axis=1)
+        return top
+
+    def nearest(self, vectors, batch_size=256):
+        '''
+        The id of the most similar word of every vector, e.g. to recover the true words from their vectors.
+        '''
+        return self.topk(vectors, 1, batch_size)[:, 0]
+
+
+def get_decoder(model):
+    '''
+    The decoder of a word embedding: the one given to set_decoder, or a WordDecoder normalized once
+    and reused by every later call with the same model.
+    '''
+    key = id(model)
+    if key not in _decoders or _decoders[key][0] is not model:
+        _decoders[key] = (model, WordDecoder.from_model(model))
+    return _decoders[key][1]
+
+
+def set_decoder(model, decoder):
+    '''
+    Make get_decoder(model) return decoder, e.g. an IVFIndex of ann_index.py to decode approximately.
+    '''
+    _decoders[id(model)] = (model, decoder)
+
+
+def get_topk_accuracy(decoder, true_ids, pred_words, topn=10):
+    '''
+    The fraction of predicted vectors whose true word is among their topn most similar words.
+    '''
+    if len(true_ids) == 0:
+        return 0.0
+    top = decoder.topk(pred_words, topn)
+    return float(np.mean(np.any(top == np.asarray(true_ids)[:, None], axis=1)))